@@ -12,8 +12,9 @@ CREATE TABLE roles (
 -- Create table for staff_accounts
 CREATE TABLE staff_accounts (
     staff_id BINARY(16) PRIMARY KEY,
+    restaurant_id INT NOT NULL DEFAULT 1,
     role_id INT NOT NULL,
-    username VARCHAR(255) NOT NULL UNIQUE,
+    username VARCHAR(255) NOT NULL,
     password VARCHAR(255) NOT NULL,
     full_name VARCHAR(255) NOT NULL,
     gender ENUM('male', 'female', 'others') NOT NULL,
@@ -21,48 +22,64 @@ CREATE TABLE staff_accounts (
     created_at TIMESTAMP NOT NULL,
     is_active BOOLEAN DEFAULT TRUE,
     FOREIGN KEY (role_id) REFERENCES roles(role_id),
-    INDEX (username)
+    UNIQUE KEY uq_staff_accounts_restaurant_username (restaurant_id, username)
 );
 
 -- Create table for tables
 CREATE TABLE tables (
     table_id INT PRIMARY KEY AUTO_INCREMENT,
+    restaurant_id INT NOT NULL DEFAULT 1,
     capacity INT NOT NULL,
     table_status ENUM('vacant', 'reserved', 'eating') NOT NULL DEFAULT 'vacant',
-    INDEX (table_id)
+    INDEX (table_id),
+    INDEX ix_tables_restaurant_status (restaurant_id, table_status)
 );
 
 -- Create table for orders
 CREATE TABLE orders (
     order_id BINARY(16) PRIMARY KEY,
+    restaurant_id INT NOT NULL DEFAULT 1,
     table_id INT NOT NULL,
     staff_id BINARY(16) NOT NULL,
     is_served BOOLEAN DEFAULT FALSE,
     created_at TIMESTAMP NOT NULL,
     FOREIGN KEY (table_id) REFERENCES tables(table_id),
-    FOREIGN KEY (staff_id) REFERENCES staff_accounts(staff_id)
+    FOREIGN KEY (staff_id) REFERENCES staff_accounts(staff_id),
+    INDEX ix_orders_restaurant_table_served (restaurant_id, table_id, is_served),
+    INDEX ix_orders_restaurant_created_at (restaurant_id, created_at)
 );
 
+-- Point each table at its unserved order, added once orders exists
+ALTER TABLE tables
+    ADD COLUMN current_order_id BINARY(16) NULL,
+    ADD CONSTRAINT fk_tables_current_order_id FOREIGN KEY (current_order_id) REFERENCES orders(order_id);
+
 -- Create table for menu_sections
 CREATE TABLE menu_sections (
     menu_section_id INT PRIMARY KEY AUTO_INCREMENT,
+    restaurant_id INT NOT NULL DEFAULT 1,
     section_name VARCHAR(255) NOT NULL,
-    INDEX (menu_section_id)
+    INDEX (menu_section_id),
+    INDEX ix_menu_sections_restaurant (restaurant_id, menu_section_id)
 );
 
 -- Create table for menu_items
 CREATE TABLE menu_items (
     menu_item_id BINARY(16) PRIMARY KEY,
+    restaurant_id INT NOT NULL DEFAULT 1,
     menu_section_id INT NOT NULL,
-    item_name VARCHAR(255) NOT NULL UNIQUE,
+    item_name VARCHAR(255) NOT NULL,
     note VARCHAR(255),
     price FLOAT NOT NULL,
-    FOREIGN KEY (menu_section_id) REFERENCES menu_sections(menu_section_id)
+    FOREIGN KEY (menu_section_id) REFERENCES menu_sections(menu_section_id),
+    UNIQUE KEY uq_menu_items_restaurant_item_name (restaurant_id, item_name),
+    INDEX ix_menu_items_restaurant_section (restaurant_id, menu_section_id)
 );
 
 -- Create table for dishes
 CREATE TABLE dishes (
     dish_id BINARY(16) PRIMARY KEY,
+    restaurant_id INT NOT NULL DEFAULT 1,
     order_id BINARY(16) NOT NULL,
     staff_id BINARY(16) NOT NULL,
     menu_item_id BINARY(16) NOT NULL,
@@ -70,9 +87,65 @@ CREATE TABLE dishes (
     quantity INT NOT NULL,
     total FLOAT NOT NULL,
     dish_status ENUM('received', 'prepared', 'ready') NOT NULL DEFAULT 'received',
+    received_at TIMESTAMP NULL,
+    prepared_at TIMESTAMP NULL,
+    ready_at TIMESTAMP NULL,
     FOREIGN KEY (order_id) REFERENCES orders(order_id),
     FOREIGN KEY (staff_id) REFERENCES staff_accounts(staff_id),
-    FOREIGN KEY (menu_item_id) REFERENCES menu_items(menu_item_id)
+    FOREIGN KEY (menu_item_id) REFERENCES menu_items(menu_item_id),
+    INDEX ix_dishes_restaurant_order (restaurant_id, order_id),
+    INDEX ix_dishes_restaurant_received_at (restaurant_id, received_at)
+);
+
+-- Create table for kitchen_stations, each chef screen shows the tickets of its menu sections
+CREATE TABLE kitchen_stations (
+    station_id INT PRIMARY KEY AUTO_INCREMENT,
+    restaurant_id INT NOT NULL DEFAULT 1,
+    station_name VARCHAR(255) NOT NULL,
+    INDEX (station_id),
+    UNIQUE KEY uq_kitchen_stations_restaurant_station_name (restaurant_id, station_name)
+);
+
+-- Create table for station_sections
+CREATE TABLE station_sections (
+    station_id INT NOT NULL,
+    menu_section_id INT NOT NULL,
+    restaurant_id INT NOT NULL DEFAULT 1,
+    PRIMARY KEY (station_id, menu_section_id),
+    FOREIGN KEY (station_id) REFERENCES kitchen_stations(station_id),
+    FOREIGN KEY (menu_section_id) REFERENCES menu_sections(menu_section_id)
+);
+
+-- Create table for kitchen_tickets, a copy of what the kitchen shows, rebuilt from dishes when needed
+CREATE TABLE kitchen_tickets (
+    dish_id BINARY(16) PRIMARY KEY,
+    restaurant_id INT NOT NULL DEFAULT 1,
+    order_id BINARY(16) NOT NULL,
+    table_id INT NOT NULL,
+    menu_item_id BINARY(16) NOT NULL,
+    menu_section_id INT NOT NULL,
+    item_name VARCHAR(255) NOT NULL,
+    quantity INT NOT NULL,
+    note VARCHAR(255),
+    dish_status ENUM('received', 'prepared', 'ready') NOT NULL DEFAULT 'received',
+    ordered_at TIMESTAMP NOT NULL,
+    INDEX ix_kitchen_tickets_menu_item_id (menu_item_id),
+    INDEX ix_kitchen_tickets_restaurant_ordered_at (restaurant_id, ordered_at),
+    INDEX ix_kitchen_tickets_restaurant_section (restaurant_id, menu_section_id, ordered_at)
+);
+
+-- Create table for audit_events, append-only and written in batches
+CREATE TABLE audit_events (
+    audit_event_id BIGINT PRIMARY KEY AUTO_INCREMENT,
+    restaurant_id INT NOT NULL DEFAULT 1,
+    event_type VARCHAR(64) NOT NULL,
+    entity_type VARCHAR(32) NOT NULL,
+    entity_id VARCHAR(36) NOT NULL,
+    staff_id BINARY(16),
+    detail TEXT,
+    created_at TIMESTAMP NOT NULL,
+    INDEX ix_audit_events_entity (restaurant_id, entity_type, entity_id, created_at),
+    INDEX ix_audit_events_created_at (restaurant_id, created_at)
 );
 
 -- Insert data into roles
@@ -100,6 +173,19 @@ INSERT INTO menu_sections (section_name) VALUES
 ('Desserts'),
 ('Drinks');
 
+-- Insert data into kitchen_stations
+INSERT INTO kitchen_stations (station_name) VALUES
+('Kitchen'),
+('Pastry'),
+('Bar');
+
+-- Insert data into station_sections
+INSERT INTO station_sections (station_id, menu_section_id) VALUES
+(1, 1),
+(1, 2),
+(2, 3),
+(3, 4);
+
 -- Insert data into menu-items
 INSERT INTO menu_items (menu_item_id, menu_section_id, item_name, note, price) VALUES
 -- Items into Main Courses
@@ -139,3 +225,6 @@ INSERT INTO dishes (dish_id, order_id, staff_id, menu_item_id, note, quantity, t
 (UUID_TO_BIN('550e8400-e29b-41d4-a716-446655440027'), UUID_TO_BIN('550e8400-e29b-41d4-a716-446655440023'), UUID_TO_BIN('550e8400-e29b-41d4-a716-446655440000'), UUID_TO_BIN('550e8400-e29b-41d4-a716-446655440016'), 'Warm', 2, 8.98, 'prepared'),
 (UUID_TO_BIN('550e8400-e29b-41d4-a716-446655440028'), UUID_TO_BIN('550e8400-e29b-41d4-a716-446655440023'), UUID_TO_BIN('550e8400-e29b-41d4-a716-446655440000'), UUID_TO_BIN('550e8400-e29b-41d4-a716-446655440018'), 'With ice', 1, 1.25, 'ready'),
 (UUID_TO_BIN('550e8400-e29b-41d4-a716-446655440029'), UUID_TO_BIN('550e8400-e29b-41d4-a716-446655440023'), UUID_TO_BIN('550e8400-e29b-41d4-a716-446655440000'), UUID_TO_BIN('550e8400-e29b-41d4-a716-446655440019'), 'No ice', 1, 1.50, 'ready');
+
+-- Point table 3 at its unserved order
+UPDATE tables SET current_order_id = UUID_TO_BIN('550e8400-e29b-41d4-a716-446655440023') WHERE table_id = 3;
@@ -0,0 +1,176 @@
+# This file admits requests by priority when the server is saturated, and sheds what cannot wait
+import os
+import math
+import time
+import json
+import asyncio
+import logging
+from collections import deque
+from dotenv import load_dotenv
+from jose import JWTError
+
+from . import crud
+
+# Load variables from constants
+load_dotenv()
+# Requests running at once per worker, the size of the thread pool sync endpoints run in
+ADMISSION_CONCURRENCY = int(os.getenv("ADMISSION_CONCURRENCY", 40))
+# Low priority requests are refused outright while queued requests wait longer than this
+ADMISSION_LATENCY_TARGET = float(os.getenv("ADMISSION_LATENCY_TARGET", 0.5))
+logger = logging.getLogger(__name__)
+
+# Highest priority first: share of the concurrency a class may use, and how long it may queue
+CRITICAL, NORMAL, LOW = "critical", "normal", "low"
+PRIORITIES = [CRITICAL, NORMAL, LOW]
+CLASS_SHARES = {CRITICAL: 1.0, NORMAL: 0.75, LOW: 0.25}
+CLASS_DEADLINES = {CRITICAL: 5.0, NORMAL: 1.0, LOW: 0.25}
+# Never queued or limited
+BYPASS_PATHS = ("/health/", "/docs", "/openapi.json")
+WAITER, CHEF, MANAGER = 1, 2, 3
+
+
+class Overloaded(Exception):
+    def __init__(self, retry_after: float):
+        self.retry_after = retry_after
+
+
+def request_role(headers):
+    # role_id claim of a valid bearer token, None for anonymous or invalid tokens
+    authorization = headers.get(b"authorization", b"").decode("latin-1")
+    scheme, _, token = authorization.partition(" ")
+    if scheme.lower() != "bearer" or not token:
+        return None
+    try:
+        return crud.decode_access_token(token).get("role_id")
+    except JWTError:
+        return None
+
+
+def classify(method: str, path: str, role_id):
+    # Order taking and kitchen writes first, floor staff reads next, manager and anonymous traffic last
+    if role_id in (WAITER, CHEF):
+        return CRITICAL if method != "GET" else NORMAL
+    if role_id == MANAGER and method != "GET":
+        return NORMAL
+    return LOW
+
+
+class AdmissionController:
+    # Runs on the event loop of one worker, so plain counters are enough
+    def __init__(self, concurrency: int = ADMISSION_CONCURRENCY, latency_target: float = ADMISSION_LATENCY_TARGET,
+                 shares: dict = None, deadlines: dict = None):
+        self.concurrency = concurrency
+        self.latency_target = latency_target
+        shares = shares or CLASS_SHARES
+        self.limits = {name: max(int(concurrency * shares[name]), 1) for name in PRIORITIES}
+        self.deadlines = dict(deadlines or CLASS_DEADLINES)
+        self.in_flight = {name: 0 for name in PRIORITIES}
+        self.waiting = {name: deque() for name in PRIORITIES}
+        # Moving average of queue waits, the overload signal
+        self.queue_delay = 0.0
+        self.stats = {name: {"admitted": 0, "shed": 0, "timed_out": 0} for name in PRIORITIES}
+
+    def total_in_flight(self):
+        return sum(self.in_flight.values())
+
+    def can_admit(self, name: str):
+        return self.total_in_flight() < self.concurrency and self.in_flight[name] < self.limits[name]
+
+    def higher_waiting(self, name: str):
+        # Anyone of the same or a higher class already queued goes first
+        return any(self.waiting[other] for other in PRIORITIES[:PRIORITIES.index(name) + 1])
+
+    def retry_after(self):
+        return max(1, math.ceil(self.queue_delay))
+
+    def observe(self, waited: float):
+        self.queue_delay = 0.8 * self.queue_delay + 0.2 * waited
+
+    async def acquire(self, name: str):
+        if self.can_admit(name) and not self.higher_waiting(name):
+            self.admit(name, 0.0)
+            return
+        if name == LOW and self.queue_delay > self.latency_target:
+            self.stats[name]["shed"] += 1
+            raise Overloaded(self.retry_after())
+        waiter = asyncio.get_running_loop().create_future()
+        entry = (waiter, time.monotonic())
+        self.waiting[name].append(entry)
+        try:
+            await asyncio.wait_for(asyncio.shield(waiter), self.deadlines[name])
+        except asyncio.TimeoutError:
+            if waiter.done():
+                # Admitted just as the deadline passed, keep the slot
+                return
+            self.abandon(name, entry)
+            self.stats[name]["timed_out"] += 1
+            self.observe(self.deadlines[name])
+            raise Overloaded(self.retry_after())
+        except asyncio.CancelledError:
+            # The client went away while queued, give back a slot it may have just been handed
+            if waiter.done():
+                self.release(name)
+            else:
+                self.abandon(name, entry)
+            raise
+
+    def abandon(self, name: str, entry):
+        self.waiting[name].remove(entry)
+        entry[0].cancel()
+
+    def admit(self, name: str, waited: float):
+        self.in_flight[name] += 1
+        self.stats[name]["admitted"] += 1
+        self.observe(waited)
+
+    def release(self, name: str):
+        self.in_flight[name] -= 1
+        self.dispatch()
+
+    def dispatch(self):
+        # Hand free slots to queued requests, highest class first
+        for name in PRIORITIES:
+            queue = self.waiting[name]
+            while queue and self.can_admit(name):
+                waiter, queued_at = queue.popleft()
+                if waiter.done():
+                    continue
+                self.admit(name, time.monotonic() - queued_at)
+                waiter.set_result(None)
+
+
+class AdmissionMiddleware:
+    # Plain ASGI, the slot is held until the response has been sent
+    def __init__(self, app, controller: AdmissionController):
+        self.app = app
+        self.controller = controller
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or scope["method"] == "OPTIONS" or scope["path"].startswith(BYPASS_PATHS):
+            await self.app(scope, receive, send)
+            return
+        name = classify(scope["method"], scope["path"], request_role(dict(scope["headers"])))
+        try:
+            await self.controller.acquire(name)
+        except Overloaded as overloaded:
+            await self.reject(send, overloaded.retry_after)
+            return
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            self.controller.release(name)
+
+    @staticmethod
+    async def reject(send, retry_after: int):
+        body = json.dumps({"detail": "Server is busy, please retry"}).encode()
+        await send({
+            "type": "http.response.start",
+            "status": 503,
+            "headers": [(b"content-type", b"application/json"),
+                        (b"content-length", str(len(body)).encode()),
+                        (b"retry-after", str(retry_after).encode())],
+        })
+        await send({"type": "http.response.body", "body": body})
+
+
+admission = AdmissionController()
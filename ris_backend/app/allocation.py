@@ -0,0 +1,93 @@
+# This file keeps the vacant tables bucketed by capacity, for best-fit allocation of a party
+import bisect
+import threading
+from datetime import datetime
+from sqlalchemy.orm import Session
+
+from . import models
+from .events import event_bus
+from .tenancy import TenantRegistry
+
+
+class VacantTableIndex:
+    # capacities is sorted and only holds capacities with at least one vacant table,
+    # so the best fit is one bisect away; each bucket keeps its table ids sorted
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.capacities = []
+            self.buckets = {}
+            self.reconciled_at = None
+
+    def add(self, table_id: int, capacity: int):
+        with self.lock:
+            bucket = self.buckets.get(capacity)
+            if bucket is None:
+                bucket = self.buckets[capacity] = []
+                bisect.insort(self.capacities, capacity)
+            position = bisect.bisect_left(bucket, table_id)
+            if position == len(bucket) or bucket[position] != table_id:
+                bucket.insert(position, table_id)
+
+    def remove(self, table_id: int, capacity: int):
+        with self.lock:
+            bucket = self.buckets.get(capacity)
+            if not bucket:
+                return
+            position = bisect.bisect_left(bucket, table_id)
+            if position < len(bucket) and bucket[position] == table_id:
+                del bucket[position]
+            if not bucket:
+                del self.buckets[capacity]
+                del self.capacities[bisect.bisect_left(self.capacities, capacity)]
+
+    def best_fit(self, party_size: int, exclude=()):
+        # Smallest capacity that seats the party, lowest table id within it
+        with self.lock:
+            start = bisect.bisect_left(self.capacities, party_size)
+            for capacity in self.capacities[start:]:
+                for table_id in self.buckets[capacity]:
+                    if table_id not in exclude:
+                        return table_id, capacity
+        return None
+
+    def snapshot(self):
+        with self.lock:
+            return {table_id for bucket in self.buckets.values() for table_id in bucket}
+
+    def reconcile(self, db: Session):
+        # Reload from the tables rows, returns the table ids the index had wrong
+        rows = db.query(models.Table.table_id, models.Table.capacity)\
+            .filter(models.Table.table_status == "vacant").all()
+        buckets = {}
+        for table_id, capacity in sorted(rows):
+            buckets.setdefault(capacity, []).append(table_id)
+        before = self.snapshot()
+        # Swapped in one step, allocations never see a half built index
+        with self.lock:
+            self.buckets = buckets
+            self.capacities = sorted(buckets)
+            self.reconciled_at = datetime.utcnow()
+        after = self.snapshot()
+        return {"missing": sorted(after - before), "stale": sorted(before - after)}
+
+
+# One index per restaurant
+vacant_tables = TenantRegistry(VacantTableIndex)
+
+# ------------------------ EVENT HANDLERS ------------------------
+
+
+def on_table_status_changed(item):
+    payload = item.payload
+    index = vacant_tables.get(payload["restaurant_id"])
+    if payload["new"] == "vacant":
+        index.add(payload["table_id"], payload["capacity"])
+    elif payload["old"] == "vacant":
+        index.remove(payload["table_id"], payload["capacity"])
+
+
+event_bus.on_commit(["table_status_changed"], on_table_status_changed)
@@ -0,0 +1,201 @@
+# This file records every committed state transition in the audit_events table, written in batches
+import os
+import json
+import logging
+import threading
+from sqlalchemy import insert
+from dotenv import load_dotenv
+
+from . import models
+from .database import TENANT_KEY, DEFAULT_RESTAURANT_ID
+from .events import event_bus
+
+# Load variables from constants
+load_dotenv()
+AUDIT_BATCH_SIZE = int(os.getenv("AUDIT_BATCH_SIZE", 200))
+AUDIT_FLUSH_INTERVAL = float(os.getenv("AUDIT_FLUSH_INTERVAL", 1.0))
+AUDIT_MAX_BUFFER = int(os.getenv("AUDIT_MAX_BUFFER", 5000))
+logger = logging.getLogger(__name__)
+
+AUDITED_EVENTS = ["table_status_changed", "dish_status_changed", "dishes_added",
+                  "order_created", "order_served", "menu_changed"]
+
+
+def detail_json(**values):
+    # UUIDs and datetimes are stored as their string form
+    return json.dumps(values, default=str, sort_keys=True)
+
+
+def audit_rows(item):
+    # One committed event to one or more audit_events rows
+    payload = item.payload
+    staff_id = payload.get("staff_id")
+    if item.name == "table_status_changed":
+        rows = [("table_status_changed", "table", payload["table_id"],
+                 detail_json(old=payload["old"], new=payload["new"]))]
+    elif item.name == "dish_status_changed":
+        rows = [("dish_status_changed", "dish", payload["dish_id"],
+                 detail_json(order_id=payload["order_id"], old=payload["old"], new=payload["new"]))]
+    elif item.name == "dishes_added":
+        rows = [("dish_added", "dish", dish["dish_id"],
+                 detail_json(order_id=payload["order_id"], menu_item_id=dish["menu_item_id"],
+                             quantity=dish["quantity"]))
+                for dish in payload["dishes"]]
+    elif item.name in ("order_created", "order_served"):
+        rows = [(item.name, "order", payload["order_id"], detail_json(table_id=payload["table_id"]))]
+    else:
+        # Menu changes are about an item when there is one, otherwise about a section
+        if payload.get("menu_item_id") is not None:
+            entity = ("menu_item", payload["menu_item_id"])
+        else:
+            entity = ("menu_section", payload["menu_section_id"])
+        extra = {key: value for key, value in payload.items()
+                 if key not in ("action", "staff_id", "menu_item_id")}
+        rows = [(payload["action"], entity[0], entity[1], detail_json(**extra))]
+    return [{
+        "event_type": event_type,
+        "entity_type": entity_type,
+        "entity_id": str(entity_id),
+        "staff_id": staff_id,
+        "detail": detail,
+        "created_at": item.created_at,
+        "restaurant_id": payload.get("restaurant_id", DEFAULT_RESTAURANT_ID),
+    } for event_type, entity_type, entity_id, detail in rows]
+
+
+class AuditLog:
+    # Group commit: rows wait in memory and are written as one multi-row INSERT per batch.
+    # A crash loses at most what is buffered, bounded by AUDIT_FLUSH_INTERVAL and AUDIT_MAX_BUFFER.
+    def __init__(self, batch_size: int = AUDIT_BATCH_SIZE, flush_interval: float = AUDIT_FLUSH_INTERVAL,
+                 max_buffer: int = AUDIT_MAX_BUFFER, session_factory=None):
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.max_buffer = max_buffer
+        self.session_factory = session_factory
+        self.buffer = []
+        self.lock = threading.Lock()
+        # Only one writer at a time, so batches land in the order they were recorded
+        self.write_lock = threading.Lock()
+        self.wakeup = threading.Event()
+        self.stopping = threading.Event()
+        self.thread = None
+        self.stats = {"recorded": 0, "written": 0, "batches": 0, "failed_flushes": 0, "dropped": 0}
+
+    # ------------------------ RECORDING ------------------------
+
+    def record(self, item):
+        rows = audit_rows(item)
+        with self.lock:
+            self.buffer.extend(rows)
+            self.stats["recorded"] += len(rows)
+            size = len(self.buffer)
+        if size >= self.max_buffer:
+            # The writer is not keeping up, make the committing request pay for the write
+            self.flush()
+        elif size >= self.batch_size:
+            self.wakeup.set()
+
+    def pending(self):
+        with self.lock:
+            return len(self.buffer)
+
+    def clear(self):
+        with self.lock:
+            self.buffer = []
+
+    # ------------------------ WRITING ------------------------
+
+    def flush(self, db=None):
+        # Write everything buffered so far, returns the number of rows written.
+        # Each restaurant's rows go to its own shard, a shard that is down does not hold back the others
+        with self.write_lock:
+            with self.lock:
+                rows, self.buffer = self.buffer, []
+            if not rows:
+                return 0
+            groups = {}
+            for row in rows:
+                groups.setdefault(row["restaurant_id"], []).append(row)
+            written = 0
+            failed = []
+            for restaurant_id, group in groups.items():
+                done = 0
+                try:
+                    for start in range(0, len(group), self.batch_size):
+                        self.write(group[start:start + self.batch_size], db)
+                        done += len(group[start:start + self.batch_size])
+                except Exception:
+                    logger.exception("Audit flush failed for restaurant %s, %d rows kept for the next attempt",
+                                     restaurant_id, len(group) - done)
+                    failed.extend(group[done:])
+                    with self.lock:
+                        self.stats["failed_flushes"] += 1
+                written += done
+            if failed:
+                self.requeue(failed)
+            with self.lock:
+                self.stats["written"] += written
+            return written
+
+    def write(self, rows, db=None):
+        # rows all belong to one restaurant, the given session is only used when it is scoped to it
+        restaurant_id = rows[0]["restaurant_id"]
+        own_session = db is None or db.info.get(TENANT_KEY) != restaurant_id
+        if own_session:
+            db = self.make_session(restaurant_id)
+        try:
+            db.execute(insert(models.AuditEvent), rows)
+            db.commit()
+        except Exception:
+            db.rollback()
+            raise
+        finally:
+            if own_session:
+                db.close()
+        with self.lock:
+            self.stats["batches"] += 1
+
+    def make_session(self, restaurant_id: int):
+        if self.session_factory is None:
+            from .database import router
+            self.session_factory = router.session
+        return self.session_factory(restaurant_id)
+
+    def requeue(self, rows):
+        # Failed rows go back in front, the oldest are dropped once the buffer is full
+        with self.lock:
+            self.buffer = rows + self.buffer
+            overflow = len(self.buffer) - self.max_buffer
+            if overflow > 0:
+                self.buffer = self.buffer[overflow:]
+                self.stats["dropped"] += overflow
+                logger.error("Audit buffer full, dropped %d rows", overflow)
+
+    # ------------------------ FLUSH THREAD ------------------------
+
+    def start(self):
+        if self.thread is not None:
+            return
+        self.stopping.clear()
+        self.thread = threading.Thread(target=self.run, name="audit-writer", daemon=True)
+        self.thread.start()
+
+    def stop(self, timeout: float = 10.0):
+        if self.thread is not None:
+            self.stopping.set()
+            self.wakeup.set()
+            self.thread.join(timeout)
+            self.thread = None
+        # Whatever is left is written before shutdown
+        return self.flush()
+
+    def run(self):
+        while not self.stopping.is_set():
+            # Flush on size, or at the latest every flush_interval
+            self.wakeup.wait(self.flush_interval)
+            self.wakeup.clear()
+            self.flush()
+
+
+audit_log = AuditLog()
+event_bus.on_commit(AUDITED_EVENTS, audit_log.record)
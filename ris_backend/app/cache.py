@@ -0,0 +1,171 @@
+# This file keeps serialized read responses in memory together with their compressed variants
+import os
+import gzip
+import time
+import threading
+from collections import OrderedDict
+from typing import Optional
+from fastapi import Response
+from dotenv import load_dotenv
+from .events import event_bus
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+# Load variables from constants
+load_dotenv()
+MIN_COMPRESS_SIZE = int(os.getenv("MIN_COMPRESS_SIZE", 500))
+RESPONSE_CACHE_SIZE = int(os.getenv("RESPONSE_CACHE_SIZE", 256))
+# Invalidation only reaches the worker that committed the write, so other workers serve an entry at most this long
+CACHE_TTL_SECONDS = float(os.getenv("CACHE_TTL_SECONDS", 30))
+GZIP_LEVEL = 6
+BROTLI_QUALITY = 5
+
+
+def supported_encodings():
+    # Encodings we can produce, best first
+    return ("br", "gzip") if brotli else ("gzip",)
+
+
+def negotiate_encoding(accept_encoding: Optional[str]):
+    # Pick the best encoding the client accepts, None means identity
+    if not accept_encoding:
+        return None
+    accepted = {}
+    for part in accept_encoding.split(","):
+        name, _, params = part.strip().partition(";")
+        quality = 1.0
+        params = params.strip()
+        if params.startswith("q="):
+            try:
+                quality = float(params[2:])
+            except ValueError:
+                quality = 0.0
+        accepted[name.strip().lower()] = quality
+    for encoding in supported_encodings():
+        if accepted.get(encoding, accepted.get("*", 0.0)) > 0:
+            return encoding
+    return None
+
+
+def compress(body: bytes, encoding: str):
+    if encoding == "br":
+        return brotli.compress(body, quality=BROTLI_QUALITY)
+    return gzip.compress(body, compresslevel=GZIP_LEVEL, mtime=0)
+
+
+def order_tag(order_id):
+    # Tag of everything cached for one order, such as its bill
+    return f"order:{order_id}"
+
+
+def tenant_tag(restaurant_id: int, tag: str):
+    # Restaurants share the cache, so every tag is qualified by the restaurant it belongs to
+    return f"{restaurant_id}:{tag}"
+
+
+class CachedBody:
+    # One serialized body plus each compressed variant, built the first time it is asked for
+    def __init__(self, body: bytes, media_type: str = "application/json"):
+        self.body = body
+        self.media_type = media_type
+        self.created_at = time.monotonic()
+        self.variants = {}
+        self.lock = threading.Lock()
+
+    def encoded(self, encoding: Optional[str]):
+        # Small bodies are not worth the compression header overhead
+        if encoding is None or len(self.body) < MIN_COMPRESS_SIZE:
+            return None, self.body
+        variant = self.variants.get(encoding)
+        if variant is None:
+            with self.lock:
+                variant = self.variants.get(encoding)
+                if variant is None:
+                    variant = compress(self.body, encoding)
+                    self.variants[encoding] = variant
+        return encoding, variant
+
+    def response(self, accept_encoding: Optional[str], status_code: int = 200):
+        encoding, content = self.encoded(negotiate_encoding(accept_encoding))
+        headers = {"Vary": "Accept-Encoding"}
+        if encoding:
+            headers["Content-Encoding"] = encoding
+        return Response(content=content, status_code=status_code, media_type=self.media_type, headers=headers)
+
+
+class ResponseCache:
+    # LRU of CachedBody entries, invalidated by tag after writes commit and dropped once older than max_age
+    def __init__(self, max_entries: int = RESPONSE_CACHE_SIZE, max_age: float = CACHE_TTL_SECONDS):
+        self.max_entries = max_entries
+        self.max_age = max_age
+        self.entries = OrderedDict()
+        self.tags = {}
+        self.generations = {}
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return None
+            if time.monotonic() - entry.created_at >= self.max_age:
+                # Its tags still list the key, invalidate() and put() cope with that
+                del self.entries[key]
+                return None
+            self.entries.move_to_end(key)
+            return entry
+
+    def generation(self, tags):
+        # Snapshot taken before a body is built, see put()
+        with self.lock:
+            return tuple(self.generations.get(tag, 0) for tag in tags)
+
+    def put(self, key, body: bytes, tags, generation=None):
+        entry = CachedBody(body)
+        with self.lock:
+            # A write committed while the body was being built, so it may be stale
+            if generation is not None and generation != tuple(self.generations.get(tag, 0) for tag in tags):
+                return entry
+            self.entries[key] = entry
+            self.entries.move_to_end(key)
+            for tag in tags:
+                self.tags.setdefault(tag, set()).add(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+        return entry
+
+    def invalidate(self, *tags):
+        with self.lock:
+            for tag in tags:
+                self.generations[tag] = self.generations.get(tag, 0) + 1
+                for key in self.tags.pop(tag, ()):
+                    self.entries.pop(key, None)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.tags.clear()
+
+
+response_cache = ResponseCache()
+
+
+# ------------------------ EVENT HANDLERS ------------------------
+
+
+def on_event(item):
+    # Drop cached bodies as soon as the write behind them commits
+    if item.name == "table_status_changed":
+        tag = "tables"
+    elif item.name == "menu_changed":
+        tag = "menu"
+    else:
+        tag = order_tag(item.payload["order_id"])
+    response_cache.invalidate(tenant_tag(item.payload["restaurant_id"], tag))
+
+
+event_bus.on_commit(["table_status_changed", "menu_changed", "order_created", "dishes_added",
+                     "dish_status_changed", "order_served"], on_event)
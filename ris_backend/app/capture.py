@@ -0,0 +1,279 @@
+# This file records request traces to rotating local files, bodies reduced to their shape, replayed with tools.replay
+import os
+import json
+import gzip
+import time
+import queue
+import hashlib
+import logging
+import threading
+from datetime import datetime
+from urllib.parse import parse_qsl
+from dotenv import load_dotenv
+from jose import JWTError
+
+from . import crud
+from .database import DEFAULT_RESTAURANT_ID
+
+# Load variables from constants
+load_dotenv()
+CAPTURE_ENABLED = os.getenv("CAPTURE_ENABLED", "false").lower() in ("1", "true", "yes")
+CAPTURE_DIR = os.getenv("CAPTURE_DIR", "captures")
+# A file is rotated once it is this large, the oldest rotated files go first once there are more than keep
+CAPTURE_MAX_BYTES = int(os.getenv("CAPTURE_MAX_BYTES", 20 * 1024 * 1024))
+CAPTURE_KEEP = int(os.getenv("CAPTURE_KEEP", 50))
+# Larger request bodies are recorded by size only
+CAPTURE_MAX_BODY = int(os.getenv("CAPTURE_MAX_BODY", 64 * 1024))
+# Traces waiting for the writer, more are dropped rather than slowing requests down
+CAPTURE_MAX_QUEUE = int(os.getenv("CAPTURE_MAX_QUEUE", 10000))
+# Never recorded, replaying them tells nothing about the tablets
+SKIP_PATHS = ("/health/", "/docs", "/openapi.json")
+# Request headers that change what the server does
+KEPT_HEADERS = (b"x-restaurant-id", b"idempotency-key", b"accept-encoding")
+SENSITIVE_KEYS = ("password", "token", "secret", "authorization")
+REDACTED = "***"
+# Body values the replay needs to hit the same rows, everything else is recorded as its type only
+KEPT_VALUES = ("quantity", "party_size", "op")
+KEPT_SUFFIXES = ("_id", "_ids")
+logger = logging.getLogger(__name__)
+
+
+def sanitize(value):
+    # Same shape, secrets replaced
+    if isinstance(value, dict):
+        return {key: REDACTED if any(word in key.lower() for word in SENSITIVE_KEYS) else sanitize(item)
+                for key, item in value.items()}
+    if isinstance(value, list):
+        return [sanitize(item) for item in value]
+    return value
+
+
+def body_shape(value, key: str = None):
+    # Keys and value types, so names, notes, dates of birth and credentials never reach the file
+    if isinstance(value, dict):
+        return {name: body_shape(item, name) for name, item in value.items()}
+    if isinstance(value, list):
+        return [body_shape(item, key) for item in value]
+    if value is None or (key is not None and (key in KEPT_VALUES or key.endswith(KEPT_SUFFIXES))):
+        return value
+    return f"<{type(value).__name__}>"
+
+
+def user_key(restaurant_id, username):
+    # Stable per user and restaurant, without the username itself
+    if username is None:
+        return None
+    return hashlib.sha256(f"{restaurant_id}:{username}".encode()).hexdigest()[:16]
+
+
+def route_template(path: str, path_params: dict):
+    # /users/waiter/orders/<uuid>/bill -> /users/waiter/orders/{order_id}/bill, to group latencies by endpoint
+    values = {str(value): f"{{{name}}}" for name, value in path_params.items()}
+    return "/".join(values.get(segment, segment) for segment in path.split("/"))
+
+
+def parse_body(body: bytes, content_type: str):
+    # (kind, parsed body), kind is None when the body is not kept
+    try:
+        if content_type.startswith("application/json"):
+            return "json", json.loads(body)
+        if content_type.startswith("application/x-www-form-urlencoded"):
+            return "form", dict(parse_qsl(body.decode("latin-1"), keep_blank_values=True))
+    except ValueError:
+        pass
+    return None, None
+
+
+def created_ids(body: bytes, headers: dict):
+    # Top level *_id values of a write's JSON response, so the replay can swap them for the ids it gets back
+    if not headers.get(b"content-type", b"").startswith(b"application/json"):
+        return {}
+    try:
+        if headers.get(b"content-encoding") == b"gzip":
+            body = gzip.decompress(body)
+        document = json.loads(body)
+    except (OSError, ValueError):
+        return {}
+    if not isinstance(document, dict):
+        return {}
+    return {key: value for key, value in document.items() if key.endswith("_id") and isinstance(value, str)}
+
+
+def build_trace(raw: dict):
+    # Runs on the writer thread, the request only hands over what it saw
+    headers = raw["headers"]
+    role_id = restaurant_id = username = None
+    scheme, _, token = headers.get(b"authorization", b"").decode("latin-1").partition(" ")
+    if scheme.lower() == "bearer" and token:
+        try:
+            claims = crud.decode_access_token(token)
+            role_id, restaurant_id = claims.get("role_id"), claims.get("restaurant_id")
+            username = claims.get("username")
+        except JWTError:
+            pass
+    kind, body = None, None
+    if raw["body"] is not None:
+        kind, body = parse_body(raw["body"], headers.get(b"content-type", b"").decode("latin-1"))
+    if restaurant_id is None and b"x-restaurant-id" in headers:
+        restaurant_id = int(headers[b"x-restaurant-id"]) if headers[b"x-restaurant-id"].isdigit() else None
+    if username is None and kind == "form":
+        # A login, tied to the user whose requests follow
+        username = body.get("username")
+        restaurant_id = DEFAULT_RESTAURANT_ID if restaurant_id is None else restaurant_id
+    return {
+        "ts": raw["ts"],
+        "method": raw["method"],
+        "path": raw["path"],
+        "route": route_template(raw["path"], raw["path_params"]),
+        "query": sanitize(dict(parse_qsl(raw["query"].decode("latin-1"), keep_blank_values=True))),
+        "role_id": role_id,
+        "restaurant_id": restaurant_id,
+        "user": user_key(restaurant_id, username),
+        "headers": {name.decode(): headers[name].decode("latin-1") for name in KEPT_HEADERS if name in headers},
+        "body_type": kind,
+        "body": body_shape(body),
+        "body_bytes": raw["body_bytes"],
+        "status": raw["status"],
+        "duration_ms": round(raw["duration"] * 1000, 3),
+        "response_bytes": raw["response_bytes"],
+        "ids": raw["ids"],
+    }
+
+
+class TrafficCapture:
+    # Requests hand raw traces to a queue, one writer thread per worker sanitizes and appends them
+    def __init__(self, enabled: bool = CAPTURE_ENABLED, directory: str = CAPTURE_DIR,
+                 max_bytes: int = CAPTURE_MAX_BYTES, keep: int = CAPTURE_KEEP, max_body: int = CAPTURE_MAX_BODY,
+                 max_queue: int = CAPTURE_MAX_QUEUE):
+        self.enabled = enabled
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.keep = keep
+        self.max_body = max_body
+        self.queue = queue.Queue(max_queue)
+        self.thread = None
+        self.file = None
+        self.stats = {"recorded": 0, "dropped": 0, "rotated": 0}
+
+    def record(self, raw: dict):
+        if self.thread is None:
+            self.thread = threading.Thread(target=self.run, name="traffic-capture", daemon=True)
+            self.thread.start()
+        try:
+            self.queue.put_nowait(raw)
+        except queue.Full:
+            self.stats["dropped"] += 1
+
+    def stop(self, timeout: float = 10.0):
+        # Writes out what is queued, the next trace starts the writer again
+        if self.thread is not None:
+            self.queue.put(None)
+            self.thread.join(timeout)
+            self.thread = None
+
+    # ------------------------ WRITER THREAD ------------------------
+
+    def path(self):
+        # One file per worker process, workers never write to the same file
+        return os.path.join(self.directory, f"capture-{os.getpid()}.jsonl")
+
+    def run(self):
+        while True:
+            raw = self.queue.get()
+            if raw is None:
+                break
+            try:
+                self.write(json.dumps(build_trace(raw), default=str, separators=(",", ":")) + "\n")
+                self.stats["recorded"] += 1
+            except Exception:
+                logger.exception("Could not record a %s %s trace", raw.get("method"), raw.get("path"))
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+    def write(self, line: str):
+        if self.file is None:
+            os.makedirs(self.directory, exist_ok=True)
+            self.file = open(self.path(), "a")
+        self.file.write(line)
+        self.file.flush()
+        if self.file.tell() >= self.max_bytes:
+            self.rotate()
+
+    def rotate(self):
+        self.file.close()
+        self.file = None
+        rotated = self.path()[:-len(".jsonl")] + f"-{datetime.utcnow():%Y%m%dT%H%M%S%f}.jsonl"
+        os.replace(self.path(), rotated)
+        self.stats["rotated"] += 1
+        self.prune()
+
+    def prune(self):
+        # Oldest rotated files go first, the files being written to are never removed
+        names = [name for name in os.listdir(self.directory) if name.startswith("capture-") and name.count("-") > 1]
+        paths = sorted((os.path.join(self.directory, name) for name in names), key=os.path.getmtime)
+        for path in paths[:max(len(paths) - self.keep, 0)]:
+            os.remove(path)
+
+
+class CaptureMiddleware:
+    # Plain ASGI and outside admission, shed requests are part of the traffic too
+    def __init__(self, app, capture: TrafficCapture):
+        self.app = app
+        self.capture = capture
+
+    async def __call__(self, scope, receive, send):
+        capture = self.capture
+        if scope["type"] != "http" or not capture.enabled or scope["path"].startswith(SKIP_PATHS):
+            await self.app(scope, receive, send)
+            return
+        started, clock = time.time(), time.perf_counter()
+        body = bytearray()
+        body_bytes = 0
+        response = {"status": None, "headers": {}, "bytes": 0, "body": bytearray()}
+        # Only writes create ids worth remembering
+        keep_response = scope["method"] != "GET"
+
+        async def receive_with_copy():
+            nonlocal body_bytes
+            message = await receive()
+            if message["type"] == "http.request":
+                chunk = message.get("body", b"")
+                body_bytes += len(chunk)
+                if body_bytes <= capture.max_body:
+                    body.extend(chunk)
+            return message
+
+        async def send_with_copy(message):
+            if message["type"] == "http.response.start":
+                response["status"] = message["status"]
+                response["headers"] = dict(message.get("headers", []))
+            elif message["type"] == "http.response.body":
+                chunk = message.get("body", b"")
+                response["bytes"] += len(chunk)
+                if keep_response and response["bytes"] <= capture.max_body:
+                    response["body"].extend(chunk)
+            await send(message)
+        try:
+            await self.app(scope, receive_with_copy, send_with_copy)
+        finally:
+            ids = {}
+            if keep_response and response["bytes"] <= capture.max_body and response["status"] in (200, 201, 202):
+                ids = created_ids(bytes(response["body"]), response["headers"])
+            capture.record({
+                "ts": started,
+                "method": scope["method"],
+                "path": scope["path"],
+                "path_params": dict(scope.get("path_params", {})),
+                "query": scope["query_string"],
+                "headers": dict(scope["headers"]),
+                "body": bytes(body) if body_bytes <= capture.max_body else None,
+                "body_bytes": body_bytes,
+                "status": response["status"],
+                "duration": time.perf_counter() - clock,
+                "response_bytes": response["bytes"],
+                "ids": ids,
+            })
+
+
+capture = TrafficCapture()
@@ -0,0 +1,120 @@
+# This file keeps live occupancy and kitchen load counters, updated by every state transition
+import threading
+from collections import Counter
+from datetime import datetime, timezone
+from sqlalchemy import func
+from sqlalchemy.orm import Session
+
+from . import models
+from .events import event_bus
+from .tenancy import TenantRegistry
+
+
+def epoch(value: datetime):
+    # Order times are stored as naive UTC
+    if value.tzinfo is None:
+        value = value.replace(tzinfo=timezone.utc)
+    return value.timestamp()
+
+
+class LiveCounters:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.tables = Counter()
+            self.dishes = Counter()
+            self.open_orders = 0
+            # Sum of open order start times, the average wait falls out of it in O(1)
+            self.open_order_time_sum = 0.0
+            self.reconciled_at = None
+
+    # ------------------------ TRANSITIONS ------------------------
+
+    def apply(self, transitions):
+        with self.lock:
+            for kind, old, new, value in transitions:
+                if kind == "table":
+                    self.move(self.tables, old, new, 1)
+                elif kind == "dish":
+                    self.move(self.dishes, old, new, value)
+                elif kind == "order_opened":
+                    self.open_orders += 1
+                    self.open_order_time_sum += value
+                elif kind == "order_closed":
+                    self.open_orders -= 1
+                    self.open_order_time_sum -= value
+
+    @staticmethod
+    def move(counter: Counter, old, new, count: int):
+        if old is not None:
+            counter[old] -= count
+        if new is not None:
+            counter[new] += count
+
+    # ------------------------ READ ------------------------
+
+    def snapshot(self, now: datetime = None):
+        now = epoch(now or datetime.utcnow())
+        with self.lock:
+            average_wait = 0.0
+            if self.open_orders:
+                average_wait = max(now - self.open_order_time_sum / self.open_orders, 0.0)
+            return {
+                "tables": {status: count for status, count in self.tables.items() if count},
+                "dishes": {status: count for status, count in self.dishes.items() if count},
+                "open_orders": self.open_orders,
+                "average_wait_seconds": round(average_wait, 1),
+                "reconciled_at": self.reconciled_at,
+            }
+
+    # ------------------------ RECONCILIATION ------------------------
+
+    def reconcile(self, db: Session):
+        # Recount from the database and replace the live values, returns how far they had drifted
+        tables = Counter(dict(db.query(models.Table.table_status, func.count())
+                              .group_by(models.Table.table_status).all()))
+        dishes = Counter(dict(db.query(models.Dish.dish_status, func.count())
+                              .group_by(models.Dish.dish_status).all()))
+        open_times = [epoch(created_at) for (created_at,) in db.query(models.Order.created_at)
+                      .filter(models.Order.is_served == False).all()]
+        with self.lock:
+            drift = {
+                "tables": dict((tables - self.tables) + (self.tables - tables)),
+                "dishes": dict((dishes - self.dishes) + (self.dishes - dishes)),
+                "open_orders": len(open_times) - self.open_orders,
+            }
+            self.tables = tables
+            self.dishes = dishes
+            self.open_orders = len(open_times)
+            self.open_order_time_sum = sum(open_times)
+            self.reconciled_at = datetime.utcnow()
+        return drift
+
+
+# One set of counters per restaurant
+live_counters = TenantRegistry(LiveCounters)
+
+# ------------------------ EVENT HANDLERS ------------------------
+
+
+def on_event(item):
+    # Turn committed write events into counter transitions
+    payload = item.payload
+    if item.name == "table_status_changed":
+        transitions = [("table", payload["old"], payload["new"], 1)]
+    elif item.name == "dish_status_changed":
+        transitions = [("dish", payload["old"], payload["new"], 1)]
+    elif item.name == "dishes_added":
+        transitions = [("dish", None, "received", len(payload["dishes"]))]
+    elif item.name == "order_created":
+        transitions = [("order_opened", None, None, epoch(payload["created_at"]))]
+    else:
+        transitions = [("order_closed", None, None, epoch(payload["created_at"]))]
+    live_counters.get(payload["restaurant_id"]).apply(transitions)
+
+
+event_bus.on_commit(["table_status_changed", "dish_status_changed", "dishes_added",
+                     "order_created", "order_served"], on_event)
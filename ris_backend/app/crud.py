@@ -1,5 +1,6 @@
 import os
-from sqlalchemy.orm import Session
+from sqlalchemy import func, select, insert, delete, update, bindparam
+from sqlalchemy.orm import Session, selectinload
 from dotenv import load_dotenv
 from passlib.context import CryptContext
 from typing import Optional
@@ -9,12 +10,85 @@ from fastapi import FastAPI, Depends, HTTPException, status
 from uuid import UUID
 
 from . import models, schemas
-from app.database import SessionLocal
+from app.database import SessionLocal, TENANT_KEY, DEFAULT_RESTAURANT_ID
+from app.events import emit
+from app.allocation import vacant_tables
 
 # Load variables from constants
 load_dotenv()
 SECRET_KEY = os.getenv("SECRET_KEY")
 ALGORITHM = os.getenv("ALGORITHM")
+ALLOCATION_ATTEMPTS = 5
+
+
+# Hot lookups, built once with bound parameters. A call only binds its values, it skips building a
+# Query and the statement cache finds the compiled SQL straight away
+USER_BY_USERNAME = select(models.StaffAccount).where(
+    models.StaffAccount.username == bindparam("username")).limit(1)
+TABLE_BY_ID = select(models.Table).where(models.Table.table_id == bindparam("table_id"))
+MENU_ITEM_BY_ID = select(models.MenuItem).where(models.MenuItem.menu_item_id == bindparam("menu_item_id"))
+DISH_BY_ID = select(models.Dish).where(models.Dish.dish_id == bindparam("dish_id"))
+# Menu items come along in one query, serving and order details read every dish's item
+DISHES_BY_ORDER = select(models.Dish).where(models.Dish.order_id == bindparam("order_id"))\
+    .options(selectinload(models.Dish.menu_item))
+ORDER_BY_ID = select(models.Order).where(models.Order.order_id == bindparam("order_id"))
+UNSERVED_ORDERS_BY_TABLE = select(models.Order).where(
+    models.Order.table_id == bindparam("table_id"), models.Order.is_served == False)\
+    .order_by(models.Order.created_at)
+MENU_ITEMS_BY_SECTION = select(models.MenuItem).where(
+    models.MenuItem.menu_section_id == bindparam("menu_section_id"))
+MENU_SECTIONS = select(models.MenuSection)
+# Sections come along, the station response lists their ids
+STATIONS = select(models.KitchenStation).options(selectinload(models.KitchenStation.sections))\
+    .order_by(models.KitchenStation.station_id)
+STATION_BY_ID = select(models.KitchenStation).where(models.KitchenStation.station_id == bindparam("station_id"))\
+    .options(selectinload(models.KitchenStation.sections))
+
+
+# Statements shared with app.crud_async, which runs the same reads on an AsyncSession
+
+
+def tables_query(fields: Optional[tuple] = None):
+    # Only select the requested columns when a fieldset is given. Ordered explicitly, the
+    # restaurant filter can be served by an index that returns rows in another order
+    if fields:
+        return select(*[getattr(models.Table, name) for name in fields]).order_by(models.Table.table_id)
+    return select(models.Table).order_by(models.Table.table_id)
+
+
+def menu_items_query(fields: Optional[tuple] = None):
+    if fields:
+        return select(*[getattr(models.MenuItem, name) for name in fields])
+    return select(models.MenuItem)
+
+
+def kitchen_tickets_query(fields: Optional[tuple] = None, station_id: Optional[int] = None):
+    # The kitchen view is one scan of the projection, no joins and no ORM objects. A station only
+    # reads the ranges of its own sections through ix_kitchen_tickets_restaurant_section
+    names = fields or KITCHEN_TICKET_FIELDS
+    columns = [getattr(models.KitchenTicket, name) for name in names]
+    query = select(*columns)
+    if station_id is not None:
+        query = query.where(models.KitchenTicket.menu_section_id.in_(
+            select(models.StationSection.menu_section_id).where(models.StationSection.station_id == station_id)))
+    return query.order_by(models.KitchenTicket.ordered_at)
+
+
+def bill_lines_query(order_id: UUID):
+    # One aggregate over the order's dishes, priced from the totals stored at order time
+    return select(
+        models.MenuItem.menu_item_id,
+        models.MenuItem.item_name,
+        models.MenuSection.menu_section_id,
+        models.MenuSection.section_name,
+        func.sum(models.Dish.quantity).label("quantity"),
+        func.sum(models.Dish.total).label("subtotal")
+    ).join(models.MenuItem, models.MenuItem.menu_item_id == models.Dish.menu_item_id)\
+     .join(models.MenuSection, models.MenuSection.menu_section_id == models.MenuItem.menu_section_id)\
+     .where(models.Dish.order_id == order_id)\
+     .group_by(models.MenuItem.menu_item_id, models.MenuItem.item_name,
+               models.MenuSection.menu_section_id, models.MenuSection.section_name)\
+     .order_by(models.MenuSection.menu_section_id, models.MenuItem.item_name)
 
 
 # Load password context & authentication scheme
@@ -35,7 +109,7 @@ def get_password_hash(password):
 
 def get_user(db: Session, username: str):
     # Get user matching with given username
-    return db.query(models.StaffAccount).filter(models.StaffAccount.username == username).first()
+    return db.execute(USER_BY_USERNAME, {"username": username}).scalars().first()
 
 
 def authenticate_user(db: Session, username: str, password: str):
@@ -51,6 +125,11 @@ def authenticate_user(db: Session, username: str, password: str):
     return user
 
 
+def decode_access_token(token: str):
+    # Verified claims of a token, raises JWTError when it is invalid or expired
+    return jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
+
+
 def create_access_token(data: dict, expires_delta: Optional[timedelta] = None):
     # Get data to encode
     to_encode = data.copy()
@@ -67,56 +146,362 @@ def create_access_token(data: dict, expires_delta: Optional[timedelta] = None):
 # Table-related functions
 
 
-def get_tables(db: Session):
-    return db.query(models.Table).all()
+def get_tables(db: Session, fields: Optional[tuple] = None):
+    result = db.execute(tables_query(fields))
+    return result.all() if fields else result.scalars().all()
 
 
 def get_table(db: Session, table_id: int):
     # Get table matching with given table_id
-    return db.query(models.Table).filter(models.Table.table_id == table_id).first()
+    return db.execute(TABLE_BY_ID, {"table_id": table_id}).scalars().first()
 
 
-def get_menu_items(db: Session):
-    return db.query(models.MenuItem).all()
+def get_menu_items(db: Session, fields: Optional[tuple] = None):
+    result = db.execute(menu_items_query(fields))
+    return result.all() if fields else result.scalars().all()
 
 
 def get_menu_item(db: Session, menu_item_id: UUID):
-    return db.query(models.MenuItem).filter(
-        models.MenuItem.menu_item_id == menu_item_id).first()
+    return db.execute(MENU_ITEM_BY_ID, {"menu_item_id": menu_item_id}).scalars().first()
 
 
 def get_dish(db: Session, dish_id: UUID):
-    return db.query(models.Dish).filter(models.Dish.dish_id == dish_id).first()
+    return db.execute(DISH_BY_ID, {"dish_id": dish_id}).scalars().first()
 
 
 def get_dish_by_order(db: Session, order_id: UUID):
-    return db.query(models.Dish).filter(
-        models.Dish.order_id == order_id
-    ).all()
+    return db.execute(DISHES_BY_ORDER, {"order_id": order_id}).scalars().all()
+
 
+def get_kitchen_tickets(db: Session, fields: Optional[tuple] = None, station_id: Optional[int] = None):
+    return db.execute(kitchen_tickets_query(fields, station_id)).all()
 
-def get_exist_unserved_orders(db: Session, table_id: int, is_served: bool):
-    return db.query(models.Order).filter(
-        models.Order.table_id == table_id,
-        models.Order.is_served == is_served
-    ).all()
+
+def get_current_order(db: Session, table_id: int):
+    # Two primary key lookups, whatever the size of the order history
+    table = get_table(db, table_id)
+    if table is None or table.current_order_id is None:
+        return None
+    return get_order(db, table.current_order_id)
 
 
-def get_sorted_order_by_table(db: Session, table_id: int):
-    return db.query(models.Order).filter(
-        models.Order.table_id == table_id
-    ).order_by(models.Order.created_at.desc()).first()
+def get_bill_lines(db: Session, order_id: UUID):
+    return db.execute(bill_lines_query(order_id)).all()
+
+
+def get_order(db: Session, order_id: UUID):
+    return db.execute(ORDER_BY_ID, {"order_id": order_id}).scalars().first()
 
 
 def get_menu_sections(db: Session):
-    return db.query(models.MenuSection).all()
+    return db.execute(MENU_SECTIONS).scalars().all()
 
 
 def get_menu_items_by_section(db: Session, menu_section_id: int):
-    return db.query(models.MenuItem).filter(
-        models.MenuItem.menu_section_id == menu_section_id).all()
+    return db.execute(MENU_ITEMS_BY_SECTION, {"menu_section_id": menu_section_id}).scalars().all()
 
 
 def get_section_name(db: Session, section_name: str):
     return db.query(models.MenuSection).filter(
         models.MenuSection.section_name == section_name).first()
+
+
+def get_stations(db: Session):
+    return db.execute(STATIONS).scalars().all()
+
+
+def get_station(db: Session, station_id: int):
+    return db.execute(STATION_BY_ID, {"station_id": station_id}).scalars().first()
+
+
+def set_station_sections(db: Session, station: models.KitchenStation, menu_section_ids: list):
+    # Replace the station's sections, every section must exist
+    menu_section_ids = sorted(set(menu_section_ids))
+    found = {section_id for (section_id,) in db.query(models.MenuSection.menu_section_id)
+             .filter(models.MenuSection.menu_section_id.in_(menu_section_ids)).all()}
+    missing = [section_id for section_id in menu_section_ids if section_id not in found]
+    if missing:
+        raise HTTPException(status_code=404, detail=f"Menu sections not found: {missing}")
+    station.sections = [models.StationSection(menu_section_id=section_id) for section_id in menu_section_ids]
+    db.flush()
+    return station
+
+
+def get_audit_events(db: Session, entity_type: Optional[str] = None, entity_id: Optional[str] = None,
+                     since: Optional[datetime] = None, until: Optional[datetime] = None, limit: int = 100):
+    # Newest first, served by ix_audit_events_entity when an entity is given, else by ix_audit_events_created_at
+    query = db.query(models.AuditEvent)
+    if entity_type is not None:
+        query = query.filter(models.AuditEvent.entity_type == entity_type)
+    if entity_id is not None:
+        query = query.filter(models.AuditEvent.entity_id == entity_id)
+    if since is not None:
+        query = query.filter(models.AuditEvent.created_at >= since)
+    if until is not None:
+        query = query.filter(models.AuditEvent.created_at < until)
+    return query.order_by(models.AuditEvent.created_at.desc(),
+                          models.AuditEvent.audit_event_id.desc()).limit(limit).all()
+
+
+def repair_current_orders(db: Session):
+    # Point every table at its newest unserved order, or at nothing. Returns the tables that were fixed
+    expected = {}
+    for table_id, order_id in db.query(models.Order.table_id, models.Order.order_id)\
+            .filter(models.Order.is_served == False)\
+            .order_by(models.Order.created_at).all():
+        expected[table_id] = order_id
+    repaired = []
+    for table_id, current_order_id in db.query(models.Table.table_id, models.Table.current_order_id).all():
+        if current_order_id == expected.get(table_id):
+            continue
+        # Compare and set, a request that moved the pointer since the read above wins
+        pointer = models.Table.current_order_id
+        changed = db.execute(update(models.Table)
+                             .where(models.Table.table_id == table_id,
+                                    pointer.is_(None) if current_order_id is None else pointer == current_order_id)
+                             .values(current_order_id=expected.get(table_id))).rowcount
+        if changed:
+            repaired.append(table_id)
+    db.flush()
+    return repaired
+
+# Kitchen ticket projection
+# Every write to dishes also writes the matching ticket, in the same transaction
+
+# Columns behind each field of schemas.DishDisplay
+KITCHEN_TICKET_FIELDS = ("dish_id", "order_id", "table_id", "item_name", "quantity", "note",
+                         "dish_status", "ordered_at")
+
+
+def add_kitchen_tickets(db: Session, order: models.Order, dishes: list, menu_items: dict):
+    db.execute(insert(models.KitchenTicket), [{
+        "dish_id": dish.dish_id,
+        "restaurant_id": order.restaurant_id,
+        "order_id": order.order_id,
+        "table_id": order.table_id,
+        "menu_item_id": dish.menu_item_id,
+        "menu_section_id": menu_items[dish.menu_item_id].menu_section_id,
+        "item_name": menu_items[dish.menu_item_id].item_name,
+        "quantity": dish.quantity,
+        "note": dish.note,
+        "dish_status": dish.dish_status,
+        "ordered_at": dish.received_at,
+    } for dish in dishes])
+
+
+def set_kitchen_ticket_status(db: Session, dish_id: UUID, dish_status: str):
+    db.execute(update(models.KitchenTicket)
+               .where(models.KitchenTicket.dish_id == dish_id)
+               .values(dish_status=dish_status))
+
+
+def rename_kitchen_tickets(db: Session, menu_item_id: UUID, item_name: str):
+    db.execute(update(models.KitchenTicket)
+               .where(models.KitchenTicket.menu_item_id == menu_item_id)
+               .values(item_name=item_name))
+
+
+def rebuild_kitchen_tickets(db: Session):
+    # Refill the projection from the source tables, for rows loaded behind the app's back
+    source = select(
+        models.Dish.dish_id, models.Dish.restaurant_id, models.Dish.order_id, models.Order.table_id,
+        models.Dish.menu_item_id, models.MenuItem.menu_section_id, models.MenuItem.item_name,
+        models.Dish.quantity, models.Dish.note, models.Dish.dish_status, func.coalesce(models.Dish.received_at, models.Order.created_at)
+    ).join(models.Order, models.Order.order_id == models.Dish.order_id)\
+     .join(models.MenuItem, models.MenuItem.menu_item_id == models.Dish.menu_item_id)
+    db.execute(delete(models.KitchenTicket))
+    db.execute(insert(models.KitchenTicket).from_select(
+        ["dish_id", "restaurant_id", "order_id", "table_id", "menu_item_id", "menu_section_id", "item_name",
+         "quantity", "note", "dish_status", "ordered_at"], source))
+    db.flush()
+
+
+def kitchen_tickets_in_sync(db: Session):
+    # Cheap check run at startup, a full rebuild only happens when the counts differ
+    tickets = db.query(func.count(models.KitchenTicket.dish_id)).scalar()
+    dishes = db.query(func.count(models.Dish.dish_id)).scalar()
+    return tickets == dishes
+
+# Waiter operations
+# These only flush, the caller owns the transaction and decides when to commit
+
+
+def set_table_status(db: Session, table: models.Table, new_status: str, staff_id: UUID):
+    # Every table transition goes through here so it is published once committed
+    if table.table_status != new_status:
+        emit(db, "table_status_changed", table_id=table.table_id, staff_id=staff_id,
+             capacity=table.capacity, old=table.table_status, new=new_status)
+        table.table_status = new_status
+
+
+def set_dish_status(db: Session, dish: models.Dish, new_status: str, staff_id: UUID):
+    if dish.dish_status != new_status:
+        now = datetime.utcnow()
+        # Serving can skip prepared, only the status actually reached gets a timestamp
+        setattr(dish, f"{new_status}_at", now)
+        emit(db, "dish_status_changed", dish_id=dish.dish_id, order_id=dish.order_id, staff_id=staff_id,
+             menu_item_id=dish.menu_item_id, menu_section_id=dish.menu_item.menu_section_id,
+             old=dish.dish_status, new=new_status, received_at=dish.received_at, at=now)
+        dish.dish_status = new_status
+        set_kitchen_ticket_status(db, dish.dish_id, new_status)
+
+
+def reserve_table(db: Session, table_id: int, staff_id: UUID):
+    # Move a vacant table to reserved
+    table = get_table(db, table_id)
+    if not table:
+        raise HTTPException(status_code=404, detail="Table not found")
+    if table.table_status != "vacant":
+        raise HTTPException(
+            status_code=400, detail="Only vacant table can be reserved")
+    set_table_status(db, table, "reserved", staff_id)
+    db.flush()
+    return table
+
+
+def allocate_table(db: Session, party_size: int, staff_id: UUID):
+    # Reserve the best-fit vacant table. The index can lag behind a concurrent allocation,
+    # so the UPDATE only succeeds while the row is still vacant, otherwise the next fit is tried
+    index = vacant_tables.get(db.info.get(TENANT_KEY, DEFAULT_RESTAURANT_ID))
+    tried = set()
+    for _ in range(ALLOCATION_ATTEMPTS):
+        candidate = index.best_fit(party_size, exclude=tried)
+        if candidate is None:
+            break
+        table_id, capacity = candidate
+        if reserve_if_vacant(db, table_id, capacity, staff_id):
+            return get_table(db, table_id)
+        # Taken through another worker, whose event never reached this index
+        index.remove(table_id, capacity)
+        tried.add(table_id)
+    # The index can also miss tables freed through another worker, the database has the last word
+    candidates = db.query(models.Table.table_id, models.Table.capacity)\
+        .filter(models.Table.table_status == "vacant", models.Table.capacity >= party_size)\
+        .order_by(models.Table.capacity, models.Table.table_id).limit(ALLOCATION_ATTEMPTS).all()
+    for table_id, capacity in candidates:
+        if reserve_if_vacant(db, table_id, capacity, staff_id):
+            return get_table(db, table_id)
+    raise HTTPException(status_code=409, detail=f"No vacant table for a party of {party_size}")
+
+
+def reserve_if_vacant(db: Session, table_id: int, capacity: int, staff_id: UUID):
+    # False when the table was no longer vacant
+    reserved = db.execute(update(models.Table)
+                          .where(models.Table.table_id == table_id, models.Table.table_status == "vacant")
+                          .values(table_status="reserved")).rowcount
+    if reserved:
+        emit(db, "table_status_changed", table_id=table_id, staff_id=staff_id,
+             capacity=capacity, old="vacant", new="reserved")
+    return bool(reserved)
+
+
+def add_dishes_to_order(db: Session, order: models.Order, dishes: list, staff_id: UUID):
+    # Price each dish from the menu at order time and attach it to the order
+    new_dishes = []
+    menu_items = {}
+    for dish_data in dishes:
+        menu_item = get_menu_item(db, dish_data.menu_item_id)
+        if not menu_item:
+            raise HTTPException(status_code=404, detail="Menu item not found")
+        menu_items[menu_item.menu_item_id] = menu_item
+        new_dish = models.Dish(
+            order_id=order.order_id,
+            staff_id=staff_id,
+            menu_item_id=dish_data.menu_item_id,
+            quantity=dish_data.quantity,
+            total=menu_item.price * dish_data.quantity,
+            dish_status='received',
+            received_at=datetime.utcnow()
+        )
+        db.add(new_dish)
+        new_dishes.append(new_dish)
+    db.flush()
+    add_kitchen_tickets(db, order, new_dishes, menu_items)
+    emit(db, "dishes_added", order_id=order.order_id, table_id=order.table_id, staff_id=staff_id,
+         dishes=[{"dish_id": dish.dish_id, "menu_item_id": dish.menu_item_id, "quantity": dish.quantity}
+                 for dish in new_dishes])
+    return new_dishes
+
+
+def create_order_with_dishes(db: Session, order_data: schemas.OrderWithDishesCreate, staff_id: UUID,
+                             order_id: Optional[UUID] = None, created_at: Optional[datetime] = None):
+    # order_id and created_at are given by the outbox, for orders that were taken before they reach the database
+    table = get_table(db, order_data.table_id)
+    if not table:
+        raise HTTPException(status_code=404, detail="Table not found")
+    # A table can only hold one unserved order at a time
+    if table.current_order_id is not None:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="Unable to create new order, please finish the previous order on the same table"
+        )
+
+    new_order = models.Order(
+        order_id=order_id,
+        table_id=order_data.table_id,
+        staff_id=staff_id,
+        created_at=created_at or datetime.utcnow()
+    )
+    db.add(new_order)
+    db.flush()
+    emit(db, "order_created", order_id=new_order.order_id, table_id=new_order.table_id,
+         staff_id=staff_id, created_at=new_order.created_at)
+    add_dishes_to_order(db, new_order, order_data.dishes, staff_id)
+
+    table.current_order_id = new_order.order_id
+    set_table_status(db, table, "eating", staff_id)
+    db.flush()
+    return new_order
+
+
+def add_dishes_to_table(db: Session, table_id: int, dishes: list, staff_id: UUID):
+    # Append dishes to the unserved order currently open on the table
+    order = get_current_order(db, table_id)
+    if not order:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail=f"No unserved orders found for table_id {table_id}"
+        )
+    add_dishes_to_order(db, order, dishes, staff_id)
+    return order
+
+
+def serve_table_orders(db: Session, table_id: int, staff_id: UUID):
+    # Mark every unserved order of the table as served and free the table. Normally that is the current
+    # order alone, older ones left unserved by data written before the pointer are served with it
+    table = get_table(db, table_id)
+    orders = db.execute(UNSERVED_ORDERS_BY_TABLE, {"table_id": table_id}).scalars().all() if table else []
+    if not orders:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail=f"No unserved orders found for table_id {table_id}"
+        )
+    for order in orders:
+        order.is_served = True
+        for dish in get_dish_by_order(db, order.order_id):
+            set_dish_status(db, dish, "ready", staff_id)
+        emit(db, "order_served", order_id=order.order_id, table_id=order.table_id,
+             staff_id=staff_id, created_at=order.created_at)
+
+    table.current_order_id = None
+    set_table_status(db, table, "vacant", staff_id)
+    db.flush()
+    return orders
+
+
+# Chef operations
+
+
+def advance_dish_status(db: Session, dish_id: UUID, staff_id: UUID):
+    # received -> prepared -> ready, ready dishes are final
+    dish = get_dish(db, dish_id)
+    if not dish:
+        raise HTTPException(status_code=404, detail="Dish not found")
+
+    next_status = {"received": "prepared", "prepared": "ready"}.get(dish.dish_status)
+    if next_status is None:
+        raise HTTPException(
+            status_code=400, detail="ready dishes cannot be changed!")
+    set_dish_status(db, dish, next_status, staff_id)
+    db.flush()
+    return dish
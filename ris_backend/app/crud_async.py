@@ -0,0 +1,58 @@
+# This file holds the reads of the polling endpoints on an AsyncSession. The statements are app.crud's,
+# only the round trips are awaited, so a tablet waiting on the database does not hold a threadpool thread
+from typing import Optional
+from uuid import UUID
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from . import crud
+
+
+async def get_user(db: AsyncSession, username: str):
+    return (await db.execute(crud.USER_BY_USERNAME, {"username": username})).scalars().first()
+
+
+async def get_tables(db: AsyncSession, fields: Optional[tuple] = None):
+    result = await db.execute(crud.tables_query(fields))
+    return result.all() if fields else result.scalars().all()
+
+
+async def get_table(db: AsyncSession, table_id: int):
+    return (await db.execute(crud.TABLE_BY_ID, {"table_id": table_id})).scalars().first()
+
+
+async def get_menu_items(db: AsyncSession, fields: Optional[tuple] = None):
+    result = await db.execute(crud.menu_items_query(fields))
+    return result.all() if fields else result.scalars().all()
+
+
+async def get_order(db: AsyncSession, order_id: UUID):
+    return (await db.execute(crud.ORDER_BY_ID, {"order_id": order_id})).scalars().first()
+
+
+async def get_dish_by_order(db: AsyncSession, order_id: UUID):
+    # The statement selectin-loads each dish's menu item, a lazy load would fail here
+    return (await db.execute(crud.DISHES_BY_ORDER, {"order_id": order_id})).scalars().all()
+
+
+async def get_bill_lines(db: AsyncSession, order_id: UUID):
+    return (await db.execute(crud.bill_lines_query(order_id))).all()
+
+
+async def get_kitchen_tickets(db: AsyncSession, fields: Optional[tuple] = None, station_id: Optional[int] = None):
+    return (await db.execute(crud.kitchen_tickets_query(fields, station_id))).all()
+
+
+async def get_stations(db: AsyncSession):
+    return (await db.execute(crud.STATIONS)).scalars().all()
+
+
+async def get_station(db: AsyncSession, station_id: int):
+    return (await db.execute(crud.STATION_BY_ID, {"station_id": station_id})).scalars().first()
+
+
+async def get_menu_sections(db: AsyncSession):
+    return (await db.execute(crud.MENU_SECTIONS)).scalars().all()
+
+
+async def get_menu_items_by_section(db: AsyncSession, menu_section_id: int):
+    return (await db.execute(crud.MENU_ITEMS_BY_SECTION, {"menu_section_id": menu_section_id})).scalars().all()
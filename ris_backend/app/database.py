@@ -1,15 +1,141 @@
-# This file sets up the database
+# This file sets up the database, one engine per shard and sessions routed by restaurant
 import os
-from sqlalchemy import create_engine
+import json
+import threading
+from sqlalchemy import create_engine, text
+from sqlalchemy.engine import make_url
+from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker
 from sqlalchemy.orm import sessionmaker, declarative_base
 from dotenv import load_dotenv
 
 # Load environment variables from .env file
 load_dotenv()
 DB_URL = os.getenv("DB_URL")
+DB_ECHO = os.getenv("DB_ECHO", "true").lower() == "true"
+# Per process, shard and engine, app.serve sizes these so every pool of every worker together stays under the server's limit
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", 5))
+DB_MAX_OVERFLOW = int(os.getenv("DB_MAX_OVERFLOW", 10))
+DB_POOL_TIMEOUT = int(os.getenv("DB_POOL_TIMEOUT", 30))
+# Below MySQL's wait_timeout, so the server never closes a pooled connection first
+DB_POOL_RECYCLE = int(os.getenv("DB_POOL_RECYCLE", 1800))
+# Extra shards as {"name": "url"}, and the shard of each restaurant as {"restaurant_id": "name"}.
+# DB_URL is the "default" shard, restaurants that are not listed live there
+SHARD_URLS = json.loads(os.getenv("SHARD_URLS") or "{}")
+TENANT_SHARDS = json.loads(os.getenv("TENANT_SHARDS") or "{}")
+DEFAULT_SHARD = "default"
+DEFAULT_RESTAURANT_ID = int(os.getenv("DEFAULT_RESTAURANT_ID", 1))
+# Session.info key holding the restaurant a session is scoped to, see app.tenancy
+TENANT_KEY = "restaurant_id"
+# Driver of each dialect's async engine, the one the polling reads of app.crud_async run on
+ASYNC_DRIVERS = {"mysql": "aiomysql", "sqlite": "aiosqlite"}
 
-# Setup database engine and session
-engine = create_engine(DB_URL, echo=True)
-SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+
+def engine_options(url: str):
+    if url.startswith("sqlite"):
+        return {}
+    return {
+        "pool_size": DB_POOL_SIZE,
+        "max_overflow": DB_MAX_OVERFLOW,
+        "pool_timeout": DB_POOL_TIMEOUT,
+        "pool_recycle": DB_POOL_RECYCLE,
+        "pool_pre_ping": True,
+    }
+
+
+def async_url(url: str):
+    # The same database through its async driver, mysql+pymysql://... becomes mysql+aiomysql://...
+    url = make_url(url)
+    return url.set(drivername=f"{url.get_backend_name()}+{ASYNC_DRIVERS[url.get_backend_name()]}")
+
+
+class ShardRouter:
+    # Every shard has the full schema and holds any number of restaurants, engines are made on first use
+    def __init__(self, default_url: str, shard_urls: dict = None, tenant_shards: dict = None):
+        self.urls = {DEFAULT_SHARD: default_url, **(shard_urls or {})}
+        self.tenant_shards = {int(restaurant_id): name for restaurant_id, name in (tenant_shards or {}).items()}
+        unknown = set(self.tenant_shards.values()) - set(self.urls)
+        if unknown:
+            raise ValueError(f"Restaurants mapped to unknown shards: {sorted(unknown)}")
+        self.engines = {}
+        self.factories = {}
+        self.async_engines = {}
+        self.async_factories = {}
+        self.lock = threading.Lock()
+
+    def shard_names(self):
+        return list(self.urls)
+
+    def shard_for(self, restaurant_id: int):
+        return self.tenant_shards.get(restaurant_id, DEFAULT_SHARD)
+
+    def engine(self, name: str):
+        if name not in self.engines:
+            with self.lock:
+                if name not in self.engines:
+                    url = self.urls[name]
+                    engine = create_engine(url, echo=DB_ECHO, **engine_options(url))
+                    self.factories[name] = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+                    self.engines[name] = engine
+        return self.engines[name]
+
+    def session_factory(self, name: str):
+        self.engine(name)
+        return self.factories[name]
+
+    def session(self, restaurant_id: int):
+        # A session that only sees and writes the rows of one restaurant
+        db = self.session_factory(self.shard_for(restaurant_id))()
+        db.info[TENANT_KEY] = restaurant_id
+        return db
+
+    def async_session_factory(self, name: str):
+        # A second pool per shard, for the reads that await the database instead of holding a thread
+        if name not in self.async_factories:
+            with self.lock:
+                if name not in self.async_factories:
+                    url = self.urls[name]
+                    engine = create_async_engine(async_url(url), echo=DB_ECHO, **engine_options(url))
+                    # Nothing lazy loads on an AsyncSession, so what a read loaded has to outlive a commit
+                    self.async_factories[name] = async_sessionmaker(bind=engine, autoflush=False,
+                                                                    expire_on_commit=False)
+                    self.async_engines[name] = engine
+        return self.async_factories[name]
+
+    def async_session(self, restaurant_id: int):
+        # The AsyncSession twin of session(), app.tenancy scopes it the same way
+        db = self.async_session_factory(self.shard_for(restaurant_id))()
+        db.info[TENANT_KEY] = restaurant_id
+        return db
+
+    def shard_session(self, name: str):
+        # Unscoped, for maintenance that works on a whole shard at once
+        return self.session_factory(name)()
+
+    def restaurant_ids(self, name: str):
+        # Restaurants with staff on the shard that are routed to it
+        with self.engine(name).connect() as connection:
+            found = connection.execute(text("SELECT DISTINCT restaurant_id FROM staff_accounts")).scalars().all()
+        return sorted(restaurant_id for restaurant_id in found if self.shard_for(restaurant_id) == name)
+
+    def dispose(self):
+        with self.lock:
+            for engine in self.engines.values():
+                engine.dispose()
+            self.engines = {}
+            self.factories = {}
+
+    async def dispose_async(self):
+        with self.lock:
+            engines = list(self.async_engines.values())
+            self.async_engines = {}
+            self.async_factories = {}
+        for engine in engines:
+            await engine.dispose()
+
+
+router = ShardRouter(DB_URL, SHARD_URLS, TENANT_SHARDS)
+# The default shard, for code that predates routing and for single site deployments
+engine = router.engine(DEFAULT_SHARD)
+SessionLocal = router.session_factory(DEFAULT_SHARD)
 
 Base = declarative_base()
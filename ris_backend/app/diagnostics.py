@@ -0,0 +1,193 @@
+# This file tracks memory of one worker: tracemalloc snapshots diffed over time and live object counts
+import os
+import gc
+import sys
+import resource
+import uuid
+import threading
+import tracemalloc
+from collections import Counter
+from datetime import datetime
+from pydantic import BaseModel
+from sqlalchemy.orm import Session
+from dotenv import load_dotenv
+
+from . import models
+
+# Load variables from constants
+load_dotenv()
+# Frames kept per allocation, more frames point further up the call stack but cost more memory
+MEMORY_TRACE_FRAMES = int(os.getenv("MEMORY_TRACE_FRAMES", 10))
+# Snapshots kept per worker, the oldest goes first
+MEMORY_SNAPSHOT_KEEP = int(os.getenv("MEMORY_SNAPSHOT_KEEP", 5))
+# Tracing stops by itself after this long, in case it was started on a worker nobody reaches again
+MEMORY_TRACE_MAX_SECONDS = float(os.getenv("MEMORY_TRACE_MAX_SECONDS", 1800))
+# Allocations made by tracemalloc itself and the import machinery are noise
+IGNORED_FILES = (tracemalloc.__file__, "<frozen importlib._bootstrap>", "<frozen importlib._bootstrap_external>",
+                 "<unknown>")
+# Longest first, so a package inside a virtualenv is not named after the virtualenv
+SEARCH_PATHS = sorted({os.path.abspath(path or os.curdir) for path in sys.path}, key=len, reverse=True)
+
+
+def module_name(filename: str):
+    # app/crud.py -> app.crud, site-packages/sqlalchemy/orm/session.py -> sqlalchemy.orm.session
+    path = os.path.abspath(filename)
+    for root in SEARCH_PATHS:
+        if path.startswith(root + os.sep):
+            break
+    else:
+        # <frozen ...>, <string> and files outside sys.path keep their name
+        return filename
+    name = os.path.splitext(os.path.relpath(path, root))[0].replace(os.sep, ".")
+    return name[:-len(".__init__")] if name.endswith(".__init__") else name
+
+
+def rss_bytes():
+    # Resident set size now on Linux, elsewhere the peak is all there is
+    try:
+        with open("/proc/self/statm") as statm:
+            return int(statm.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except OSError:
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return peak if sys.platform == "darwin" else peak * 1024
+
+
+class MemoryDiagnostics:
+    # Tracing is off until a manager starts it, it slows allocations down noticeably while on
+    def __init__(self, frames: int = MEMORY_TRACE_FRAMES, keep: int = MEMORY_SNAPSHOT_KEEP,
+                 max_seconds: float = MEMORY_TRACE_MAX_SECONDS):
+        self.frames = frames
+        self.keep = keep
+        self.max_seconds = max_seconds
+        self.snapshots = {}
+        self.timer = None
+        self.lock = threading.Lock()
+
+    def status(self):
+        with self.lock:
+            tracing = tracemalloc.is_tracing()
+            traced, peak = tracemalloc.get_traced_memory() if tracing else (0, 0)
+            snapshots = [self.describe(snapshot_id) for snapshot_id in self.snapshots]
+        return {
+            "pid": os.getpid(),
+            "tracing": tracing,
+            "frames": tracemalloc.get_traceback_limit() if tracing else self.frames,
+            "rss_bytes": rss_bytes(),
+            "traced_bytes": traced,
+            "peak_traced_bytes": peak,
+            "snapshots": snapshots,
+        }
+
+    def start(self, frames: int = None):
+        with self.lock:
+            if not tracemalloc.is_tracing():
+                tracemalloc.start(frames or self.frames)
+                self.timer = threading.Timer(self.max_seconds, self.stop)
+                self.timer.daemon = True
+                self.timer.start()
+        return self.status()
+
+    def stop(self):
+        # Snapshots are useless without tracing, and they hold a lot of memory themselves
+        with self.lock:
+            tracemalloc.stop()
+            self.snapshots.clear()
+            if self.timer is not None and self.timer is not threading.current_thread():
+                self.timer.cancel()
+            self.timer = None
+        return self.status()
+
+    # ------------------------ SNAPSHOTS ------------------------
+
+    def take(self):
+        # Returns the new snapshot, None when tracing is off. Under the lock, so stop() cannot end tracing midway
+        with self.lock:
+            if not tracemalloc.is_tracing():
+                return None
+            snapshot = tracemalloc.take_snapshot().filter_traces(
+                [tracemalloc.Filter(False, filename) for filename in IGNORED_FILES])
+            snapshot_id = uuid.uuid4().hex[:12]
+            self.snapshots[snapshot_id] = (datetime.utcnow(), rss_bytes(), snapshot)
+            while len(self.snapshots) > self.keep:
+                del self.snapshots[next(iter(self.snapshots))]
+            return self.describe(snapshot_id)
+
+    def describe(self, snapshot_id: str):
+        # Caller holds the lock
+        taken_at, rss, snapshot = self.snapshots[snapshot_id]
+        return {"snapshot_id": snapshot_id, "taken_at": taken_at, "rss_bytes": rss,
+                "traced_bytes": sum(trace.size for trace in snapshot.traces)}
+
+    def diff(self, since_id: str, until_id: str, group_by: str = "module", limit: int = 20):
+        # Allocation sites that grew most from one snapshot to the other, None when a snapshot is unknown
+        with self.lock:
+            if since_id not in self.snapshots or until_id not in self.snapshots:
+                return None
+            (since_at, since_rss, since), (until_at, until_rss, until) = \
+                self.snapshots[since_id], self.snapshots[until_id]
+            described = self.describe(since_id), self.describe(until_id)
+        if group_by == "module":
+            sites = self.by_module(until.compare_to(since, "filename"))
+        else:
+            sites = [{"site": self.site(stat.traceback, group_by), "size_bytes": stat.size,
+                      "size_diff_bytes": stat.size_diff, "count": stat.count, "count_diff": stat.count_diff}
+                     for stat in until.compare_to(since, group_by)]
+        sites.sort(key=lambda site: (-site["size_diff_bytes"], site["site"]))
+        return {
+            "since": described[0],
+            "until": described[1],
+            "seconds": (until_at - since_at).total_seconds(),
+            "rss_diff_bytes": until_rss - since_rss,
+            "group_by": group_by,
+            "sites": sites[:limit],
+        }
+
+    @staticmethod
+    def by_module(stats):
+        # Files of the same module are already one group, packages keep one entry per module
+        sites = {}
+        for stat in stats:
+            name = module_name(stat.traceback[0].filename)
+            site = sites.setdefault(name, {"site": name, "size_bytes": 0, "size_diff_bytes": 0,
+                                           "count": 0, "count_diff": 0})
+            site["size_bytes"] += stat.size
+            site["size_diff_bytes"] += stat.size_diff
+            site["count"] += stat.count
+            site["count_diff"] += stat.count_diff
+        return list(sites.values())
+
+    @staticmethod
+    def site(traceback, group_by: str):
+        # The allocating line, for traceback followed by its callers
+        frames = reversed(traceback) if group_by == "traceback" else traceback[-1:]
+        return " <- ".join(f"{module_name(frame.filename)}:{frame.lineno}" for frame in frames)
+
+    # ------------------------ LIVE OBJECTS ------------------------
+
+    @staticmethod
+    def live_objects(limit: int = 20):
+        # One pass over every object the garbage collector tracks, ORM rows and sessions held past their
+        # request and pydantic models built per row are the usual suspects
+        gc.collect()
+        orm, schemas = Counter(), Counter()
+        sessions = 0
+        for obj in gc.get_objects():
+            # By type, isinstance() runs __getattr__ hooks of arbitrary objects
+            kind = type(obj)
+            if issubclass(kind, models.Base):
+                orm[kind.__name__] += 1
+            elif issubclass(kind, BaseModel):
+                schemas[kind.__name__] += 1
+            elif issubclass(kind, Session):
+                sessions += 1
+        return {
+            "pid": os.getpid(),
+            "rss_bytes": rss_bytes(),
+            "sessions": sessions,
+            "orm_instances": dict(orm.most_common()),
+            "pydantic_instances": dict(schemas.most_common(limit)),
+            "gc_counts": list(gc.get_count()),
+        }
+
+
+memory_diagnostics = MemoryDiagnostics()
@@ -0,0 +1,205 @@
+# This file runs side effects of writes after their transaction commits, inline or on a background worker pool
+import os
+import time
+import queue
+import logging
+import threading
+from collections import namedtuple
+from datetime import datetime
+from sqlalchemy import event
+from sqlalchemy.orm import Session
+from dotenv import load_dotenv
+
+from .database import TENANT_KEY, DEFAULT_RESTAURANT_ID
+
+# Load variables from constants
+load_dotenv()
+EVENT_QUEUE_SIZE = int(os.getenv("EVENT_QUEUE_SIZE", 10000))
+EVENT_WORKERS = int(os.getenv("EVENT_WORKERS", 2))
+EVENT_BATCH_SIZE = int(os.getenv("EVENT_BATCH_SIZE", 100))
+EVENT_BATCH_INTERVAL = float(os.getenv("EVENT_BATCH_INTERVAL", 0.05))
+EVENT_MAX_RETRIES = int(os.getenv("EVENT_MAX_RETRIES", 3))
+EVENT_PUBLISH_TIMEOUT = 0.05
+SESSION_KEY = "pending_events"
+logger = logging.getLogger(__name__)
+
+Event = namedtuple("Event", ["name", "payload", "created_at"])
+STOP = object()
+
+
+class EventBus:
+    # Bounded queue drained by worker threads, each subscriber gets batches of the events it asked for
+    def __init__(self, queue_size: int = EVENT_QUEUE_SIZE, workers: int = EVENT_WORKERS,
+                 batch_size: int = EVENT_BATCH_SIZE, batch_interval: float = EVENT_BATCH_INTERVAL,
+                 max_retries: int = EVENT_MAX_RETRIES, retry_backoff: float = 0.1):
+        self.queue = queue.Queue(maxsize=queue_size)
+        self.worker_count = workers
+        self.batch_size = batch_size
+        self.batch_interval = batch_interval
+        self.max_retries = max_retries
+        self.retry_backoff = retry_backoff
+        self.inline_subscribers = []
+        self.subscribers = []
+        self.workers = []
+        self.stats = {"published": 0, "processed": 0, "dropped": 0, "retried": 0, "failed": 0}
+        self.lock = threading.Lock()
+
+    # ------------------------ SUBSCRIPTIONS ------------------------
+
+    def on_commit(self, names, handler):
+        # Run handler(event) right after commit, in the request thread, for cheap in-memory updates
+        self.inline_subscribers.append((frozenset(names), handler))
+
+    def subscribe(self, names, handler):
+        # Run handler(events) on a worker thread with batches of matching events
+        self.subscribers.append((frozenset(names), handler))
+
+    # ------------------------ PUBLISHING ------------------------
+
+    def publish(self, events):
+        for item in events:
+            for names, handler in self.inline_subscribers:
+                if item.name in names:
+                    try:
+                        handler(item)
+                    except Exception:
+                        logger.exception("Inline handler for %s failed", item.name)
+            if not any(item.name in names for names, _ in self.subscribers):
+                continue
+            try:
+                # Wait a little for room, a full queue must not stall the request for long
+                self.queue.put(item, timeout=EVENT_PUBLISH_TIMEOUT)
+                self.count("published")
+            except queue.Full:
+                self.count("dropped")
+                logger.error("Event queue full, dropped %s", item.name)
+
+    def count(self, name: str, amount: int = 1):
+        with self.lock:
+            self.stats[name] += amount
+
+    # ------------------------ WORKERS ------------------------
+
+    def start(self):
+        if self.workers:
+            return
+        for number in range(self.worker_count):
+            worker = threading.Thread(target=self.run, name=f"event-worker-{number}", daemon=True)
+            worker.start()
+            self.workers.append(worker)
+
+    def stop(self, timeout: float = 10.0):
+        # Drain what is queued, then let every worker exit
+        drained = self.drain(timeout)
+        for _ in self.workers:
+            self.queue.put(STOP)
+        for worker in self.workers:
+            worker.join(timeout)
+        self.workers = []
+        return drained
+
+    def drain(self, timeout: float = None):
+        # Wait until every queued event is handled, without workers they are handled here
+        if not self.workers:
+            while True:
+                batch = self.next_batch(block=False)
+                if not batch:
+                    return True
+                self.dispatch(batch)
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self.queue.all_tasks_done:
+            while self.queue.unfinished_tasks:
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    return False
+                self.queue.all_tasks_done.wait(remaining)
+        return True
+
+    def clear(self):
+        while True:
+            try:
+                self.queue.get_nowait()
+                self.queue.task_done()
+            except queue.Empty:
+                return
+
+    def run(self):
+        while True:
+            batch = self.next_batch(block=True)
+            stopping = STOP in batch
+            batch = [item for item in batch if item is not STOP]
+            if batch:
+                self.dispatch(batch)
+            if stopping:
+                self.queue.task_done()
+                return
+
+    def next_batch(self, block: bool):
+        # Up to batch_size events, waiting at most batch_interval after the first one
+        try:
+            first = self.queue.get(block=block)
+        except queue.Empty:
+            return []
+        batch = [first]
+        deadline = time.monotonic() + self.batch_interval
+        while first is not STOP and len(batch) < self.batch_size:
+            remaining = deadline - time.monotonic() if block else 0
+            try:
+                item = self.queue.get(timeout=remaining) if remaining > 0 else self.queue.get_nowait()
+            except queue.Empty:
+                break
+            batch.append(item)
+            if item is STOP:
+                break
+        return batch
+
+    def dispatch(self, batch):
+        try:
+            for names, handler in self.subscribers:
+                events = [item for item in batch if item.name in names]
+                if events:
+                    self.call_with_retries(handler, events)
+            self.count("processed", len(batch))
+        finally:
+            for _ in batch:
+                self.queue.task_done()
+
+    def call_with_retries(self, handler, events):
+        for attempt in range(self.max_retries + 1):
+            try:
+                handler(events)
+                return
+            except Exception:
+                if attempt == self.max_retries:
+                    self.count("failed", len(events))
+                    logger.exception("Handler %s gave up on %d events", getattr(handler, "__name__", handler), len(events))
+                    return
+                self.count("retried")
+                time.sleep(self.retry_backoff * 2 ** attempt)
+
+
+event_bus = EventBus()
+
+# ------------------------ SESSION HOOKS ------------------------
+
+
+def emit(db: Session, name: str, **payload):
+    # Queue an event on the session, it is only published if the transaction commits
+    if not db.in_transaction():
+        # Tie the event to a transaction so that a rollback always discards it
+        db.begin()
+    # Handlers keep per restaurant state, so every event says which restaurant it happened in
+    payload.setdefault("restaurant_id", db.info.get(TENANT_KEY, DEFAULT_RESTAURANT_ID))
+    db.info.setdefault(SESSION_KEY, []).append(Event(name, payload, datetime.utcnow()))
+
+
+@event.listens_for(Session, "after_commit")
+def publish_pending_events(session):
+    events = session.info.pop(SESSION_KEY, None)
+    if events:
+        event_bus.publish(events)
+
+
+@event.listens_for(Session, "after_rollback")
+def discard_pending_events(session):
+    session.info.pop(SESSION_KEY, None)
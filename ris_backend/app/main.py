@@ -1,32 +1,160 @@
 # This file handles all API endpoints
 import os
+import uuid
+import asyncio
+import logging
+from contextlib import asynccontextmanager
 from dotenv import load_dotenv
-from fastapi import FastAPI, Depends, HTTPException, status, Request
+from fastapi import FastAPI, Depends, HTTPException, status, Request, Query, Header
 from fastapi.security import OAuth2PasswordBearer, OAuth2PasswordRequestForm
-from fastapi.responses import JSONResponse
+from fastapi.responses import JSONResponse, Response
 from fastapi.middleware.cors import CORSMiddleware
-from sqlalchemy import TypeDecorator, BINARY
+from fastapi.middleware.gzip import GZipMiddleware
+from fastapi.concurrency import run_in_threadpool
+from anyio import to_thread
+from sqlalchemy import TypeDecorator, BINARY, text
 from sqlalchemy.orm import Session
+from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy.exc import NoResultFound
 from uuid import UUID
-from datetime import datetime, timedelta
-from typing import List, Annotated
-from jose import JWTError, jwt
-from . import crud, models, schemas
-from .database import SessionLocal, engine
+from datetime import datetime, timedelta, date
+from typing import List, Dict, Annotated, Optional
+from jose import JWTError
+from . import crud, crud_async, models, schemas
+from .database import router, DEFAULT_RESTAURANT_ID
+from .cache import CachedBody, response_cache, order_tag, tenant_tag, MIN_COMPRESS_SIZE
+from .counters import live_counters
+from .events import emit, event_bus
+from .audit import audit_log
+from .sketch import prep_times
+from .search import menu_search
+from .allocation import vacant_tables
+from .admission import AdmissionMiddleware, admission, ADMISSION_CONCURRENCY
+from .profiling import ProfilerMiddleware, profiler
+from .capture import CaptureMiddleware, capture
+from .diagnostics import memory_diagnostics
+from .transactions import transactions
+from .outbox import outbox
 
 # Load variables from constants
 load_dotenv()
 SECRET_KEY = os.getenv("SECRET_KEY")
 ALGORITHM = os.getenv("ALGORITHM")
 ACCESS_TOKEN_EXPIRED_MINUTES = int(os.getenv("ACCESS_TOKEN_EXPIRED_MINUTES"))
-
-# Initialize models
-models.Base.metadata.create_all(bind=engine)
+RECONCILE_INTERVAL_SECONDS = int(os.getenv("RECONCILE_INTERVAL_SECONDS", 300))
+# Threads that run the sync endpoints, the writes and login. The polling reads await an async engine and take none
+THREADPOOL_SIZE = int(os.getenv("THREADPOOL_SIZE", ADMISSION_CONCURRENCY))
+logger = logging.getLogger(__name__)
+
+# Initialize models on every shard
+for shard_name in router.shard_names():
+    models.Base.metadata.create_all(bind=router.engine(shard_name))
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl="login")
 
+# ------------------------ BACKGROUND TASKS ------------------------
+
+
+def served_restaurants():
+    # Every restaurant on every shard, looked up each time so a new site is picked up without a restart
+    return [restaurant_id for name in router.shard_names() for restaurant_id in router.restaurant_ids(name)]
+
+
+def reconcile_counters():
+    # Recount the live dashboard counters of every restaurant from the database
+    for restaurant_id in served_restaurants():
+        counters = live_counters.get(restaurant_id)
+        index = vacant_tables.get(restaurant_id)
+        # The index starts empty, so the first load is not drift
+        vacant_loaded = index.reconciled_at is not None
+        db = router.session(restaurant_id)
+        try:
+            drift = counters.reconcile(db)
+            vacant_drift = index.reconcile(db)
+        finally:
+            db.close()
+        if drift["tables"] or drift["dishes"] or drift["open_orders"]:
+            logger.warning("Live counters of restaurant %s drifted from the database: %s", restaurant_id, drift)
+        if vacant_loaded and (vacant_drift["missing"] or vacant_drift["stale"]):
+            logger.warning("Vacant table index of restaurant %s drifted from the database: %s",
+                           restaurant_id, vacant_drift)
+    for _, sketches in prep_times.items():
+        sketches.expire()
+
+
+def sync_kitchen_tickets():
+    # Dishes loaded outside the app have no tickets yet, checked a whole shard at a time
+    for name in router.shard_names():
+        db = router.shard_session(name)
+        try:
+            if not crud.kitchen_tickets_in_sync(db):
+                logger.warning("Kitchen tickets out of sync with dishes on shard %s, rebuilding", name)
+                crud.rebuild_kitchen_tickets(db)
+                db.commit()
+        finally:
+            db.close()
+
+
+def repair_current_orders():
+    # Tables whose current_order_id disagrees with their unserved orders
+    for name in router.shard_names():
+        db = router.shard_session(name)
+        try:
+            repaired = crud.repair_current_orders(db)
+            db.commit()
+        finally:
+            db.close()
+        if repaired:
+            logger.warning("Repaired current order pointers of tables %s on shard %s", repaired, name)
+
+
+def rebuild_in_memory_indexes():
+    # Prep-time sketches and the menu search index live in memory, refill them from the database
+    for restaurant_id in served_restaurants():
+        db = router.session(restaurant_id)
+        try:
+            prep_times.get(restaurant_id).rebuild(db)
+            menu_search.get(restaurant_id).rebuild(db)
+        finally:
+            db.close()
+
+
+async def reconcile_counters_periodically():
+    while True:
+        await asyncio.sleep(RECONCILE_INTERVAL_SECONDS)
+        try:
+            await run_in_threadpool(repair_current_orders)
+            await run_in_threadpool(reconcile_counters)
+        except Exception:
+            logger.exception("Periodic reconciliation failed")
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    to_thread.current_default_thread_limiter().total_tokens = THREADPOOL_SIZE
+    await run_in_threadpool(sync_kitchen_tickets)
+    await run_in_threadpool(repair_current_orders)
+    await run_in_threadpool(reconcile_counters)
+    await run_in_threadpool(rebuild_in_memory_indexes)
+    reconciler = asyncio.create_task(reconcile_counters_periodically())
+    event_bus.start()
+    audit_log.start()
+    outbox.start()
+    app.state.ready = True
+    yield
+    # Fail readiness first so the load balancer stops sending new requests
+    app.state.ready = False
+    reconciler.cancel()
+    # Let queued post-commit work finish before the worker exits
+    await run_in_threadpool(outbox.stop)
+    await run_in_threadpool(event_bus.stop)
+    await run_in_threadpool(audit_log.stop)
+    await run_in_threadpool(capture.stop)
+    await router.dispose_async()
+
+
 # Apply FastAPI framework
-app = FastAPI()
+app = FastAPI(lifespan=lifespan)
+app.state.ready = False
 
 # Allow CORS for all domains for demonstration purposes
 app.add_middleware(
@@ -36,37 +164,76 @@ app.add_middleware(
     allow_methods=["*"],
     allow_headers=["*"],
 )
+# Compress uncached responses on the fly, cached ones carry their own encoding
+app.add_middleware(GZipMiddleware, minimum_size=MIN_COMPRESS_SIZE)
+# Ahead of the other middleware, so a request that is turned away costs nothing else
+app.add_middleware(AdmissionMiddleware, controller=admission)
+# Sees requests before admission, so shed ones and queueing time are recorded too
+app.add_middleware(CaptureMiddleware, capture=capture)
+# Outermost, a profiled request is measured from the moment it arrives
+app.add_middleware(ProfilerMiddleware, profiler=profiler)
+
+
+def tenant_from_request(request: Request):
+    # The restaurant_id claim of the bearer token, at login the X-Restaurant-Id header.
+    # An invalid token falls back to the default restaurant and is refused by get_current_user anyway
+    restaurant_id = getattr(request.state, "restaurant_id", None)
+    if restaurant_id is not None:
+        return restaurant_id
+    restaurant_id = DEFAULT_RESTAURANT_ID
+    scheme, _, token = request.headers.get("authorization", "").partition(" ")
+    if scheme.lower() == "bearer" and token:
+        try:
+            restaurant_id = int(crud.decode_access_token(token).get("restaurant_id", DEFAULT_RESTAURANT_ID))
+        except (JWTError, TypeError, ValueError):
+            pass
+    elif request.headers.get("x-restaurant-id", "").isdigit():
+        restaurant_id = int(request.headers["x-restaurant-id"])
+    request.state.restaurant_id = restaurant_id
+    return restaurant_id
+
+
+def get_db(request: Request):
+    # Database dependency, a session on the shard of the caller's restaurant that only sees its rows
+    db = router.session(tenant_from_request(request))
+    try:
+        yield db
+    finally:
+        db.close()
 
 
-def get_db():
-    # Database dependency
-    db = SessionLocal()
+async def get_async_db(request: Request):
+    # The same, as an AsyncSession for the endpoints that only read
+    db = router.async_session(tenant_from_request(request))
     try:
         yield db
     finally:
-        db.close()
+        await db.close()
 
 
 # -------------------- AUTHENTICATION & AUTHORIZATION UTILS ---------------------
 
 
-async def get_current_user(token: Annotated[str, Depends(oauth2_scheme)], db: Session = Depends(get_db)):
+async def get_current_user(token: Annotated[str, Depends(oauth2_scheme)], db: AsyncSession = Depends(get_async_db)):
+    # The user lookup is awaited, so authenticating a request never takes a threadpool thread
     credentials_exception = HTTPException(
         status_code=status.HTTP_401_UNAUTHORIZED,
         detail="Invalid credentials",
         headers={"WWW-Authenticate": "Bearer"}
     )
     try:
-        payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
+        payload = crud.decode_access_token(token)
         username: str = payload.get("username")
         if username is None:
             raise credentials_exception
         token_data = schemas.TokenData(username=username)
     except JWTError:
         raise credentials_exception
-    user = crud.get_user(db, username=token_data.username)
+    user = await crud_async.get_user(db, username=token_data.username)
     if user is None:
         raise credentials_exception
+    # Hand the connection back, a write goes on with a sync session and would otherwise hold one from each pool
+    await db.close()
     return user
 
 
@@ -80,7 +247,8 @@ class RoleChecker:
     def __init__(self, allowed_roles: list):
         self.allowed_roles = allowed_roles
 
-    def __call__(self, user: Annotated[schemas.User, Depends(get_current_active_user)]):
+    # No I/O, so it runs on the event loop without taking a thread
+    async def __call__(self, user: Annotated[schemas.User, Depends(get_current_active_user)]):
         if user.role_id in self.allowed_roles:
             return user
         raise HTTPException(
@@ -89,6 +257,42 @@ class RoleChecker:
         )
 
 
+# ------------------------ SPARSE FIELDSET UTILS ------------------------
+
+FIELDS_DESCRIPTION = "Comma-separated fields to return, the row id is always included"
+
+
+def sparse_fields(model, fields: Optional[str], key: str):
+    # Validate the fields= query parameter against the response model
+    try:
+        return schemas.parse_fields(model, fields, key)
+    except ValueError as exc:
+        raise HTTPException(status_code=400, detail=str(exc))
+
+
+def sparse_model(model, fields: Optional[tuple]):
+    return schemas.partial_model(model, fields) if fields else model
+
+
+# ------------------------ RESPONSE CACHE UTILS ------------------------
+
+
+async def cached_json(request: Request, key, tags: tuple, build, keep=None):
+    # Serve a read endpoint from the response cache, await build() returns the JSON bytes on a miss.
+    # await keep(), when given, says after the build whether the body is final enough to cache
+    restaurant_id = tenant_from_request(request)
+    key = (restaurant_id, *key)
+    tags = tuple(tenant_tag(restaurant_id, tag) for tag in tags)
+    entry = response_cache.get(key)
+    if entry is None:
+        generation = response_cache.generation(tags)
+        body = await build()
+        if keep is not None and not await keep():
+            return CachedBody(body).response(request.headers.get("accept-encoding"))
+        entry = response_cache.put(key, body, tags, generation)
+    return entry.response(request.headers.get("accept-encoding"))
+
+
 # ------------------------ CUSTOM UUID ------------------------
 
 
@@ -112,11 +316,34 @@ class UUID(TypeDecorator):
             return value
         return uuid.UUID(bytes=value)
 
+# ------------------------ HEALTH ENDPOINTS ------------------------
+
+
+@app.get("/health/live")
+# The process is up and serving requests
+def liveness():
+    return {"status": "ok"}
+
+
+@app.get("/health/ready")
+# Startup finished, not shutting down, and the database answers
+async def readiness(db: AsyncSession = Depends(get_async_db)):
+    if not app.state.ready:
+        return JSONResponse(status_code=503, content={"status": "starting or stopping"})
+    try:
+        await db.execute(text("SELECT 1"))
+    except Exception:
+        logger.exception("Readiness check could not reach the database")
+        return JSONResponse(status_code=503, content={"status": "database unavailable"})
+    return {"status": "ok"}
+
+
 # ------------------------ AUTHENTICATION ENDPOINT ------------------------
 
 
 @app.post("/login", status_code=200, response_model=schemas.Token)
-async def login_for_access_token(form_data: OAuth2PasswordRequestForm = Depends(), db: Session = Depends(get_db)):
+# Sync, bcrypt and the user lookup would stall every other request of the worker on the event loop
+def login_for_access_token(form_data: OAuth2PasswordRequestForm = Depends(), db: Session = Depends(get_db)):
     user = crud.authenticate_user(db, form_data.username, form_data.password)
     if user is None:
         raise HTTPException(status_code=404, detail="User not found", headers={
@@ -126,7 +353,8 @@ async def login_for_access_token(form_data: OAuth2PasswordRequestForm = Depends(
                             "WWW-Authenticate": "Bearer"})
     access_token_expires = timedelta(minutes=15)
     access_token = crud.create_access_token(
-        data={"username": user.username, "role_id": user.role_id}, expires_delta=access_token_expires)
+        data={"username": user.username, "role_id": user.role_id, "restaurant_id": user.restaurant_id},
+        expires_delta=access_token_expires)
     return {"access_token": access_token, "token_type": "bearer"}
 
 # ------------------------ WAITER ENDPOINTS ------------------------
@@ -134,107 +362,105 @@ async def login_for_access_token(form_data: OAuth2PasswordRequestForm = Depends(
 
 @ app.get("/users/me", response_model=schemas.User)
 # Get current waiter details
-def get_data(current_user: schemas.User = Depends(RoleChecker(allowed_roles=[1, 2, 3])), db: Session = Depends(get_db)):
+async def get_data(current_user: schemas.User = Depends(RoleChecker(allowed_roles=[1, 2, 3]))):
     return current_user
 
 
 @app.get("/users/waiter/tables", response_model=List[schemas.Table])
 # Get all tables
-def get_tables(current_user: schemas.User = Depends(RoleChecker(allowed_roles=[1])), db: Session = Depends(get_db)):
-    tables = crud.get_tables(db)
-    return tables
+async def get_tables(request: Request, fields: Optional[str] = Query(None, description=FIELDS_DESCRIPTION), current_user: schemas.User = Depends(RoleChecker(allowed_roles=[1])), db: AsyncSession = Depends(get_async_db)):
+    selected = sparse_fields(schemas.Table, fields, "table_id")
+
+    async def build():
+        return schemas.dump_rows(sparse_model(schemas.Table, selected), await crud_async.get_tables(db, selected))
+    return await cached_json(request, ("tables", selected), ("tables",), build)
 
 
 @app.put("/users/waiter/tables/reserve", response_model=schemas.Table)
 # Update table status to reserved
 def update_table_status(update: schemas.TableStatusUpdate, current_user: schemas.User = Depends(RoleChecker(allowed_roles=[1])), db: Session = Depends(get_db)):
-    table = crud.get_table(db, update.table_id)
-    if not table:
-        raise HTTPException(status_code=404, detail="Table not found")
+    table = transactions.run(db, lambda: crud.reserve_table(db, update.table_id, current_user.staff_id),
+                             "reserve_table")
+    db.refresh(table)
+    return table
 
-    if table.table_status == "vacant":
-        table.table_status = "reserved"
-    else:
-        raise HTTPException(
-            status_code=400, detail="Only vacant table can be reserved")
 
-    db.commit()
+@app.put("/users/waiter/tables/allocate", response_model=schemas.Table)
+# Reserve the smallest vacant table that seats the party
+def allocate_table(allocation: schemas.TableAllocate, current_user: schemas.User = Depends(RoleChecker(allowed_roles=[1])), db: Session = Depends(get_db)):
+    table = transactions.run(db, lambda: crud.allocate_table(db, allocation.party_size, current_user.staff_id),
+                             "allocate_table")
     db.refresh(table)
     return table
 
 
 @app.get("/users/waiter/tables/menu-items", response_model=List[schemas.MenuItem])
 # Get menu items for a specific table
-def get_menu_items(current_user: schemas.User = Depends(RoleChecker(allowed_roles=[1])), db: Session = Depends(get_db)):
-    menu_items = crud.get_menu_items(db)
-    return menu_items
+async def get_menu_items(request: Request, fields: Optional[str] = Query(None, description=FIELDS_DESCRIPTION), current_user: schemas.User = Depends(RoleChecker(allowed_roles=[1])), db: AsyncSession = Depends(get_async_db)):
+    selected = sparse_fields(schemas.MenuItem, fields, "menu_item_id")
+
+    async def build():
+        return schemas.dump_rows(sparse_model(schemas.MenuItem, selected),
+                                 await crud_async.get_menu_items(db, selected))
+    return await cached_json(request, ("menu-items", selected), ("menu",), build)
+
+
+@app.get("/users/waiter/tables/menu-items/search", response_model=List[schemas.MenuItemSearchResult])
+# Search menu items by name or note, tolerant to typos and partial words
+def search_menu_items(request: Request, q: str = Query(..., min_length=1, max_length=100),
+                      limit: int = Query(10, ge=1, le=50),
+                      current_user: schemas.User = Depends(RoleChecker(allowed_roles=[1]))):
+    return menu_search.get(tenant_from_request(request)).search(q, limit)
 
 
 @app.post("/users/waiter/create-order", response_model=schemas.Order)
 # Create an order with dishes
 def create_order_with_dishes(order_data: schemas.OrderWithDishesCreate, current_user: schemas.User = Depends(RoleChecker(allowed_roles=[1])), db: Session = Depends(get_db)):
-    # Check if there are any existing orders for the same table that have not been served
-    existing_orders = crud.get_exist_unserved_orders(
-        db, order_data.table_id, False)
-
-    if existing_orders:
-        raise HTTPException(
-            status_code=status.HTTP_400_BAD_REQUEST,
-            detail="Unable to create new order, please finish the previous order on the same table"
-        )
-    # Create the order
-    new_order = models.Order(
-        table_id=order_data.table_id,
-        staff_id=current_user.staff_id,
-        created_at=datetime.utcnow()
-    )
-    db.add(new_order)
-    db.commit()
+    new_order = transactions.run(db, lambda: crud.create_order_with_dishes(
+        db, order_data, current_user.staff_id), "create_order")
     db.refresh(new_order)
+    return new_order
 
-    # Create the dishes
-    for dish_data in order_data.dishes:
-        menu_item = crud.get_menu_item(db, dish_data.menu_item_id)
-        if not menu_item:
-            raise HTTPException(status_code=404, detail="Menu item not found")
-
-        total_price = menu_item.price * dish_data.quantity
-        new_dish = models.Dish(
-            order_id=new_order.order_id,
-            staff_id=current_user.staff_id,
-            menu_item_id=dish_data.menu_item_id,
-            quantity=dish_data.quantity,
-            total=total_price,
-            dish_status='received'
-        )
-        db.add(new_dish)
 
-    # Update the table status
-    table = crud.get_table(db, order_data.table_id)
-    if table:
-        table.table_status = 'eating'
-        db.add(table)
-    else:
-        raise HTTPException(status_code=404, detail="Table not found")
+@app.post("/users/waiter/create-order/queued", response_model=schemas.OutboxEntry, status_code=202)
+# Take an order without waiting for the database, it is applied in the background in submission order
+def queue_order_with_dishes(request: Request, order_data: schemas.OrderWithDishesCreate,
+                            idempotency_key: Optional[str] = Header(None, max_length=128),
+                            current_user: schemas.User = Depends(RoleChecker(allowed_roles=[1]))):
+    return outbox.append(tenant_from_request(request), current_user.staff_id, order_data, idempotency_key)
 
-    db.commit()
 
-    return new_order
+@app.get("/users/waiter/outbox", response_model=schemas.OutboxStatus)
+# Get queued orders that are not in the database yet, and the ones it refused
+def get_outbox(request: Request, limit: int = Query(100, ge=1, le=1000),
+               current_user: schemas.User = Depends(RoleChecker(allowed_roles=[1, 3]))):
+    restaurant_id = tenant_from_request(request)
+    return {"pending": outbox.pending_count(restaurant_id), "entries": outbox.entries(restaurant_id, limit=limit)}
+
+
+@app.get("/users/waiter/outbox/{order_id}", response_model=schemas.OutboxEntry)
+# Get the state of one queued order
+def get_outbox_entry(request: Request, order_id: uuid.UUID,
+                     current_user: schemas.User = Depends(RoleChecker(allowed_roles=[1, 3]))):
+    entry = outbox.get(tenant_from_request(request), order_id)
+    if entry is None:
+        raise HTTPException(status_code=404, detail="Queued order not found")
+    return entry
 
 
 @app.get("/users/waiter/tables/{table_id}/order", response_model=schemas.OrderDetail)
 # Get order details for a specific table
-def get_order_details(table_id: int, current_user: schemas.User = Depends(RoleChecker(allowed_roles=[1])), db: Session = Depends(get_db)):
-    # Get the latest order for the table
-    order = crud.get_sorted_order_by_table(db, table_id)
-
-    if not order:
+async def get_order_details(table_id: int, current_user: schemas.User = Depends(RoleChecker(allowed_roles=[1])), db: AsyncSession = Depends(get_async_db)):
+    # Get the unserved order the table points at
+    table = await crud_async.get_table(db, table_id)
+    if not table:
         raise HTTPException(status_code=404, detail="Order not found")
-    if order.is_served == True:
+    if table.current_order_id is None:
         raise HTTPException(status_code=400, detail="No order available")
+    order = await crud_async.get_order(db, table.current_order_id)
 
     # Get the order items
-    dishes = crud.get_dish_by_order(db, order.order_id)
+    dishes = await crud_async.get_dish_by_order(db, order.order_id)
     # Prepare the response
     order_items = [
         schemas.OrderItemDetail(
@@ -252,107 +478,299 @@ def get_order_details(table_id: int, current_user: schemas.User = Depends(RoleCh
     )
 
 
+@app.get("/users/waiter/orders/{order_id}/bill", response_model=schemas.Bill)
+# Get the bill of an order, cached once the order is served. Until then another worker can add dishes
+# and only its own cache would hear about it
+async def get_order_bill(request: Request, order_id: uuid.UUID, current_user: schemas.User = Depends(RoleChecker(allowed_roles=[1])), db: AsyncSession = Depends(get_async_db)):
+    async def served():
+        return (await crud_async.get_order(db, order_id)).is_served
+    return await cached_json(request, ("bill", order_id), (order_tag(order_id),), lambda: build_bill(db, order_id),
+                             keep=served)
+
+
+async def build_bill(db: AsyncSession, order_id: uuid.UUID):
+    lines = await crud_async.get_bill_lines(db, order_id)
+    if not lines and not await crud_async.get_order(db, order_id):
+        raise HTTPException(status_code=404, detail="Order not found")
+
+    # Section subtotals come from the grouped lines, no second query
+    sections = {}
+    for line in lines:
+        section = sections.setdefault(line.menu_section_id, schemas.BillSection(
+            menu_section_id=line.menu_section_id, section_name=line.section_name, item_count=0, subtotal=0))
+        section.item_count += line.quantity
+        section.subtotal += line.subtotal
+
+    bill = schemas.Bill(
+        order_id=order_id,
+        lines=lines,
+        sections=list(sections.values()),
+        item_count=sum(line.quantity for line in lines),
+        subtotal=sum(line.subtotal for line in lines)
+    )
+    return bill.model_dump_json().encode()
+
+
 @app.put("/users/waiter/orders/{table_id}/serve", response_model=List[schemas.OrderUpdate])
 # Update order status to served
 def update_order_status(
         table_id: int,
         current_user: schemas.User = Depends(RoleChecker(allowed_roles=[1])),
         db: Session = Depends(get_db)):
-    # Fetch orders for the given table_id that are not yet served
-    orders = crud.get_exist_unserved_orders(db, table_id, False)
+    # Mark unserved orders as served, dishes as ready and free the table
+    return transactions.run(db, lambda: crud.serve_table_orders(db, table_id, current_user.staff_id),
+                            "serve_table")
+
+
+@app.post("/users/waiter/batch", response_model=schemas.BatchResult)
+# Run several waiter operations in one request and one transaction
+def run_waiter_batch(batch: schemas.BatchRequest, current_user: schemas.User = Depends(RoleChecker(allowed_roles=[1])), db: Session = Depends(get_db)):
+    def run_operations():
+        results = []
+        failed = False
+        for index, operation in enumerate(batch.operations):
+            # Once an operation fails the rest are skipped and nothing is committed
+            if failed:
+                results.append(schemas.BatchOperationResult(
+                    index=index, op=operation.op, status_code=status.HTTP_424_FAILED_DEPENDENCY,
+                    detail="Skipped after a previous operation failed"))
+                continue
+            try:
+                data = run_waiter_operation(db, operation, current_user)
+                results.append(schemas.BatchOperationResult(
+                    index=index, op=operation.op, status_code=200, data=data))
+            except HTTPException as exc:
+                failed = True
+                results.append(schemas.BatchOperationResult(
+                    index=index, op=operation.op, status_code=exc.status_code, detail=exc.detail))
+        if failed:
+            # Leaves nothing for the commit that follows
+            db.rollback()
+        return failed, results
+
+    # A lost deadlock runs the whole batch again
+    failed, results = transactions.run(db, run_operations, "waiter_batch")
+    return schemas.BatchResult(committed=not failed, results=results)
+
+
+def run_waiter_operation(db: Session, operation: schemas.BatchOperation, current_user: schemas.User):
+    # Dispatch one batch operation to the matching crud function
+    if operation.op == schemas.BatchOperationEnum.reserve:
+        table = crud.reserve_table(db, operation.table_id, current_user.staff_id)
+        return schemas.Table.model_validate(table).model_dump(mode="json")
+    if operation.op == schemas.BatchOperationEnum.create_order:
+        order = crud.create_order_with_dishes(db, schemas.OrderWithDishesCreate(
+            table_id=operation.table_id, dishes=operation.dishes), current_user.staff_id)
+        return schemas.Order.model_validate(order).model_dump(mode="json")
+    if operation.op == schemas.BatchOperationEnum.add_dishes:
+        order = crud.add_dishes_to_table(
+            db, operation.table_id, operation.dishes, current_user.staff_id)
+        return schemas.Order.model_validate(order).model_dump(mode="json")
+    orders = crud.serve_table_orders(db, operation.table_id, current_user.staff_id)
+    return [schemas.OrderUpdate.model_validate(order).model_dump(mode="json") for order in orders]
 
-    if not orders:
-        raise HTTPException(
-            status_code=status.HTTP_404_NOT_FOUND,
-            detail=f"No unserved orders found for table_id {table_id}"
-        )
-
-    # Update is_served status to True for each order and change dishes' status to 'ready'
-    updated_orders = []
-    for order in orders:
-        order.is_served = True
-        db.add(order)
+# ------------------------ CHEF ENDPOINTS ------------------------
 
-        # Fetch and update dishes for the order
-        dishes = db.query(models.Dish).filter(
-            models.Dish.order_id == order.order_id
-        ).all()
 
-        for dish in dishes:
-            dish.dish_status = "ready"
-            db.add(dish)
+@app.get("/users/chef/dishes", response_model=List[schemas.DishDisplay])
+# Get all dishes for the chef
+async def get_dishes(fields: Optional[str] = Query(None, description=FIELDS_DESCRIPTION), current_user: schemas.User = Depends(RoleChecker(allowed_roles=[2])), db: AsyncSession = Depends(get_async_db)):
+    selected = sparse_fields(schemas.DishDisplay, fields, "dish_id")
+    tickets = await crud_async.get_kitchen_tickets(db, selected)
 
-        updated_orders.append(order)
+    if not tickets:
+        raise HTTPException(status_code=404, detail="No dishes found")
 
-    table = crud.get_table(db, table_id)
-    table.table_status = "vacant"
+    # Rows go straight from the projection to JSON bytes
+    return Response(content=schemas.dump_rows(sparse_model(schemas.DishDisplay, selected), tickets),
+                    media_type="application/json")
 
-    db.commit()
 
-    return updated_orders
+@app.get("/users/chef/stations", response_model=List[schemas.KitchenStation])
+# Get the kitchen stations, so a screen can pick its own
+async def get_stations(current_user: schemas.User = Depends(RoleChecker(allowed_roles=[2, 3])), db: AsyncSession = Depends(get_async_db)):
+    return await crud_async.get_stations(db)
 
-# ------------------------ CHEF ENDPOINTS ------------------------
 
+@app.get("/users/chef/stations/{station_id}/dishes", response_model=List[schemas.DishDisplay])
+# Get the dishes of the station's menu sections only
+async def get_station_dishes(station_id: int, fields: Optional[str] = Query(None, description=FIELDS_DESCRIPTION), current_user: schemas.User = Depends(RoleChecker(allowed_roles=[2])), db: AsyncSession = Depends(get_async_db)):
+    selected = sparse_fields(schemas.DishDisplay, fields, "dish_id")
+    if await crud_async.get_station(db, station_id) is None:
+        raise HTTPException(status_code=404, detail="Station not found")
+    tickets = await crud_async.get_kitchen_tickets(db, selected, station_id)
 
-@app.get("/users/chef/dishes", response_model=List[schemas.DishDisplay])
-# Get all dishes for the chef
-def get_dishes(current_user: schemas.User = Depends(RoleChecker(allowed_roles=[2])), db: Session = Depends(get_db)):
-    dishes = db.query(
-        models.Dish.dish_id,
-        models.Dish.order_id,
-        models.Order.table_id,
-        models.MenuItem.item_name,
-        models.Dish.quantity,
-        models.Dish.dish_status
-    ).join(models.Order, models.Order.order_id == models.Dish.order_id)\
-     .join(models.Table, models.Table.table_id == models.Order.table_id)\
-     .join(models.MenuItem, models.MenuItem.menu_item_id == models.Dish.menu_item_id).all()
-
-    if not dishes:
+    if not tickets:
         raise HTTPException(status_code=404, detail="No dishes found")
 
-    return [schemas.DishDisplay(
-        dish_id=dish.dish_id,
-        order_id=dish.order_id,
-        table_id=dish.table_id,
-        item_name=dish.item_name,
-        quantity=dish.quantity,
-        dish_status=dish.dish_status
-    ) for dish in dishes]
+    return Response(content=schemas.dump_rows(sparse_model(schemas.DishDisplay, selected), tickets),
+                    media_type="application/json")
 
 
 @app.put("/users/chef/dishes/status-update", response_model=schemas.Dish)
 # Update dish status
 def update_dish_status(update: schemas.DishStatusUpdate, current_user: schemas.User = Depends(RoleChecker(allowed_roles=[2])), db: Session = Depends(get_db)):
-    dish = crud.get_dish(db, update.dish_id)
-    if not dish:
-        raise HTTPException(status_code=404, detail="Dish not found")
-
-    if dish.dish_status == "received":
-        dish.dish_status = "prepared"
-    elif dish.dish_status == "prepared":
-        dish.dish_status = "ready"
-    else:
-        raise HTTPException(
-            status_code=400, detail="ready dishes cannot be changed!")
-
-    db.commit()
+    dish = transactions.run(db, lambda: crud.advance_dish_status(db, update.dish_id, current_user.staff_id),
+                            "advance_dish_status")
     db.refresh(dish)
     return dish
 
 # ------------------------ MANAGER ENDPOINTS ------------------------
 
 
+@app.get("/users/manager/dashboard", response_model=schemas.Dashboard)
+# Get live occupancy and kitchen load, served from in-memory counters on the event loop
+async def get_dashboard(request: Request, current_user: schemas.User = Depends(RoleChecker(allowed_roles=[3]))):
+    return live_counters.get(tenant_from_request(request)).snapshot()
+
+
+@app.get("/users/manager/prep-times", response_model=schemas.PrepTimes)
+# Get p50/p90/p99 prep times per menu item and section, merged over the last days
+def get_prep_times(request: Request, stage: schemas.PrepStageEnum = schemas.PrepStageEnum.total,
+                   days: int = Query(7, ge=1), until: Optional[date] = None,
+                   current_user: schemas.User = Depends(RoleChecker(allowed_roles=[3]))):
+    until = until or datetime.utcnow().date()
+    since = until - timedelta(days=days - 1)
+    merged = prep_times.get(tenant_from_request(request)).merged(stage.value, since, until)
+
+    def stats(sketch):
+        return {"count": sketch.count, "p50": sketch.quantile(0.5),
+                "p90": sketch.quantile(0.9), "p99": sketch.quantile(0.99)}
+    return {
+        "stage": stage,
+        "since": since,
+        "until": until,
+        "items": [{"menu_item_id": key, **stats(sketch)} for key, sketch in merged["item"].items()],
+        "sections": [{"menu_section_id": key, **stats(sketch)}
+                     for key, sketch in sorted(merged["section"].items())],
+    }
+
+
+@app.get("/users/manager/audit-events", response_model=List[schemas.AuditEvent])
+# Get audit events for an entity and/or a time range, newest first
+def get_audit_events(entity_type: Optional[schemas.AuditEntityEnum] = None, entity_id: Optional[str] = None,
+                     since: Optional[datetime] = None, until: Optional[datetime] = None,
+                     limit: int = Query(100, ge=1, le=1000),
+                     current_user: schemas.User = Depends(RoleChecker(allowed_roles=[3])), db: Session = Depends(get_db)):
+    if entity_id is not None and entity_type is None:
+        raise HTTPException(status_code=400, detail="entity_id needs an entity_type")
+    # Buffered events would otherwise be missing from the answer
+    audit_log.flush(db)
+    return crud.get_audit_events(db, entity_type.value if entity_type else None, entity_id, since, until, limit)
+
+
+@app.get("/users/manager/diagnostics/memory", response_model=schemas.MemoryStatus)
+# Get the memory use of the worker that answers, and its snapshots
+def get_memory_status(current_user: schemas.User = Depends(RoleChecker(allowed_roles=[3]))):
+    return memory_diagnostics.status()
+
+
+@app.post("/users/manager/diagnostics/memory/start", response_model=schemas.MemoryStatus)
+# Start tracing allocations, keeping the given number of frames per allocation
+def start_memory_tracing(frames: Optional[int] = Query(None, ge=1, le=100),
+                         current_user: schemas.User = Depends(RoleChecker(allowed_roles=[3]))):
+    return memory_diagnostics.start(frames)
+
+
+@app.post("/users/manager/diagnostics/memory/stop", response_model=schemas.MemoryStatus)
+# Stop tracing and drop the snapshots
+def stop_memory_tracing(current_user: schemas.User = Depends(RoleChecker(allowed_roles=[3]))):
+    return memory_diagnostics.stop()
+
+
+@app.post("/users/manager/diagnostics/memory/snapshots", response_model=schemas.MemorySnapshot)
+# Take a snapshot of the traced allocations
+def take_memory_snapshot(current_user: schemas.User = Depends(RoleChecker(allowed_roles=[3]))):
+    snapshot = memory_diagnostics.take()
+    if snapshot is None:
+        raise HTTPException(status_code=409, detail="Memory tracing is not started")
+    return snapshot
+
+
+@app.get("/users/manager/diagnostics/memory/diff", response_model=schemas.MemoryDiff)
+# Get the allocation sites that grew most between two snapshots, until defaults to a snapshot taken now
+def get_memory_diff(since: str, until: Optional[str] = None,
+                    group_by: schemas.MemoryGroupEnum = schemas.MemoryGroupEnum.module,
+                    limit: int = Query(20, ge=1, le=200),
+                    current_user: schemas.User = Depends(RoleChecker(allowed_roles=[3]))):
+    if until is None:
+        snapshot = memory_diagnostics.take()
+        if snapshot is None:
+            raise HTTPException(status_code=409, detail="Memory tracing is not started")
+        until = snapshot["snapshot_id"]
+    diff = memory_diagnostics.diff(since, until, group_by.value, limit)
+    if diff is None:
+        # Snapshots stay in the worker that took them
+        raise HTTPException(status_code=404, detail=f"Snapshot not found on worker {os.getpid()}")
+    return diff
+
+
+@app.get("/users/manager/diagnostics/objects", response_model=schemas.LiveObjects)
+# Count live ORM instances by model, sessions and pydantic models of the worker that answers
+def get_live_objects(limit: int = Query(20, ge=1, le=200),
+                     current_user: schemas.User = Depends(RoleChecker(allowed_roles=[3]))):
+    return memory_diagnostics.live_objects(limit)
+
+
+@app.get("/users/manager/diagnostics/transactions", response_model=Dict[str, schemas.TransactionStats])
+# Get commits, retries and give-ups of the write transactions run by the worker that answers
+def get_transaction_stats(current_user: schemas.User = Depends(RoleChecker(allowed_roles=[3]))):
+    return transactions.snapshot()
+
+
+@app.post("/users/manager/stations", response_model=schemas.KitchenStation)
+# Create a kitchen station serving the given menu sections
+def create_station(station_data: schemas.KitchenStationCreate, current_user: schemas.User = Depends(RoleChecker(allowed_roles=[3])), db: Session = Depends(get_db)):
+    existing_station = db.query(models.KitchenStation).filter(
+        models.KitchenStation.station_name == station_data.station_name).first()
+    if existing_station:
+        raise HTTPException(status_code=400, detail="Station name must be unique")
+    station = models.KitchenStation(station_name=station_data.station_name)
+    db.add(station)
+    crud.set_station_sections(db, station, station_data.menu_section_ids)
+    db.commit()
+    db.refresh(station)
+    return station
+
+
+@app.put("/users/manager/stations/{station_id}", response_model=schemas.KitchenStation)
+# Rename a station and replace its menu sections
+def update_station(station_id: int, station_data: schemas.KitchenStationCreate, current_user: schemas.User = Depends(RoleChecker(allowed_roles=[3])), db: Session = Depends(get_db)):
+    station = crud.get_station(db, station_id)
+    if not station:
+        raise HTTPException(status_code=404, detail="Station not found")
+    station.station_name = station_data.station_name
+    crud.set_station_sections(db, station, station_data.menu_section_ids)
+    db.commit()
+    db.refresh(station)
+    return station
+
+
+@app.delete("/users/manager/stations/{station_id}/delete", status_code=204)
+# Delete a station, its menu sections are left alone
+def delete_station(station_id: int, current_user: schemas.User = Depends(RoleChecker(allowed_roles=[3])), db: Session = Depends(get_db)):
+    station = crud.get_station(db, station_id)
+    if not station:
+        raise HTTPException(status_code=404, detail="Station not found")
+    db.delete(station)
+    db.commit()
+    return {"detail": "Station deleted"}
+
+
 @app.get("/users/manager/menu-sections", response_model=List[schemas.MenuSectionWithItems])
 # Get menu sections with their items
-def get_menu_sections(current_user: schemas.User = Depends(RoleChecker(allowed_roles=[3])), db: Session = Depends(get_db)):
-    menu_sections = crud.get_menu_sections(db)
+async def get_menu_sections(request: Request, current_user: schemas.User = Depends(RoleChecker(allowed_roles=[3])), db: AsyncSession = Depends(get_async_db)):
+    return await cached_json(request, ("menu-sections",), ("menu",), lambda: build_menu_sections(db))
+
+
+async def build_menu_sections(db: AsyncSession):
+    menu_sections = await crud_async.get_menu_sections(db)
     if not menu_sections:
         raise HTTPException(status_code=404, detail="No menu sections found")
 
     result = []
     for section in menu_sections:
-        items = crud.get_menu_items_by_section(db, section.menu_section_id)
+        items = await crud_async.get_menu_items_by_section(db, section.menu_section_id)
         # Convert SQLAlchemy models to Pydantic models
         pydantic_items = [schemas.MenuItem(
             **item.__dict__) for item in items]
@@ -362,7 +780,7 @@ def get_menu_sections(current_user: schemas.User = Depends(RoleChecker(allowed_r
             menu_items=pydantic_items
         ))
 
-    return result
+    return schemas.list_adapter(schemas.MenuSectionWithItems).dump_json(result)
 
 
 @app.post("/users/manager/menu-sections", response_model=schemas.MenuSection)
@@ -377,6 +795,9 @@ def create_menu_section(section_data: schemas.MenuSectionCreate, current_user: s
     # Create new section
     new_section = models.MenuSection(section_name=section_data.section_name)
     db.add(new_section)
+    db.flush()
+    emit(db, "menu_changed", action="section_created", staff_id=current_user.staff_id,
+         menu_section_id=new_section.menu_section_id)
     db.commit()
     db.refresh(new_section)
 
@@ -399,6 +820,10 @@ def create_menu_item(item_data: schemas.MenuItemCreate, current_user: schemas.Us
         price=item_data.price
     )
     db.add(new_item)
+    db.flush()
+    emit(db, "menu_changed", action="item_created", staff_id=current_user.staff_id, menu_item_id=new_item.menu_item_id,
+         menu_section_id=new_item.menu_section_id, item_name=new_item.item_name, note=new_item.note,
+         price=new_item.price)
     db.commit()
     db.refresh(new_item)
 
@@ -412,11 +837,15 @@ def delete_menu_section(menu_section_id: int, current_user: schemas.User = Depen
         models.MenuSection.menu_section_id == menu_section_id).first()
     if not section:
         raise HTTPException(status_code=404, detail="Menu section not found")
-    # Delete all associated menu items
+    # Delete all associated menu items, and take the section off its stations
     db.query(models.MenuItem).filter(
         models.MenuItem.menu_section_id == menu_section_id).delete()
+    db.query(models.StationSection).filter(
+        models.StationSection.menu_section_id == menu_section_id).delete()
     # Delete the section
     db.delete(section)
+    emit(db, "menu_changed", action="section_deleted", staff_id=current_user.staff_id,
+         menu_section_id=menu_section_id)
     db.commit()
     return {"detail": "Menu section and associated items deleted"}
 
@@ -429,6 +858,8 @@ def delete_menu_item(menu_item_id: str, current_user: schemas.User = Depends(Rol
     if not item:
         raise HTTPException(status_code=404, detail="Menu item not found")
     db.delete(item)
+    emit(db, "menu_changed", action="item_deleted", staff_id=current_user.staff_id, menu_item_id=item.menu_item_id,
+         menu_section_id=item.menu_section_id)
     db.commit()
     return {"detail": "Menu item deleted"}
 
@@ -440,9 +871,14 @@ def update_menu_item(menu_item_id: str, item_data: schemas.MenuItemCreate, curre
         models.MenuItem.menu_item_id == menu_item_id).first()
     if not item:
         raise HTTPException(status_code=404, detail="Menu item not found")
+    if item.item_name != item_data.item_name:
+        crud.rename_kitchen_tickets(db, item.menu_item_id, item_data.item_name)
     item.item_name = item_data.item_name
     item.note = item_data.note
     item.price = item_data.price
+    emit(db, "menu_changed", action="item_updated", staff_id=current_user.staff_id, menu_item_id=item.menu_item_id,
+         menu_section_id=item.menu_section_id, item_name=item.item_name, note=item.note,
+         price=item.price)
     db.commit()
     db.refresh(item)
     return item
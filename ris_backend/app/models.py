@@ -1,5 +1,5 @@
 # This file defines the classes/tables in database with given fields, datatypes and relationships
-from sqlalchemy import Column, Integer, String, Boolean, ForeignKey, TIMESTAMP, Float, Enum, Date, TypeDecorator, BINARY
+from sqlalchemy import Column, Integer, String, Boolean, ForeignKey, TIMESTAMP, Float, Enum, Date, TypeDecorator, BINARY, BigInteger, Text, Index, UniqueConstraint
 from sqlalchemy.dialects.mysql import BINARY
 from sqlalchemy.orm import relationship
 import uuid
@@ -27,6 +27,11 @@ class UUID(TypeDecorator):
         return uuid.UUID(bytes=value)
 
 
+class TenantMixin:
+    # Restaurant the row belongs to. Sessions opened for a restaurant only ever see and write its rows
+    restaurant_id = Column(Integer, nullable=False, server_default="1")
+
+
 class StaffRole(Base):
     __tablename__ = 'roles'
     role_id = Column(Integer, primary_key=True, index=True)
@@ -34,12 +39,12 @@ class StaffRole(Base):
     staff_accounts = relationship("StaffAccount", back_populates="role")
 
 
-class StaffAccount(Base):
+class StaffAccount(TenantMixin, Base):
     __tablename__ = 'staff_accounts'
     staff_id = Column(UUID, primary_key=True,
-                      default=lambda: uuid.uuid4().bytes)
+                      default=uuid.uuid4)
     role_id = Column(Integer, ForeignKey('roles.role_id'), nullable=False)
-    username = Column(String, nullable=False, unique=True, index=True)
+    username = Column(String, nullable=False)
     password = Column(String, nullable=False)
     full_name = Column(String, nullable=False)
     gender = Column(Enum('male', 'female', 'others',
@@ -52,36 +57,49 @@ class StaffAccount(Base):
                           primaryjoin="and_(StaffAccount.staff_id == Order.staff_id, StaffAccount.role_id == 1)")
     dishes = relationship("Dish", back_populates="chef",
                           primaryjoin="and_(StaffAccount.staff_id == Dish.staff_id, StaffAccount.role_id == 2)")
+    __table_args__ = (
+        UniqueConstraint('restaurant_id', 'username', name='uq_staff_accounts_restaurant_username'),
+    )
 
 
-class Table(Base):
+class Table(TenantMixin, Base):
     __tablename__ = 'tables'
     table_id = Column(Integer, primary_key=True, index=True)
     capacity = Column(Integer, nullable=False)
     table_status = Column(Enum('vacant', 'reserved', 'eating',
                                name='table_status'), nullable=False, default='vacant')
-    orders = relationship("Order", back_populates="table")
+    # The unserved order on the table, if any. Kept by crud, checked by repair_current_orders
+    current_order_id = Column(UUID, ForeignKey('orders.order_id', use_alter=True,
+                                               name='fk_tables_current_order_id'), nullable=True)
+    orders = relationship("Order", back_populates="table", foreign_keys="Order.table_id")
+    __table_args__ = (
+        Index('ix_tables_restaurant_status', 'restaurant_id', 'table_status'),
+    )
 
 
-class Order(Base):
+class Order(TenantMixin, Base):
     __tablename__ = 'orders'
     order_id = Column(UUID, primary_key=True,
-                      default=lambda: uuid.uuid4().bytes)
+                      default=uuid.uuid4)
     table_id = Column(Integer, ForeignKey('tables.table_id'), nullable=False)
     staff_id = Column(UUID, ForeignKey(
         'staff_accounts.staff_id'), nullable=False)
     is_served = Column(Boolean, default=False)
     created_at = Column(TIMESTAMP(timezone=True), nullable=False)
-    table = relationship("Table", back_populates="orders")
+    table = relationship("Table", back_populates="orders", foreign_keys=[table_id])
     waiter = relationship("StaffAccount", back_populates="orders",
                           primaryjoin="and_(Order.staff_id == StaffAccount.staff_id, StaffAccount.role_id == 1)")
     dishes = relationship("Dish", back_populates="order")
+    __table_args__ = (
+        Index('ix_orders_restaurant_table_served', 'restaurant_id', 'table_id', 'is_served'),
+        Index('ix_orders_restaurant_created_at', 'restaurant_id', 'created_at'),
+    )
 
 
-class Dish(Base):
+class Dish(TenantMixin, Base):
     __tablename__ = 'dishes'
     dish_id = Column(UUID, primary_key=True,
-                     default=lambda: uuid.uuid4().bytes)
+                     default=uuid.uuid4)
     order_id = Column(UUID, ForeignKey('orders.order_id'), nullable=False)
     staff_id = Column(UUID, ForeignKey(
         'staff_accounts.staff_id'), nullable=False)
@@ -92,27 +110,97 @@ class Dish(Base):
     total = Column(Float, nullable=False)
     dish_status = Column(Enum('received', 'prepared', 'ready',
                               name='dish_status'), nullable=False, default='received')
+    # When the dish entered each status, naive UTC
+    received_at = Column(TIMESTAMP(timezone=True), nullable=True)
+    prepared_at = Column(TIMESTAMP(timezone=True), nullable=True)
+    ready_at = Column(TIMESTAMP(timezone=True), nullable=True)
     order = relationship("Order", back_populates="dishes")
     chef = relationship("StaffAccount", back_populates="dishes",
                         primaryjoin="and_(Dish.staff_id == StaffAccount.staff_id, StaffAccount.role_id == 2)")
     menu_item = relationship("MenuItem", back_populates="dishes")
+    __table_args__ = (
+        Index('ix_dishes_restaurant_order', 'restaurant_id', 'order_id'),
+        Index('ix_dishes_restaurant_received_at', 'restaurant_id', 'received_at'),
+    )
 
 
-class MenuItem(Base):
+class MenuItem(TenantMixin, Base):
     __tablename__ = 'menu_items'
     menu_item_id = Column(UUID, primary_key=True,
-                          default=lambda: uuid.uuid4().bytes)
+                          default=uuid.uuid4)
     menu_section_id = Column(Integer, ForeignKey(
         'menu_sections.menu_section_id'), nullable=False)
-    item_name = Column(String, nullable=False, unique=True)
+    item_name = Column(String, nullable=False)
     note = Column(String, nullable=True)
     price = Column(Float, nullable=False)
     dishes = relationship("Dish", back_populates="menu_item")
     menu_section = relationship("MenuSection", back_populates="menu_items")
+    __table_args__ = (
+        UniqueConstraint('restaurant_id', 'item_name', name='uq_menu_items_restaurant_item_name'),
+        Index('ix_menu_items_restaurant_section', 'restaurant_id', 'menu_section_id'),
+    )
 
 
-class MenuSection(Base):
+class MenuSection(TenantMixin, Base):
     __tablename__ = 'menu_sections'
     menu_section_id = Column(Integer, primary_key=True, index=True)
     section_name = Column(String, nullable=False)
     menu_items = relationship("MenuItem", back_populates="menu_section")
+    __table_args__ = (
+        Index('ix_menu_sections_restaurant', 'restaurant_id', 'menu_section_id'),
+    )
+
+
+class KitchenStation(TenantMixin, Base):
+    # A chef screen, it shows the tickets of its menu sections only
+    __tablename__ = 'kitchen_stations'
+    station_id = Column(Integer, primary_key=True, index=True)
+    station_name = Column(String, nullable=False)
+    sections = relationship("StationSection", back_populates="station", cascade="all, delete-orphan")
+    __table_args__ = (
+        UniqueConstraint('restaurant_id', 'station_name', name='uq_kitchen_stations_restaurant_station_name'),
+    )
+
+
+class StationSection(TenantMixin, Base):
+    __tablename__ = 'station_sections'
+    station_id = Column(Integer, ForeignKey('kitchen_stations.station_id'), primary_key=True)
+    menu_section_id = Column(Integer, ForeignKey('menu_sections.menu_section_id'), primary_key=True)
+    station = relationship("KitchenStation", back_populates="sections")
+
+
+class KitchenTicket(TenantMixin, Base):
+    # Read model for the kitchen, one row per dish kept in step by crud on every write
+    __tablename__ = 'kitchen_tickets'
+    dish_id = Column(UUID, primary_key=True)
+    order_id = Column(UUID, nullable=False)
+    table_id = Column(Integer, nullable=False)
+    menu_item_id = Column(UUID, nullable=False, index=True)
+    menu_section_id = Column(Integer, nullable=False)
+    item_name = Column(String, nullable=False)
+    quantity = Column(Integer, nullable=False)
+    note = Column(String, nullable=True)
+    dish_status = Column(Enum('received', 'prepared', 'ready',
+                              name='dish_status'), nullable=False, default='received')
+    ordered_at = Column(TIMESTAMP(timezone=True), nullable=False)
+    __table_args__ = (
+        Index('ix_kitchen_tickets_restaurant_ordered_at', 'restaurant_id', 'ordered_at'),
+        # Station feeds, one range per section of the station already in ticket order
+        Index('ix_kitchen_tickets_restaurant_section', 'restaurant_id', 'menu_section_id', 'ordered_at'),
+    )
+
+
+class AuditEvent(TenantMixin, Base):
+    # Append-only, rows are written in batches by app.audit and never updated
+    __tablename__ = 'audit_events'
+    audit_event_id = Column(BigInteger().with_variant(Integer, "sqlite"), primary_key=True, autoincrement=True)
+    event_type = Column(String(64), nullable=False)
+    entity_type = Column(String(32), nullable=False)
+    entity_id = Column(String(36), nullable=False)
+    staff_id = Column(UUID, nullable=True)
+    detail = Column(Text, nullable=True)
+    created_at = Column(TIMESTAMP(timezone=True), nullable=False)
+    __table_args__ = (
+        Index('ix_audit_events_entity', 'restaurant_id', 'entity_type', 'entity_id', 'created_at'),
+        Index('ix_audit_events_created_at', 'restaurant_id', 'created_at'),
+    )
@@ -0,0 +1,330 @@
+# This file keeps a durable local outbox of submitted orders, applied to the database by a background replayer
+import os
+import time
+import uuid
+import sqlite3
+import logging
+import threading
+from datetime import datetime
+from fastapi import HTTPException
+from sqlalchemy.exc import IntegrityError, InterfaceError, OperationalError, TimeoutError as PoolTimeoutError
+from dotenv import load_dotenv
+
+from . import crud, schemas
+
+# Load variables from constants
+load_dotenv()
+OUTBOX_PATH = os.getenv("OUTBOX_PATH", "outbox.db")
+OUTBOX_REPLAY_INTERVAL = float(os.getenv("OUTBOX_REPLAY_INTERVAL", 0.2))
+# Wait after a pass that could not reach the database, doubled per failed attempt up to the maximum
+OUTBOX_RETRY_INTERVAL = float(os.getenv("OUTBOX_RETRY_INTERVAL", 1.0))
+OUTBOX_MAX_RETRY_INTERVAL = float(os.getenv("OUTBOX_MAX_RETRY_INTERVAL", 30.0))
+# Only the worker holding the lease replays, so orders of a restaurant are applied one at a time and in order.
+# Longer than the longest retry wait, a worker that dies hands over once its lease runs out
+OUTBOX_LEASE_SECONDS = float(os.getenv("OUTBOX_LEASE_SECONDS", 60.0))
+# An unreachable database is waited out however long it takes, any other error gives the entry up after this
+# many attempts so it does not hold back the restaurant's later orders for good
+OUTBOX_MAX_ATTEMPTS = int(os.getenv("OUTBOX_MAX_ATTEMPTS", 5))
+PENDING, APPLIED, REJECTED, FAILED = "pending", "applied", "rejected", "failed"
+# Connection lost, refused or timed out, and lock waits, the entry is fine and the database will be back
+UNAVAILABLE_ERRORS = (OperationalError, InterfaceError, PoolTimeoutError)
+logger = logging.getLogger(__name__)
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS outbox_entries (
+    seq INTEGER PRIMARY KEY AUTOINCREMENT,
+    order_id TEXT NOT NULL UNIQUE,
+    idempotency_key TEXT,
+    restaurant_id INTEGER NOT NULL,
+    staff_id TEXT NOT NULL,
+    table_id INTEGER NOT NULL,
+    payload TEXT NOT NULL,
+    status TEXT NOT NULL,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    detail TEXT,
+    created_at TEXT NOT NULL,
+    applied_at TEXT,
+    -- Keys come from the tablets, two restaurants can pick the same one
+    UNIQUE (restaurant_id, idempotency_key)
+);
+CREATE INDEX IF NOT EXISTS ix_outbox_entries_status ON outbox_entries (status, restaurant_id, seq);
+CREATE TABLE IF NOT EXISTS outbox_lease (
+    name TEXT PRIMARY KEY,
+    owner TEXT NOT NULL,
+    expires_at REAL NOT NULL
+);
+"""
+COLUMNS = ("seq", "order_id", "idempotency_key", "restaurant_id", "staff_id", "table_id", "payload", "status",
+           "attempts", "detail", "created_at", "applied_at")
+
+
+def entry_dict(row):
+    if row is None:
+        return None
+    entry = dict(zip(COLUMNS, row))
+    entry["order_id"] = uuid.UUID(entry["order_id"])
+    entry["staff_id"] = uuid.UUID(entry["staff_id"])
+    entry["created_at"] = datetime.fromisoformat(entry["created_at"])
+    if entry["applied_at"]:
+        entry["applied_at"] = datetime.fromisoformat(entry["applied_at"])
+    return entry
+
+
+class Outbox:
+    # Orders are acknowledged once they are on local disk and applied in submission order per restaurant.
+    # The provisional order id is the id the order gets in the database, so applying twice is caught
+    def __init__(self, path: str = OUTBOX_PATH, replay_interval: float = OUTBOX_REPLAY_INTERVAL,
+                 retry_interval: float = OUTBOX_RETRY_INTERVAL, session_factory=None,
+                 lease_seconds: float = OUTBOX_LEASE_SECONDS, max_attempts: int = OUTBOX_MAX_ATTEMPTS):
+        self.path = path
+        self.max_attempts = max_attempts
+        self.lease_seconds = lease_seconds
+        self.lease_token = uuid.uuid4().hex[:8]
+        self.lease_until = 0.0
+        self.replay_interval = replay_interval
+        self.retry_interval = retry_interval
+        self.session_factory = session_factory
+        self.connection = None
+        self.lock = threading.Lock()
+        self.wakeup = threading.Event()
+        self.stopping = threading.Event()
+        self.thread = None
+        self.failures = 0
+        self.stats = {"appended": 0, "applied": 0, "rejected": 0, "failed": 0, "retried": 0}
+
+    # ------------------------ LOCAL LOG ------------------------
+
+    def connect(self):
+        # Caller holds the lock. WAL with synchronous=FULL fsyncs every commit, an acknowledged order survives a crash
+        if self.connection is None:
+            directory = os.path.dirname(self.path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            self.connection = sqlite3.connect(self.path, check_same_thread=False, isolation_level=None)
+            self.connection.execute("PRAGMA journal_mode=WAL")
+            self.connection.execute("PRAGMA synchronous=FULL")
+            self.upgrade(self.connection)
+        return self.connection
+
+    @staticmethod
+    def upgrade(connection):
+        # Files written while the idempotency key was unique across restaurants are copied into the new table
+        row = connection.execute("SELECT sql FROM sqlite_master WHERE type = 'table' AND name = 'outbox_entries'")\
+            .fetchone()
+        if row is None or "idempotency_key TEXT UNIQUE" not in row[0]:
+            connection.executescript(SCHEMA)
+            return
+        connection.executescript(
+            "BEGIN IMMEDIATE; DROP INDEX IF EXISTS ix_outbox_entries_status; "
+            "ALTER TABLE outbox_entries RENAME TO outbox_entries_old; " + SCHEMA +
+            f"INSERT INTO outbox_entries ({', '.join(COLUMNS)}) SELECT {', '.join(COLUMNS)} FROM outbox_entries_old; "
+            "DROP TABLE outbox_entries_old; COMMIT;")
+
+    def close(self):
+        with self.lock:
+            if self.connection is not None:
+                self.connection.close()
+                self.connection = None
+
+    def append(self, restaurant_id: int, staff_id, order_data: schemas.OrderWithDishesCreate,
+               idempotency_key: str = None):
+        # Returns the entry, the existing one when the restaurant sent the key before
+        with self.lock:
+            connection = self.connect()
+            if idempotency_key is not None:
+                existing = connection.execute(
+                    f"SELECT {', '.join(COLUMNS)} FROM outbox_entries WHERE restaurant_id = ? AND idempotency_key = ?",
+                    (restaurant_id, idempotency_key)).fetchone()
+                if existing is not None:
+                    return entry_dict(existing)
+            cursor = connection.execute(
+                "INSERT INTO outbox_entries (order_id, idempotency_key, restaurant_id, staff_id, table_id, payload, "
+                "status, created_at) VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                (str(uuid.uuid4()), idempotency_key, restaurant_id, str(staff_id), order_data.table_id,
+                 order_data.model_dump_json(), PENDING, datetime.utcnow().isoformat()))
+            row = connection.execute(f"SELECT {', '.join(COLUMNS)} FROM outbox_entries WHERE seq = ?",
+                                     (cursor.lastrowid,)).fetchone()
+            self.stats["appended"] += 1
+        self.wakeup.set()
+        return entry_dict(row)
+
+    def get(self, restaurant_id: int, order_id):
+        with self.lock:
+            row = self.connect().execute(
+                f"SELECT {', '.join(COLUMNS)} FROM outbox_entries WHERE order_id = ? AND restaurant_id = ?",
+                (str(order_id), restaurant_id)).fetchone()
+        return entry_dict(row)
+
+    def entries(self, restaurant_id: int = None, statuses=(PENDING, REJECTED, FAILED), limit: int = 100):
+        # Oldest first
+        query = f"SELECT {', '.join(COLUMNS)} FROM outbox_entries WHERE status IN ({', '.join('?' * len(statuses))})"
+        params = list(statuses)
+        if restaurant_id is not None:
+            query += " AND restaurant_id = ?"
+            params.append(restaurant_id)
+        with self.lock:
+            rows = self.connect().execute(query + " ORDER BY seq LIMIT ?", (*params, limit)).fetchall()
+        return [entry_dict(row) for row in rows]
+
+    def pending_count(self, restaurant_id: int = None):
+        query = "SELECT COUNT(*) FROM outbox_entries WHERE status = ?"
+        params = [PENDING]
+        if restaurant_id is not None:
+            query += " AND restaurant_id = ?"
+            params.append(restaurant_id)
+        with self.lock:
+            return self.connect().execute(query, params).fetchone()[0]
+
+    def mark(self, seq: int, status: str, detail: str = None):
+        applied_at = datetime.utcnow().isoformat() if status == APPLIED else None
+        with self.lock:
+            self.connect().execute(
+                "UPDATE outbox_entries SET status = ?, detail = ?, applied_at = ?, attempts = attempts + 1 "
+                "WHERE seq = ? AND status = ?", (status, detail, applied_at, seq, PENDING))
+            self.stats[status] += 1
+
+    def record_failure(self, seq: int, detail: str):
+        with self.lock:
+            self.connect().execute(
+                "UPDATE outbox_entries SET attempts = attempts + 1, detail = ? WHERE seq = ? AND status = ?",
+                (detail, seq, PENDING))
+            self.stats["retried"] += 1
+
+    # ------------------------ LEASE ------------------------
+
+    def owner(self):
+        # The pid changes in a forked worker, the token in a restarted one
+        return f"{os.getpid()}-{self.lease_token}"
+
+    def hold_lease(self):
+        # Takes or renews the replay lease, False while another worker holds it. Renewed once half of it
+        # is used, the check and the write are one IMMEDIATE transaction so two workers never both win
+        now = time.time()
+        if now < self.lease_until - self.lease_seconds / 2:
+            return True
+        with self.lock:
+            connection = self.connect()
+            connection.execute("BEGIN IMMEDIATE")
+            try:
+                row = connection.execute("SELECT owner, expires_at FROM outbox_lease WHERE name = 'replay'").fetchone()
+                if row is not None and row[0] != self.owner() and row[1] > now:
+                    connection.execute("COMMIT")
+                    self.lease_until = 0.0
+                    return False
+                connection.execute("INSERT OR REPLACE INTO outbox_lease (name, owner, expires_at) "
+                                   "VALUES ('replay', ?, ?)", (self.owner(), now + self.lease_seconds))
+                connection.execute("COMMIT")
+            except Exception:
+                connection.execute("ROLLBACK")
+                raise
+        self.lease_until = now + self.lease_seconds
+        return True
+
+    def release_lease(self):
+        with self.lock:
+            if self.connection is not None:
+                self.connection.execute("DELETE FROM outbox_lease WHERE name = 'replay' AND owner = ?",
+                                        (self.owner(),))
+        self.lease_until = 0.0
+
+    # ------------------------ REPLAY ------------------------
+
+    def make_session(self, restaurant_id: int):
+        if self.session_factory is None:
+            from .database import router
+            self.session_factory = router.session
+        return self.session_factory(restaurant_id)
+
+    def replay(self):
+        # One pass over the pending entries, returns how many were settled. A restaurant whose database
+        # cannot be reached is skipped for the rest of the pass, so its later orders never overtake
+        settled = 0
+        blocked = set()
+        if not self.hold_lease():
+            return settled
+        for entry in self.entries(statuses=(PENDING,), limit=1000):
+            if entry["restaurant_id"] in blocked:
+                continue
+            if not self.hold_lease():
+                # Lost the lease while applying, the new holder carries on from here
+                break
+            try:
+                status, detail = self.apply(entry)
+            except UNAVAILABLE_ERRORS as exc:
+                logger.warning("Outbox order %s not applied yet: %s", entry["order_id"], exc)
+                self.record_failure(entry["seq"], str(exc))
+                blocked.add(entry["restaurant_id"])
+                continue
+            except Exception as exc:
+                if entry["attempts"] + 1 < self.max_attempts:
+                    logger.warning("Outbox order %s failed, will retry: %s", entry["order_id"], exc)
+                    self.record_failure(entry["seq"], str(exc))
+                    blocked.add(entry["restaurant_id"])
+                    continue
+                logger.exception("Outbox order %s failed %d times, giving up", entry["order_id"], self.max_attempts)
+                status, detail = FAILED, str(exc)
+            self.mark(entry["seq"], status, detail)
+            settled += 1
+        self.failures = self.failures + 1 if blocked else 0
+        return settled
+
+    def apply(self, entry):
+        # Returns (status, detail), raises when the order could not be applied this time
+        db = self.make_session(entry["restaurant_id"])
+        try:
+            # Committed on an earlier attempt that crashed before it was marked
+            if crud.get_order(db, entry["order_id"]) is not None:
+                return APPLIED, None
+            order_data = schemas.OrderWithDishesCreate.model_validate_json(entry["payload"])
+            try:
+                crud.create_order_with_dishes(db, order_data, entry["staff_id"], order_id=entry["order_id"],
+                                              created_at=entry["created_at"])
+                db.commit()
+            except HTTPException as exc:
+                # The order itself is wrong, retrying will not help
+                db.rollback()
+                return REJECTED, str(exc.detail)
+            except IntegrityError:
+                # Another worker applied it first
+                db.rollback()
+                if crud.get_order(db, entry["order_id"]) is None:
+                    raise
+            return APPLIED, None
+        finally:
+            db.close()
+
+    # ------------------------ REPLAYER THREAD ------------------------
+
+    def start(self):
+        if self.thread is not None:
+            return
+        self.stopping.clear()
+        self.thread = threading.Thread(target=self.run, name="outbox-replayer", daemon=True)
+        self.thread.start()
+
+    def stop(self, timeout: float = 10.0):
+        if self.thread is not None:
+            self.stopping.set()
+            self.wakeup.set()
+            self.thread.join(timeout)
+            self.thread = None
+            # Another worker takes over right away instead of waiting for the lease to run out
+            self.release_lease()
+        self.close()
+
+    def run(self):
+        while not self.stopping.is_set():
+            try:
+                self.replay()
+            except Exception:
+                logger.exception("Outbox replay failed")
+                self.failures += 1
+            if self.failures:
+                wait = min(self.retry_interval * 2 ** (self.failures - 1), OUTBOX_MAX_RETRY_INTERVAL)
+            else:
+                wait = self.replay_interval
+            self.wakeup.wait(wait)
+            self.wakeup.clear()
+
+
+outbox = Outbox()
@@ -0,0 +1,212 @@
+# This file profiles single requests on demand by sampling thread stacks, written out as flamegraphs
+import os
+import sys
+import json
+import time
+import uuid
+import random
+import logging
+import threading
+from collections import Counter
+from datetime import datetime
+from dotenv import load_dotenv
+from starlette.concurrency import run_in_threadpool
+
+from .admission import request_role, MANAGER
+
+# Load variables from constants
+load_dotenv()
+PROFILE_DIR = os.getenv("PROFILE_DIR", "profiles")
+# Share of all requests profiled without asking, 0 leaves only the X-Profile header
+PROFILE_SAMPLE_RATE = float(os.getenv("PROFILE_SAMPLE_RATE", 0.0))
+PROFILE_INTERVAL = float(os.getenv("PROFILE_INTERVAL", 0.001))
+# "speedscope" for https://www.speedscope.app, "collapsed" for flamegraph.pl and most other viewers
+PROFILE_FORMAT = os.getenv("PROFILE_FORMAT", "speedscope")
+PROFILE_KEEP = int(os.getenv("PROFILE_KEEP", 200))
+PROFILE_HEADER = b"x-profile"
+# A thread whose innermost frame is in one of these is waiting, not working
+IDLE_FILES = (f"{os.sep}threading.py", f"{os.sep}selectors.py", f"{os.sep}queue.py")
+logger = logging.getLogger(__name__)
+
+
+def frame_name(code):
+    # function (package/module.py:line), enough to tell apart the middleware, dependencies and handler
+    path = code.co_filename.replace(os.sep, "/").split("/")
+    return f"{code.co_name} ({'/'.join(path[-2:])}:{code.co_firstlineno})"
+
+
+class StackSampler:
+    # Samples every busy thread at a fixed interval. Threads are not tied to requests, so
+    # other requests in flight at the same time show up too, see Profiler.in_flight
+    def __init__(self, loop_thread: int, interval: float = PROFILE_INTERVAL):
+        self.loop_thread = loop_thread
+        self.interval = interval
+        self.counts = Counter()
+        self.seconds = Counter()
+        self.names = {}
+        self.stopping = threading.Event()
+        self.thread = None
+        self.started = None
+        self.duration = 0.0
+
+    def start(self):
+        self.started = time.perf_counter()
+        self.thread = threading.Thread(target=self.run, name="profile-sampler", daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.stopping.set()
+        self.thread.join()
+        self.duration = time.perf_counter() - self.started
+
+    def run(self):
+        own = threading.get_ident()
+        last = time.perf_counter()
+        while not self.stopping.wait(self.interval):
+            now = time.perf_counter()
+            for ident, frame in sys._current_frames().items():
+                if ident == own:
+                    continue
+                stack = self.stack(frame)
+                if stack is not None:
+                    self.record(("event-loop" if ident == self.loop_thread else "worker",) + stack, now - last)
+            last = now
+
+    def record(self, stack: tuple, seconds: float):
+        self.counts[stack] += 1
+        self.seconds[stack] += seconds
+
+    def stack(self, frame):
+        # Root first, None for an idle thread
+        if frame.f_code.co_filename.endswith(IDLE_FILES):
+            return None
+        names = []
+        while frame is not None:
+            code = frame.f_code
+            name = self.names.get(code)
+            if name is None:
+                name = self.names[code] = frame_name(code)
+            names.append(name)
+            frame = frame.f_back
+        names.reverse()
+        return tuple(names)
+
+    # ------------------------ OUTPUT ------------------------
+
+    def collapsed(self):
+        # One "root;...;leaf count" line per distinct stack
+        return "".join(f"{';'.join(stack)} {count}\n" for stack, count in sorted(self.counts.items()))
+
+    def speedscope(self, name: str):
+        frames = {}
+        profiles = {}
+        for stack, seconds in sorted(self.seconds.items()):
+            thread, frame_names = stack[0], stack[1:]
+            profile = profiles.setdefault(thread, {"samples": [], "weights": []})
+            profile["samples"].append([frames.setdefault(frame, len(frames)) for frame in frame_names])
+            profile["weights"].append(round(seconds, 6))
+        return json.dumps({
+            "$schema": "https://www.speedscope.app/file-format-schema.json",
+            "name": name,
+            "exporter": "ris-backend",
+            "shared": {"frames": [{"name": frame} for frame in frames]},
+            "profiles": [{
+                "type": "sampled",
+                "name": f"{name} [{thread}]",
+                "unit": "seconds",
+                "startValue": 0,
+                "endValue": round(sum(profile["weights"]), 6),
+                **profile,
+            } for thread, profile in profiles.items()],
+        })
+
+
+class Profiler:
+    # Settings and state shared by every request of a worker, one profile at a time
+    def __init__(self, directory: str = PROFILE_DIR, sample_rate: float = PROFILE_SAMPLE_RATE,
+                 interval: float = PROFILE_INTERVAL, output_format: str = PROFILE_FORMAT, keep: int = PROFILE_KEEP):
+        self.directory = directory
+        self.sample_rate = sample_rate
+        self.interval = interval
+        self.output_format = output_format
+        self.keep = keep
+        self.active = False
+        self.in_flight = 0
+
+    def wanted(self, scope):
+        # Cheap unless asked: a random draw when sampling is on, one pass over the header names otherwise
+        if self.sample_rate and random.random() < self.sample_rate:
+            return True
+        for name, value in scope["headers"]:
+            if name == PROFILE_HEADER:
+                return value not in (b"", b"0") and request_role(dict(scope["headers"])) == MANAGER
+        return False
+
+    def profile_id(self, scope):
+        path = scope["path"].strip("/").replace("/", "_") or "root"
+        return f"{datetime.utcnow():%Y%m%dT%H%M%S}-{scope['method']}-{path}-{uuid.uuid4().hex[:8]}"
+
+    def write(self, profile_id: str, sampler: StackSampler, concurrent: int):
+        os.makedirs(self.directory, exist_ok=True)
+        if self.output_format == "collapsed":
+            path = os.path.join(self.directory, f"{profile_id}.collapsed")
+            content = sampler.collapsed()
+        else:
+            path = os.path.join(self.directory, f"{profile_id}.speedscope.json")
+            content = sampler.speedscope(profile_id)
+        with open(path, "w") as output:
+            output.write(content)
+        logger.info("Profiled %s in %.3fs, %d samples, %d other requests in flight, written to %s",
+                    profile_id, sampler.duration, sum(sampler.counts.values()), concurrent, path)
+        self.prune()
+        return path
+
+    def prune(self):
+        # Oldest profiles go first once there are more than keep
+        paths = [os.path.join(self.directory, name) for name in os.listdir(self.directory)]
+        paths.sort(key=os.path.getmtime)
+        for path in paths[:max(len(paths) - self.keep, 0)]:
+            os.remove(path)
+
+
+class ProfilerMiddleware:
+    # Plain ASGI and outermost, so the profile covers every other middleware too
+    def __init__(self, app, profiler: Profiler):
+        self.app = app
+        self.profiler = profiler
+
+    async def __call__(self, scope, receive, send):
+        profiler = self.profiler
+        if scope["type"] != "http" or profiler.active or not profiler.wanted(scope):
+            profiler.in_flight += 1
+            try:
+                await self.app(scope, receive, send)
+            finally:
+                profiler.in_flight -= 1
+            return
+        profiler.active = True
+        profile_id = profiler.profile_id(scope)
+        # Highest number of other requests seen while sampling, each of them adds noise
+        concurrent = profiler.in_flight
+        sampler = StackSampler(threading.get_ident(), profiler.interval)
+
+        async def send_with_id(message):
+            nonlocal concurrent
+            if message["type"] == "http.response.start":
+                message = {**message, "headers": [*message.get("headers", []),
+                                                  (b"x-profile-id", profile_id.encode())]}
+            concurrent = max(concurrent, profiler.in_flight)
+            await send(message)
+        sampler.start()
+        try:
+            await self.app(scope, receive, send_with_id)
+        finally:
+            sampler.stop()
+            profiler.active = False
+            try:
+                await run_in_threadpool(profiler.write, profile_id, sampler, concurrent)
+            except OSError:
+                logger.exception("Could not write profile %s", profile_id)
+
+
+profiler = Profiler()
@@ -1,6 +1,8 @@
 # This file is a data validator / serializer in Django
-from pydantic import BaseModel, Field, ValidationError, conint, confloat, ConfigDict, field_validator
+import json
+from pydantic import BaseModel, Field, ValidationError, conint, confloat, ConfigDict, field_validator, model_validator, create_model, TypeAdapter
 from typing import List, Optional, Dict
+from functools import lru_cache
 from datetime import datetime, date
 from uuid import UUID
 from enum import Enum
@@ -25,6 +27,13 @@ class DishStatusEnum(str, Enum):
     prepared = 'prepared'
     ready = 'ready'
 
+
+class BatchOperationEnum(str, Enum):
+    reserve = 'reserve'
+    create_order = 'create_order'
+    add_dishes = 'add_dishes'
+    serve = 'serve'
+
 # ------------------------ AUTHENTICATION SCHEMAS ------------------------
 
 
@@ -60,6 +69,10 @@ class TableStatusUpdate(BaseModel):
     table_id: conint(ge=0)
 
 
+class TableAllocate(BaseModel):
+    party_size: conint(gt=0)
+
+
 class TableBase(BaseModel):
     capacity: conint(ge=2)
     table_status: TableStatusEnum
@@ -104,6 +117,31 @@ class OrderDetail(BaseModel):
     is_served: bool
 
 
+class BillLine(BaseModel):
+    menu_item_id: UUID
+    item_name: str
+    menu_section_id: conint(ge=0)
+    quantity: conint(ge=0)
+    subtotal: confloat(ge=0)
+
+    model_config = ConfigDict(from_attributes=True)
+
+
+class BillSection(BaseModel):
+    menu_section_id: conint(ge=0)
+    section_name: str
+    item_count: conint(ge=0)
+    subtotal: confloat(ge=0)
+
+
+class Bill(BaseModel):
+    order_id: UUID
+    lines: List[BillLine]
+    sections: List[BillSection]
+    item_count: conint(ge=0)
+    subtotal: confloat(ge=0)
+
+
 class OrderUpdate(BaseModel):
     order_id: UUID
     table_id: conint(ge=0)
@@ -152,14 +190,69 @@ class DishDisplay(BaseModel):
     table_id: conint(ge=0)
     item_name: str
     quantity: conint(ge=0)
+    note: Optional[str] = None
     dish_status: DishStatusEnum
+    ordered_at: Optional[datetime] = None
 
     model_config = ConfigDict(from_attributes=True)
 
 
+class KitchenStationCreate(BaseModel):
+    station_name: str = Field(min_length=1, max_length=255)
+    menu_section_ids: List[conint(ge=0)]
+
+
+class KitchenStation(BaseModel):
+    station_id: int
+    station_name: str
+    menu_section_ids: List[int]
+
+    model_config = ConfigDict(from_attributes=True)
+
+    @model_validator(mode='before')
+    def section_ids(cls, value):
+        # From the ORM object, the section rows are flattened to their ids
+        if isinstance(value, dict):
+            return value
+        return {"station_id": value.station_id, "station_name": value.station_name,
+                "menu_section_ids": sorted(section.menu_section_id for section in value.sections)}
+
+
 class DishStatusUpdate(BaseModel):
     dish_id: UUID
 
+# ------------------------ BATCH SCHEMAS ------------------------
+
+
+class BatchOperation(BaseModel):
+    op: BatchOperationEnum
+    table_id: conint(ge=0)
+    dishes: List[DishCreate] = []
+
+    @model_validator(mode='after')
+    def dishes_required_for_orders(self):
+        if self.op in (BatchOperationEnum.create_order, BatchOperationEnum.add_dishes) and not self.dishes:
+            raise ValueError(
+                'dishes are required for create_order and add_dishes')
+        return self
+
+
+class BatchRequest(BaseModel):
+    operations: List[BatchOperation] = Field(min_length=1, max_length=50)
+
+
+class BatchOperationResult(BaseModel):
+    index: conint(ge=0)
+    op: BatchOperationEnum
+    status_code: int
+    detail: Optional[str] = None
+    data: Optional[object] = None
+
+
+class BatchResult(BaseModel):
+    committed: bool
+    results: List[BatchOperationResult]
+
 # ------------------------ MENU ITEM SCHEMAS ------------------------
 
 
@@ -182,6 +275,10 @@ class MenuItem(MenuItemBase):
     model_config = ConfigDict(from_attributes=True)
 
 
+class MenuItemSearchResult(MenuItem):
+    score: float
+
+
 class ItemBase(BaseModel):
     menu_item_id: UUID
     item_name: str
@@ -213,3 +310,192 @@ class MenuSectionWithItems(MenuSectionBase):
     menu_items: List[ItemBase]
 
     model_config = ConfigDict(from_attributes=True)
+
+# ------------------------ DASHBOARD SCHEMAS ------------------------
+
+
+class Dashboard(BaseModel):
+    tables: Dict[TableStatusEnum, conint(ge=0)]
+    dishes: Dict[DishStatusEnum, conint(ge=0)]
+    open_orders: conint(ge=0)
+    average_wait_seconds: confloat(ge=0)
+    reconciled_at: Optional[datetime] = None
+
+# ------------------------ PREP TIME SCHEMAS ------------------------
+
+
+class PrepStageEnum(str, Enum):
+    prepare = 'prepare'
+    total = 'total'
+
+
+class PrepTimeStats(BaseModel):
+    # Seconds since the dish was received
+    count: conint(ge=0)
+    p50: confloat(ge=0)
+    p90: confloat(ge=0)
+    p99: confloat(ge=0)
+
+
+class MenuItemPrepTime(PrepTimeStats):
+    menu_item_id: UUID
+
+
+class MenuSectionPrepTime(PrepTimeStats):
+    menu_section_id: int
+
+
+class PrepTimes(BaseModel):
+    stage: PrepStageEnum
+    since: date
+    until: date
+    items: List[MenuItemPrepTime]
+    sections: List[MenuSectionPrepTime]
+
+# ------------------------ AUDIT SCHEMAS ------------------------
+
+
+class AuditEntityEnum(str, Enum):
+    table = 'table'
+    order = 'order'
+    dish = 'dish'
+    menu_item = 'menu_item'
+    menu_section = 'menu_section'
+
+
+class AuditEvent(BaseModel):
+    audit_event_id: int
+    event_type: str
+    entity_type: AuditEntityEnum
+    entity_id: str
+    staff_id: Optional[UUID] = None
+    detail: Optional[dict] = None
+    created_at: datetime
+
+    model_config = ConfigDict(from_attributes=True)
+
+    @field_validator('detail', mode='before')
+    def parse_detail(cls, value):
+        # Stored as JSON text
+        if isinstance(value, str):
+            return json.loads(value)
+        return value
+
+# ------------------------ OUTBOX SCHEMAS ------------------------
+
+
+class OutboxStatusEnum(str, Enum):
+    pending = 'pending'
+    applied = 'applied'
+    rejected = 'rejected'
+    failed = 'failed'
+
+
+class OutboxEntry(BaseModel):
+    # order_id is provisional until applied, then it is the id of the order in the database
+    order_id: UUID
+    table_id: conint(ge=0)
+    status: OutboxStatusEnum
+    attempts: conint(ge=0)
+    detail: Optional[str] = None
+    created_at: datetime
+    applied_at: Optional[datetime] = None
+
+
+class OutboxStatus(BaseModel):
+    pending: conint(ge=0)
+    entries: List[OutboxEntry]
+
+# ------------------------ DIAGNOSTICS SCHEMAS ------------------------
+
+
+class MemoryGroupEnum(str, Enum):
+    module = 'module'
+    lineno = 'lineno'
+    traceback = 'traceback'
+
+
+class MemorySnapshot(BaseModel):
+    snapshot_id: str
+    taken_at: datetime
+    rss_bytes: conint(ge=0)
+    traced_bytes: conint(ge=0)
+
+
+class MemoryStatus(BaseModel):
+    # Every worker traces its own memory, pid tells which one answered
+    pid: int
+    tracing: bool
+    frames: conint(ge=1)
+    rss_bytes: conint(ge=0)
+    traced_bytes: conint(ge=0)
+    peak_traced_bytes: conint(ge=0)
+    snapshots: List[MemorySnapshot]
+
+
+class AllocationSite(BaseModel):
+    site: str
+    size_bytes: conint(ge=0)
+    size_diff_bytes: int
+    count: conint(ge=0)
+    count_diff: int
+
+
+class MemoryDiff(BaseModel):
+    since: MemorySnapshot
+    until: MemorySnapshot
+    seconds: float
+    rss_diff_bytes: int
+    group_by: MemoryGroupEnum
+    sites: List[AllocationSite]
+
+
+class LiveObjects(BaseModel):
+    pid: int
+    rss_bytes: conint(ge=0)
+    sessions: conint(ge=0)
+    orm_instances: Dict[str, int]
+    pydantic_instances: Dict[str, int]
+    gc_counts: List[int]
+
+class TransactionStats(BaseModel):
+    committed: conint(ge=0)
+    retried: conint(ge=0)
+    exhausted: conint(ge=0)
+    # Retried and exhausted attempts by error, e.g. deadlock or lock_wait_timeout
+    errors: Dict[str, int]
+
+# ------------------------ SPARSE FIELDSETS ------------------------
+
+
+def parse_fields(model, fields: Optional[str], key: str):
+    # Turn "a,b" into an ordered tuple of known fields, the key is always kept
+    if not fields:
+        return None
+    requested = [name.strip() for name in fields.split(",") if name.strip()]
+    unknown = [name for name in requested if name not in model.model_fields]
+    if unknown:
+        raise ValueError(f"Unknown fields: {', '.join(unknown)}")
+    return tuple(dict.fromkeys([key] + requested))
+
+
+@lru_cache(maxsize=128)
+def partial_model(model, fields: tuple):
+    # Build a model that validates only the requested fields, once per fieldset
+    return create_model(
+        f"{model.__name__}Fields",
+        __config__=ConfigDict(from_attributes=True),
+        **{name: (model.model_fields[name].annotation, model.model_fields[name]) for name in fields}
+    )
+
+
+@lru_cache(maxsize=128)
+def list_adapter(model):
+    # Reusable validator/serializer for a list of the given model
+    return TypeAdapter(List[model])
+
+
+def dump_rows(model, rows):
+    # Validate ORM objects or rows and serialize them straight to JSON bytes
+    adapter = list_adapter(model)
+    return adapter.dump_json(adapter.validate_python(rows, from_attributes=True))
@@ -0,0 +1,153 @@
+# This file keeps an in-memory trigram index over menu item names and notes for as-you-type search
+import re
+import threading
+import unicodedata
+from collections import Counter
+from sqlalchemy.orm import Session
+
+from . import models
+from .events import event_bus
+from .tenancy import TenantRegistry
+
+# Share of the query's trigrams a name must contain to count as a match, low enough for a typo or two
+MIN_NAME_MATCH = 0.3
+MIN_NOTE_MATCH = 0.6
+NOTE_WEIGHT = 0.4
+PREFIX_BONUS = 0.5
+WORD = re.compile(r"[a-z0-9]+")
+
+
+def normalize(text: str):
+    # Lowercase and drop accents, "Crème brûlée" is found by "creme brulee"
+    decomposed = unicodedata.normalize("NFKD", text or "")
+    return "".join(char for char in decomposed if not unicodedata.combining(char)).lower()
+
+
+def trigrams(text: str, partial_last_word: bool = False):
+    # Words padded like pg_trgm, two spaces in front and one behind. The word still being typed
+    # gets no trailing pad, so a prefix matches as well as the whole word
+    words = WORD.findall(normalize(text))
+    grams = set()
+    for position, word in enumerate(words):
+        trailing = "" if partial_last_word and position == len(words) - 1 else " "
+        padded = f"  {word}{trailing}"
+        grams.update(padded[index:index + 3] for index in range(len(padded) - 2))
+    return grams
+
+
+class MenuSearchIndex:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.items = {}
+            self.name_grams = {}
+            self.note_grams = {}
+            self.name_postings = {}
+            self.note_postings = {}
+
+    # ------------------------ UPDATES ------------------------
+
+    def rebuild(self, db: Session):
+        # Full build from the menu snapshot
+        items = db.query(models.MenuItem).all()
+        self.reset()
+        for item in items:
+            self.upsert(item.menu_item_id, item.item_name, item.note, item.price, item.menu_section_id)
+        return len(items)
+
+    def upsert(self, menu_item_id, item_name: str, note, price: float, menu_section_id: int):
+        with self.lock:
+            self.discard(menu_item_id)
+            self.items[menu_item_id] = {
+                "menu_item_id": menu_item_id,
+                "item_name": item_name,
+                "note": note,
+                "price": price,
+                "menu_section_id": menu_section_id,
+                "normalized_name": normalize(item_name),
+            }
+            self.name_grams[menu_item_id] = trigrams(item_name)
+            self.note_grams[menu_item_id] = trigrams(note)
+            for gram in self.name_grams[menu_item_id]:
+                self.name_postings.setdefault(gram, set()).add(menu_item_id)
+            for gram in self.note_grams[menu_item_id]:
+                self.note_postings.setdefault(gram, set()).add(menu_item_id)
+
+    def remove(self, menu_item_id):
+        with self.lock:
+            self.discard(menu_item_id)
+
+    def remove_section(self, menu_section_id: int):
+        with self.lock:
+            for menu_item_id in [key for key, item in self.items.items()
+                                 if item["menu_section_id"] == menu_section_id]:
+                self.discard(menu_item_id)
+
+    def discard(self, menu_item_id):
+        # Caller holds the lock
+        if self.items.pop(menu_item_id, None) is None:
+            return
+        for grams, postings in ((self.name_grams, self.name_postings), (self.note_grams, self.note_postings)):
+            for gram in grams.pop(menu_item_id, ()):
+                postings[gram].discard(menu_item_id)
+                if not postings[gram]:
+                    del postings[gram]
+
+    # ------------------------ SEARCH ------------------------
+
+    def search(self, query: str, limit: int = 10):
+        # Ranked by trigram similarity of the name, then of the note, with a bonus for prefixes
+        grams = trigrams(query, partial_last_word=True)
+        if not grams:
+            return []
+        needle = normalize(query).strip()
+        with self.lock:
+            name_hits = Counter()
+            note_hits = Counter()
+            for gram in grams:
+                name_hits.update(self.name_postings.get(gram, ()))
+                note_hits.update(self.note_postings.get(gram, ()))
+            results = []
+            for menu_item_id in name_hits.keys() | note_hits.keys():
+                name_share = name_hits[menu_item_id] / len(grams)
+                note_share = note_hits[menu_item_id] / len(grams)
+                if name_share < MIN_NAME_MATCH and note_share < MIN_NOTE_MATCH:
+                    continue
+                item = self.items[menu_item_id]
+                # Jaccard similarity, so a short exact name beats a long one that merely contains the query
+                name_size = len(self.name_grams[menu_item_id])
+                score = name_hits[menu_item_id] / (len(grams) + name_size - name_hits[menu_item_id])
+                if note_share >= MIN_NOTE_MATCH:
+                    score += NOTE_WEIGHT * note_share
+                name = item["normalized_name"]
+                if name.startswith(needle) or f" {needle}" in name:
+                    score += PREFIX_BONUS
+                results.append((score, item))
+        results.sort(key=lambda result: (-result[0], result[1]["item_name"]))
+        return [{**{key: value for key, value in item.items() if key != "normalized_name"},
+                 "score": round(score, 3)} for score, item in results[:limit]]
+
+
+# One index per restaurant, each site has its own menu
+menu_search = TenantRegistry(MenuSearchIndex)
+
+# ------------------------ EVENT HANDLERS ------------------------
+
+
+def on_menu_changed(item):
+    payload = item.payload
+    action = payload["action"]
+    index = menu_search.get(payload["restaurant_id"])
+    if action in ("item_created", "item_updated"):
+        index.upsert(payload["menu_item_id"], payload["item_name"], payload["note"],
+                     payload["price"], payload["menu_section_id"])
+    elif action == "item_deleted":
+        index.remove(payload["menu_item_id"])
+    elif action == "section_deleted":
+        index.remove_section(payload["menu_section_id"])
+
+
+event_bus.on_commit(["menu_changed"], on_menu_changed)
@@ -0,0 +1,104 @@
+# This file is the production entry point: python -m app.serve (from the backend folder)
+import os
+import json
+import logging
+import importlib.util
+import uvicorn
+from dotenv import load_dotenv
+
+# Load variables from constants
+load_dotenv()
+HOST = os.getenv("HOST", "0.0.0.0")
+PORT = int(os.getenv("PORT", 8000))
+# Longer than the load balancer's idle timeout, so it never reuses a connection we already closed
+KEEP_ALIVE_SECONDS = int(os.getenv("KEEP_ALIVE_SECONDS", 75))
+BACKLOG = int(os.getenv("BACKLOG", 2048))
+GRACEFUL_TIMEOUT_SECONDS = int(os.getenv("GRACEFUL_TIMEOUT_SECONDS", 30))
+# MySQL's default max_connections, minus what admin sessions and tools.bulk_load need
+DB_MAX_CONNECTIONS = int(os.getenv("DB_MAX_CONNECTIONS", 151))
+DB_RESERVED_CONNECTIONS = int(os.getenv("DB_RESERVED_CONNECTIONS", 11))
+# Every worker keeps pools per shard (DB_URL plus SHARD_URLS, see app.database). The budget assumes the worst,
+# all shards on the one server DB_MAX_CONNECTIONS describes
+SHARD_COUNT = 1 + len(json.loads(os.getenv("SHARD_URLS") or "{}"))
+# Each shard has a sync engine for the writes and an async one for the polling reads, each with its own pool
+POOLS_PER_SHARD = 2
+logger = logging.getLogger(__name__)
+
+
+def cpu_count():
+    # CPUs this process may run on, which can be fewer than the machine has in a container
+    if hasattr(os, "sched_getaffinity"):
+        return len(os.sched_getaffinity(0))
+    return os.cpu_count() or 1
+
+
+def worker_count():
+    # One worker unless WEB_CONCURRENCY says otherwise. The response cache, live counters, prep times, menu search
+    # and vacant table index live in each process and only hear about writes that process committed, so more
+    # workers (up to cpu_count()) trade that freshness for throughput, see CACHE_TTL_SECONDS
+    return int(os.getenv("WEB_CONCURRENCY", 1))
+
+
+def pool_budget(workers: int, shards: int = SHARD_COUNT, max_connections: int = DB_MAX_CONNECTIONS,
+                reserved: int = DB_RESERVED_CONNECTIONS):
+    # Split the database's connection limit over the pools: (pool_size, max_overflow) per worker, shard and engine
+    pools = workers * shards * POOLS_PER_SHARD
+    per_pool = (max_connections - reserved) // pools
+    if per_pool < 2:
+        # A floor here would hand out more connections than the database allows
+        raise ValueError(f"{workers} workers with {shards} shards need at least {2 * pools + reserved} database "
+                         f"connections, DB_MAX_CONNECTIONS is {max_connections}; lower WEB_CONCURRENCY")
+    overflow = per_pool // 4
+    return per_pool - overflow, overflow
+
+
+def pool_settings(workers: int, shards: int = SHARD_COUNT, environ=os.environ):
+    # The budget, or DB_POOL_SIZE and DB_MAX_OVERFLOW from .env or the shell when they fit in it
+    pool_size, max_overflow = pool_budget(workers, shards)
+    preset = int(environ.get("DB_POOL_SIZE", pool_size)), int(environ.get("DB_MAX_OVERFLOW", max_overflow))
+    if sum(preset) > pool_size + max_overflow:
+        raise ValueError(f"DB_POOL_SIZE + DB_MAX_OVERFLOW is {sum(preset)}, {workers} workers can each have "
+                         f"{pool_size + max_overflow} per pool; lower them or unset them")
+    return preset
+
+
+def installed(module: str):
+    return importlib.util.find_spec(module) is not None
+
+
+def server_options(workers: int):
+    loop = "uvloop" if installed("uvloop") else "asyncio"
+    http = "httptools" if installed("httptools") else "h11"
+    if loop != "uvloop" or http != "httptools":
+        logger.warning("uvloop/httptools missing, falling back to %s and %s", loop, http)
+    return {
+        "host": HOST,
+        "port": PORT,
+        "workers": workers,
+        "loop": loop,
+        "http": http,
+        "backlog": BACKLOG,
+        "timeout_keep_alive": KEEP_ALIVE_SECONDS,
+        "timeout_graceful_shutdown": GRACEFUL_TIMEOUT_SECONDS,
+        "proxy_headers": True,
+        "access_log": False,
+    }
+
+
+def main():
+    workers = worker_count()
+    if workers > cpu_count():
+        logger.warning("%d workers on %d CPUs, they will compete for the same cores", workers, cpu_count())
+    pool_size, max_overflow = pool_settings(workers)
+    # Workers are spawned processes, they read these when app.database is imported
+    os.environ["DB_POOL_SIZE"] = str(pool_size)
+    os.environ["DB_MAX_OVERFLOW"] = str(max_overflow)
+    os.environ.setdefault("DB_ECHO", "false")
+    logger.info("Starting %d workers, %d+%d database connections per pool, %d pools per shard", workers, pool_size,
+                max_overflow, POOLS_PER_SHARD)
+    uvicorn.run("app.main:app", **server_options(workers))
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    main()
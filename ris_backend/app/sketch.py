@@ -0,0 +1,133 @@
+# This file keeps kitchen prep-time distributions in mergeable quantile sketches, one per day
+import os
+import math
+import threading
+from collections import Counter
+from datetime import datetime, timedelta
+from sqlalchemy.orm import Session
+from dotenv import load_dotenv
+
+from . import models
+from .events import event_bus
+from .tenancy import TenantRegistry
+
+# Load variables from constants
+load_dotenv()
+PREP_TIME_DAYS = int(os.getenv("PREP_TIME_DAYS", 30))
+SKETCH_ACCURACY = 0.01
+# Stage durations measured from the moment a dish is received
+STAGES = {"prepared": "prepare", "ready": "total"}
+
+
+class QuantileSketch:
+    # Log-bucketed sketch (DDSketch): every quantile is within SKETCH_ACCURACY of the true value,
+    # memory grows with the log of the value range and two sketches merge by adding bucket counts
+    def __init__(self, accuracy: float = SKETCH_ACCURACY):
+        self.accuracy = accuracy
+        self.gamma = (1 + accuracy) / (1 - accuracy)
+        self.log_gamma = math.log(self.gamma)
+        self.buckets = Counter()
+        # Durations under a second are not worth a bucket of their own
+        self.zero_count = 0
+        self.count = 0
+
+    def add(self, value: float, count: int = 1):
+        if value < 1:
+            self.zero_count += count
+        else:
+            self.buckets[math.ceil(math.log(value) / self.log_gamma)] += count
+        self.count += count
+
+    def merge(self, other: "QuantileSketch"):
+        if other.accuracy != self.accuracy:
+            raise ValueError("Only sketches with the same accuracy can be merged")
+        self.buckets.update(other.buckets)
+        self.zero_count += other.zero_count
+        self.count += other.count
+        return self
+
+    def quantile(self, q: float):
+        if not self.count:
+            return None
+        rank = q * (self.count - 1)
+        seen = self.zero_count
+        if rank < seen:
+            return 0.0
+        for index in sorted(self.buckets):
+            seen += self.buckets[index]
+            if rank < seen:
+                # Middle of the bucket, within accuracy of anything that fell in it
+                return 2 * self.gamma ** index / (self.gamma + 1)
+        return 2 * self.gamma ** max(self.buckets) / (self.gamma + 1)
+
+
+class PrepTimes:
+    # Sketches keyed by (day, stage, scope, key), scope is "item" or "section"
+    def __init__(self, days: int = PREP_TIME_DAYS):
+        self.days = days
+        self.sketches = {}
+        self.lock = threading.Lock()
+
+    def reset(self):
+        with self.lock:
+            self.sketches = {}
+
+    def add(self, at: datetime, received_at: datetime, status: str, menu_item_id, menu_section_id):
+        stage = STAGES.get(status)
+        if stage is None or received_at is None:
+            return
+        seconds = max((at - received_at).total_seconds(), 0.0)
+        day = at.date()
+        with self.lock:
+            for scope, key in (("item", menu_item_id), ("section", menu_section_id)):
+                self.sketches.setdefault((day, stage, scope, key), QuantileSketch()).add(seconds)
+
+    def expire(self, today=None):
+        # Days past the retention window are dropped whole
+        oldest = (today or datetime.utcnow().date()) - timedelta(days=self.days - 1)
+        with self.lock:
+            self.sketches = {key: sketch for key, sketch in self.sketches.items() if key[0] >= oldest}
+
+    def merged(self, stage: str, since, until):
+        # One sketch per item and per section, merged over the days in [since, until]
+        result = {"item": {}, "section": {}}
+        with self.lock:
+            for (day, sketch_stage, scope, key), sketch in self.sketches.items():
+                if sketch_stage != stage or not since <= day <= until:
+                    continue
+                result[scope].setdefault(key, QuantileSketch()).merge(sketch)
+        return result
+
+    def rebuild(self, db: Session, today=None):
+        # Refill the retention window from the stored transition timestamps
+        since = datetime.combine((today or datetime.utcnow().date()) - timedelta(days=self.days - 1),
+                                 datetime.min.time())
+        rows = db.query(models.Dish.received_at, models.Dish.prepared_at, models.Dish.ready_at,
+                        models.Dish.menu_item_id, models.MenuItem.menu_section_id)\
+            .join(models.MenuItem, models.Dish.menu_item_id == models.MenuItem.menu_item_id)\
+            .filter(models.Dish.received_at >= since).all()
+        self.reset()
+        for received_at, prepared_at, ready_at, menu_item_id, menu_section_id in rows:
+            if prepared_at is not None:
+                self.add(prepared_at, received_at, "prepared", menu_item_id, menu_section_id)
+            if ready_at is not None:
+                self.add(ready_at, received_at, "ready", menu_item_id, menu_section_id)
+        return len(rows)
+
+
+# One set of sketches per restaurant
+prep_times = TenantRegistry(PrepTimes)
+
+# ------------------------ EVENT HANDLERS ------------------------
+
+
+def on_dish_status_changed(events):
+    # Runs on an event worker, off the request path
+    for item in events:
+        payload = item.payload
+        sketches = prep_times.get(payload["restaurant_id"])
+        sketches.add(payload["at"], payload["received_at"], payload["new"],
+                     payload["menu_item_id"], payload["menu_section_id"])
+
+
+event_bus.subscribe(["dish_status_changed"], on_dish_status_changed)
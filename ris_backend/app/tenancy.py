@@ -0,0 +1,68 @@
+# This file scopes sessions to one restaurant, and keeps in-memory structures per restaurant
+import threading
+from sqlalchemy import event
+from sqlalchemy.orm import Session, with_loader_criteria
+
+from .database import TENANT_KEY
+from .models import TenantMixin
+
+# ------------------------ SESSION HOOKS ------------------------
+
+
+# One option per restaurant, building it on every statement costs more than the lookup it filters
+criteria = {}
+
+
+def restaurant_criteria(restaurant_id: int):
+    option = criteria.get(restaurant_id)
+    if option is None:
+        option = criteria[restaurant_id] = with_loader_criteria(
+            TenantMixin, lambda cls: cls.restaurant_id == restaurant_id, include_aliases=True)
+    return option
+
+
+@event.listens_for(Session, "do_orm_execute")
+def scope_to_restaurant(execute_state):
+    # Every ORM select, update and delete of a scoped session only touches its restaurant's rows
+    restaurant_id = execute_state.session.info.get(TENANT_KEY)
+    if restaurant_id is None or execute_state.is_column_load or execute_state.is_relationship_load:
+        return
+    execute_state.statement = execute_state.statement.options(restaurant_criteria(restaurant_id))
+
+
+@event.listens_for(Session, "before_flush")
+def stamp_restaurant(session, flush_context, instances):
+    # New rows of a scoped session belong to its restaurant
+    restaurant_id = session.info.get(TENANT_KEY)
+    if restaurant_id is None:
+        return
+    for instance in session.new:
+        if isinstance(instance, TenantMixin) and instance.restaurant_id is None:
+            instance.restaurant_id = restaurant_id
+
+# ------------------------ PER RESTAURANT STATE ------------------------
+
+
+class TenantRegistry:
+    # One instance of an in-memory structure per restaurant, made on first use
+    def __init__(self, factory):
+        self.factory = factory
+        self.instances = {}
+        self.lock = threading.Lock()
+
+    def get(self, restaurant_id: int):
+        instance = self.instances.get(restaurant_id)
+        if instance is None:
+            with self.lock:
+                instance = self.instances.get(restaurant_id)
+                if instance is None:
+                    instance = self.instances[restaurant_id] = self.factory()
+        return instance
+
+    def items(self):
+        with self.lock:
+            return list(self.instances.items())
+
+    def reset(self):
+        with self.lock:
+            self.instances = {}
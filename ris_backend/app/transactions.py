@@ -0,0 +1,95 @@
+# This file runs write transactions as one unit, retried whole when they lose a deadlock or a lock wait
+import os
+import time
+import random
+import logging
+import threading
+from collections import Counter
+from fastapi import HTTPException
+from sqlalchemy.exc import DBAPIError
+from sqlalchemy.orm import Session
+from dotenv import load_dotenv
+
+# Load variables from constants
+load_dotenv()
+# Attempts per transaction, the first one included
+TX_ATTEMPTS = int(os.getenv("TX_ATTEMPTS", 4))
+# Backoff before retry n is drawn from [0, min(base * 2 ** (n - 1), max)], so contending requests spread out
+TX_BASE_DELAY = float(os.getenv("TX_BASE_DELAY", 0.01))
+TX_MAX_DELAY = float(os.getenv("TX_MAX_DELAY", 0.2))
+# Seconds one request may spend on retries, well below the time a tablet waits before it resends
+TX_RETRY_BUDGET = float(os.getenv("TX_RETRY_BUDGET", 1.0))
+logger = logging.getLogger(__name__)
+
+# MySQL error codes, InnoDB already rolled the deadlock victim back
+MYSQL_ERRORS = {1213: "deadlock", 1205: "lock_wait_timeout"}
+SQLITE_ERRORS = {"database is locked": "sqlite_locked", "database table is locked": "sqlite_locked"}
+
+
+def retryable_error(exc: Exception):
+    # Name of the transient lock error behind exc, None when retrying would not help
+    if not isinstance(exc, DBAPIError) or exc.connection_invalidated:
+        return None
+    args = getattr(exc.orig, "args", ())
+    if args and isinstance(args[0], int):
+        return MYSQL_ERRORS.get(args[0])
+    return SQLITE_ERRORS.get(str(exc.orig))
+
+
+class TransactionRunner:
+    # Stats are per worker and shared by the request threads
+    def __init__(self, attempts: int = TX_ATTEMPTS, base_delay: float = TX_BASE_DELAY,
+                 max_delay: float = TX_MAX_DELAY, budget: float = TX_RETRY_BUDGET):
+        self.attempts = attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.budget = budget
+        self.stats = {}
+        self.lock = threading.Lock()
+
+    def count(self, name: str, outcome: str, error: str = None):
+        with self.lock:
+            stats = self.stats.setdefault(name, {"committed": 0, "retried": 0, "exhausted": 0, "errors": Counter()})
+            stats[outcome] += 1
+            if error is not None:
+                stats["errors"][error] += 1
+
+    def delay(self, attempt: int):
+        return random.uniform(0, min(self.base_delay * 2 ** (attempt - 1), self.max_delay))
+
+    def run(self, db: Session, work, name: str):
+        # Runs work() and commits, returns what work() returned. work must only touch the database through db,
+        # everything it did is rolled back and done again on a retry. Post-commit events fire once, on the commit
+        deadline = time.monotonic() + self.budget
+        attempt = 1
+        while True:
+            try:
+                result = work()
+                db.commit()
+                self.count(name, "committed")
+                return result
+            except DBAPIError as exc:
+                db.rollback()
+                error = retryable_error(exc)
+                if error is None:
+                    raise
+                delay = self.delay(attempt)
+                if attempt >= self.attempts or time.monotonic() + delay > deadline:
+                    self.count(name, "exhausted", error)
+                    logger.warning("%s gave up after %d attempts: %s", name, attempt, exc.orig)
+                    raise HTTPException(status_code=503, detail="Database busy, please retry",
+                                        headers={"Retry-After": "1"}) from exc
+                self.count(name, "retried", error)
+                logger.info("%s hit %s, retrying in %.3fs", name, error, delay)
+                time.sleep(delay)
+                attempt += 1
+            except Exception:
+                db.rollback()
+                raise
+
+    def snapshot(self):
+        with self.lock:
+            return {name: {**stats, "errors": dict(stats["errors"])} for name, stats in self.stats.items()}
+
+
+transactions = TransactionRunner()
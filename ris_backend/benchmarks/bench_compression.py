@@ -0,0 +1,64 @@
+# This file compares the CPU cost per request of serving the menu with and without the compressed response cache
+# Run from the backend folder: python -m benchmarks.bench_compression
+import time
+import argparse
+from uuid import uuid4
+from app import schemas
+from app.cache import CachedBody, compress, supported_encodings
+
+
+def build_menu(sections: int, items_per_section: int):
+    # Synthetic payload shaped like GET /users/manager/menu-sections
+    menu = [schemas.MenuSectionWithItems(
+        menu_section_id=section_id,
+        section_name=f"Section {section_id}",
+        menu_items=[schemas.ItemBase(
+            menu_item_id=uuid4(),
+            item_name=f"Item {section_id}-{item_id}",
+            note="Served with seasonal vegetables and house sauce",
+            price=4.5 + item_id
+        ) for item_id in range(items_per_section)]
+    ) for section_id in range(sections)]
+    return menu
+
+
+def cpu_per_request(handler, requests: int):
+    # CPU seconds spent per call, in microseconds
+    start = time.process_time()
+    for _ in range(requests):
+        handler()
+    return (time.process_time() - start) / requests * 1e6
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Menu response compression benchmark")
+    parser.add_argument("--sections", type=int, default=8)
+    parser.add_argument("--items", type=int, default=25)
+    parser.add_argument("--requests", type=int, default=2000)
+    args = parser.parse_args()
+
+    menu = build_menu(args.sections, args.items)
+    adapter = schemas.list_adapter(schemas.MenuSectionWithItems)
+    body = adapter.dump_json(menu)
+    print(f"payload: {len(body)} bytes, {args.requests} requests per case")
+    print(f"{'case':<34}{'us/request':>12}{'bytes':>10}")
+
+    def report(case, handler, size):
+        print(f"{case:<34}{cpu_per_request(handler, args.requests):>12.1f}{size:>10}")
+
+    report("serialize, identity", lambda: adapter.dump_json(menu), len(body))
+    for encoding in supported_encodings():
+        size = len(compress(body, encoding))
+        report(f"serialize + {encoding} per request",
+               lambda: compress(adapter.dump_json(menu), encoding), size)
+
+        cached = CachedBody(body)
+        cached.encoded(encoding)
+        report(f"cached {encoding} body",
+               lambda: cached.response(encoding), size)
+    cached = CachedBody(body)
+    report("cached identity body", lambda: cached.response(None), len(body))
+
+
+if __name__ == "__main__":
+    main()
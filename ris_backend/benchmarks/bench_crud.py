@@ -0,0 +1,100 @@
+# This file compares the Python overhead per call of the hot crud lookups, legacy Query against prebuilt select()
+# Run from the backend folder: python -m benchmarks.bench_crud
+import os
+import time
+import uuid
+import argparse
+from datetime import datetime, date
+
+# An in-memory database, only the Python side of each call is of interest
+os.environ.setdefault("DB_URL", "sqlite://")
+os.environ.setdefault("DB_ECHO", "false")
+
+from sqlalchemy import create_engine  # noqa: E402
+from sqlalchemy.orm import Session, selectinload  # noqa: E402
+from app import crud, models  # noqa: E402
+from app.database import TENANT_KEY  # noqa: E402
+
+
+def seed(db: Session):
+    staff_id = uuid.uuid4()
+    db.add(models.StaffRole(role_id=1, role_name="Waiter"))
+    db.add(models.StaffAccount(staff_id=staff_id, role_id=1, username="waiter", password="-", full_name="Waiter",
+                               gender="male", dob=date(1990, 1, 1), created_at=datetime.utcnow()))
+    db.add(models.MenuSection(menu_section_id=1, section_name="Main Courses"))
+    item = models.MenuItem(menu_section_id=1, item_name="Beef Steak", price=15.0)
+    db.add(item)
+    db.add(models.Table(table_id=1, capacity=4, table_status="eating"))
+    db.flush()
+    order = models.Order(table_id=1, staff_id=staff_id, created_at=datetime.utcnow())
+    db.add(order)
+    db.flush()
+    dish = models.Dish(order_id=order.order_id, staff_id=staff_id, menu_item_id=item.menu_item_id,
+                       quantity=1, total=15.0, received_at=datetime.utcnow())
+    db.add(dish)
+    db.commit()
+    return item.menu_item_id, order.order_id, dish.dish_id
+
+
+def legacy_lookups(menu_item_id, order_id, dish_id):
+    # The db.query(...).filter(...) form every lookup used before
+    return {
+        "get_user": lambda db: db.query(models.StaffAccount).filter(models.StaffAccount.username == "waiter").first(),
+        "get_table": lambda db: db.query(models.Table).filter(models.Table.table_id == 1).first(),
+        "get_menu_item": lambda db: db.query(models.MenuItem).filter(
+            models.MenuItem.menu_item_id == menu_item_id).first(),
+        "get_dish": lambda db: db.query(models.Dish).filter(models.Dish.dish_id == dish_id).first(),
+        "get_order": lambda db: db.query(models.Order).filter(models.Order.order_id == order_id).first(),
+        "get_dish_by_order": lambda db: db.query(models.Dish).filter(models.Dish.order_id == order_id)
+        .options(selectinload(models.Dish.menu_item)).all(),
+    }
+
+
+def prebuilt_lookups(menu_item_id, order_id, dish_id):
+    return {
+        "get_user": lambda db: crud.get_user(db, "waiter"),
+        "get_table": lambda db: crud.get_table(db, 1),
+        "get_menu_item": lambda db: crud.get_menu_item(db, menu_item_id),
+        "get_dish": lambda db: crud.get_dish(db, dish_id),
+        "get_order": lambda db: crud.get_order(db, order_id),
+        "get_dish_by_order": lambda db: crud.get_dish_by_order(db, order_id),
+    }
+
+
+def cpu_per_call(lookup, db: Session, calls: int):
+    # CPU seconds spent per call, in microseconds
+    lookup(db)
+    start = time.process_time()
+    for _ in range(calls):
+        lookup(db)
+    return (time.process_time() - start) / calls * 1e6
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Hot crud lookup overhead benchmark")
+    parser.add_argument("--calls", type=int, default=5000)
+    parser.add_argument("--unscoped", action="store_true",
+                        help="Run without the restaurant filter that request sessions carry")
+    args = parser.parse_args()
+
+    engine = create_engine("sqlite://")
+    models.Base.metadata.create_all(bind=engine)
+    with Session(bind=engine) as db:
+        ids = seed(db)
+    legacy = legacy_lookups(*ids)
+    prebuilt = prebuilt_lookups(*ids)
+
+    with Session(bind=engine) as db:
+        if not args.unscoped:
+            db.info[TENANT_KEY] = 1
+        print(f"{args.calls} calls per case, {'unscoped' if args.unscoped else 'restaurant scoped'} session")
+        print(f"{'lookup':<20}{'query us':>10}{'select us':>11}{'saved':>8}")
+        for name in legacy:
+            before = cpu_per_call(legacy[name], db, args.calls)
+            after = cpu_per_call(prebuilt[name], db, args.calls)
+            print(f"{name:<20}{before:>10.1f}{after:>11.1f}{1 - after / before:>8.0%}")
+    engine.dispose()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,229 @@
+# This file sets up an isolated SQLite test database, every test runs inside a transaction that is rolled back
+import os
+import re
+import uuid
+import tempfile
+import pytest
+import aiosqlite
+from sqlalchemy import create_engine, event
+from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine
+from sqlalchemy.orm import Session
+from sqlalchemy.pool import NullPool
+
+# Point the app at a per-worker SQLite file before anything imports app.database
+WORKER = os.getenv("PYTEST_XDIST_WORKER", "main")
+TEST_DB_PATH = os.path.join(tempfile.gettempdir(), f"ris_test_{os.getpid()}_{WORKER}.db")
+os.environ["DB_URL"] = f"sqlite:///{TEST_DB_PATH}"
+
+from app import models, crud  # noqa: E402
+from app.database import Base, TENANT_KEY  # noqa: E402
+from app.cache import response_cache  # noqa: E402
+from app.counters import live_counters  # noqa: E402
+from app.events import event_bus  # noqa: E402
+from app.audit import audit_log  # noqa: E402
+from app.sketch import prep_times  # noqa: E402
+from app.search import menu_search  # noqa: E402
+from app.allocation import vacant_tables  # noqa: E402
+
+INIT_SQL_PATH = os.path.join(os.path.dirname(os.path.dirname(os.path.dirname(__file__))), "init.sql")
+
+# Seeded accounts from init.sql
+WAITER_ID = uuid.UUID("550e8400-e29b-41d4-a716-446655440000")
+CHEF_ID = uuid.UUID("550e8400-e29b-41d4-a716-446655440001")
+MANAGER_ID = uuid.UUID("550e8400-e29b-41d4-a716-446655440002")
+SEED_ORDER_ID = uuid.UUID("550e8400-e29b-41d4-a716-446655440023")
+BEEF_STEAK_ID = uuid.UUID("550e8400-e29b-41d4-a716-446655440003")
+CAESAR_SALAD_ID = uuid.UUID("550e8400-e29b-41d4-a716-446655440008")
+COCA_COLA_ID = uuid.UUID("550e8400-e29b-41d4-a716-446655440018")
+RESTAURANT_ID = 1
+
+# ------------------------ SQLITE SHIMS ------------------------
+
+
+def uuid_to_bin(value):
+    # MySQL's UUID_TO_BIN, so the seed rows in init.sql load unchanged
+    return uuid.UUID(value).bytes
+
+
+def create_test_engine(path: str):
+    engine = create_engine(f"sqlite:///{path}", connect_args={"check_same_thread": False})
+
+    @event.listens_for(engine, "connect")
+    def on_connect(dbapi_connection, connection_record):
+        dbapi_connection.create_function("UUID_TO_BIN", 1, uuid_to_bin)
+        # pysqlite's own transaction handling breaks SAVEPOINT, SQLAlchemy emits BEGIN instead
+        dbapi_connection.isolation_level = None
+        # MySQL enforces foreign keys, so should the tests
+        dbapi_connection.execute("PRAGMA foreign_keys = ON")
+
+    @event.listens_for(engine, "begin")
+    def on_begin(connection):
+        connection.exec_driver_sql("BEGIN")
+
+    return engine
+
+
+class SharedConnection:
+    # The test's SQLite connection as aiosqlite sees it. The outer transaction belongs to the connection
+    # fixture, so async sessions read and write inside it but cannot commit, roll back or close it
+    def __init__(self, dbapi_connection):
+        object.__setattr__(self, "dbapi_connection", dbapi_connection)
+
+    def __getattr__(self, name):
+        return getattr(self.dbapi_connection, name)
+
+    def __setattr__(self, name, value):
+        setattr(self.dbapi_connection, name, value)
+
+    def commit(self):
+        pass
+
+    def rollback(self):
+        pass
+
+    def close(self):
+        pass
+
+
+def seed_statements():
+    # The INSERT and UPDATE statements of init.sql, the schema itself comes from the models
+    with open(INIT_SQL_PATH) as init_sql:
+        script = re.sub(r"--[^\n]*", "", init_sql.read())
+    return [statement.strip() for statement in script.split(";")
+            if statement.strip().upper().startswith(("INSERT", "UPDATE"))]
+
+# ------------------------ DATABASE FIXTURES ------------------------
+
+
+@pytest.fixture(scope="session")
+def engine():
+    # One schema and seed per worker, reused by every test on that worker
+    engine = create_test_engine(TEST_DB_PATH)
+    Base.metadata.drop_all(bind=engine)
+    Base.metadata.create_all(bind=engine)
+    with engine.begin() as connection:
+        for statement in seed_statements():
+            connection.exec_driver_sql(statement)
+    with Session(bind=engine) as db:
+        crud.rebuild_kitchen_tickets(db)
+        db.commit()
+    yield engine
+    engine.dispose()
+    os.remove(TEST_DB_PATH)
+
+
+@pytest.fixture
+def connection(engine):
+    # Outer transaction rolled back after the test, whatever the endpoints commit
+    connection = engine.connect()
+    transaction = connection.begin()
+    yield connection
+    transaction.rollback()
+    connection.close()
+
+
+@pytest.fixture
+def session_factory(connection):
+    # Sessions that commit into SAVEPOINTs of the outer transaction, scoped to a restaurant like the router's
+    def make_session(restaurant_id: int = RESTAURANT_ID):
+        session = Session(bind=connection, autoflush=False, join_transaction_mode="create_savepoint")
+        session.info[TENANT_KEY] = restaurant_id
+        return session
+    return make_session
+
+
+@pytest.fixture
+def async_session_factory(connection):
+    # AsyncSessions on the same connection, so they see what the test wrote and are rolled back with it
+    shared = SharedConnection(connection.connection.dbapi_connection)
+
+    def connect():
+        async_connection = aiosqlite.Connection(lambda: shared, 64)
+        async_connection.daemon = True
+        return async_connection
+    async_engine = create_async_engine("sqlite+aiosqlite://", async_creator=connect, poolclass=NullPool,
+                                       pool_reset_on_return=None)
+
+    def make_session(restaurant_id: int = RESTAURANT_ID):
+        session = AsyncSession(bind=async_engine, autoflush=False, expire_on_commit=False)
+        session.info[TENANT_KEY] = restaurant_id
+        return session
+    return make_session
+
+
+@pytest.fixture
+def db(session_factory):
+    session = session_factory()
+    yield session
+    session.close()
+
+
+@pytest.fixture(autouse=True)
+def reset_in_memory_state():
+    # In-memory state is not covered by the rollback
+    response_cache.clear()
+    live_counters.reset()
+    prep_times.reset()
+    menu_search.reset()
+    vacant_tables.reset()
+    yield
+    event_bus.clear()
+    audit_log.clear()
+    response_cache.clear()
+    live_counters.reset()
+    prep_times.reset()
+    menu_search.reset()
+    vacant_tables.reset()
+
+# ------------------------ API FIXTURES ------------------------
+
+
+@pytest.fixture
+def client(session_factory, async_session_factory):
+    from fastapi import Request
+    from fastapi.testclient import TestClient
+    from app.main import app, get_db, get_async_db, tenant_from_request
+
+    def override_get_db(request: Request):
+        db = session_factory(tenant_from_request(request))
+        try:
+            yield db
+        finally:
+            db.close()
+
+    async def override_get_async_db(request: Request):
+        db = async_session_factory(tenant_from_request(request))
+        try:
+            yield db
+        finally:
+            await db.close()
+
+    app.dependency_overrides[get_db] = override_get_db
+    app.dependency_overrides[get_async_db] = override_get_async_db
+    # Audit batches go into the test transaction too
+    audit_log.session_factory = session_factory
+    yield TestClient(app)
+    app.dependency_overrides.clear()
+    audit_log.session_factory = None
+
+
+def auth_headers(username: str, role_id: int, restaurant_id: int = RESTAURANT_ID):
+    # Mint the token directly, bcrypt in every test would dominate the runtime
+    token = crud.create_access_token(data={"username": username, "role_id": role_id,
+                                           "restaurant_id": restaurant_id})
+    return {"Authorization": f"Bearer {token}"}
+
+
+@pytest.fixture
+def waiter_headers():
+    return auth_headers("waiter", 1)
+
+
+@pytest.fixture
+def chef_headers():
+    return auth_headers("chef", 2)
+
+
+@pytest.fixture
+def manager_headers():
+    return auth_headers("manager", 3)
@@ -0,0 +1,106 @@
+import asyncio
+import pytest
+from app.admission import (AdmissionController, Overloaded, classify, request_role, admission,
+                           CRITICAL, NORMAL, LOW)
+from test_case.conftest import auth_headers
+
+# ------------------------ CLASSIFICATION TESTS ------------------------
+
+
+def test_classify_by_role_and_method():
+    assert classify("POST", "/users/waiter/create-order", 1) == CRITICAL
+    assert classify("PUT", "/users/chef/dishes/status-update", 2) == CRITICAL
+    assert classify("GET", "/users/waiter/tables", 1) == NORMAL
+    assert classify("GET", "/users/manager/menu-sections", 3) == LOW
+    assert classify("POST", "/login", None) == LOW
+
+
+def test_request_role_from_token():
+    headers = {b"authorization": auth_headers("chef", 2)["Authorization"].encode()}
+    assert request_role(headers) == 2
+    assert request_role({b"authorization": b"Bearer not-a-token"}) is None
+    assert request_role({}) is None
+
+# ------------------------ CONTROLLER TESTS ------------------------
+
+
+def test_queued_requests_are_admitted_by_priority():
+    async def scenario():
+        controller = AdmissionController(concurrency=1, deadlines={CRITICAL: 1, NORMAL: 1, LOW: 1})
+        await controller.acquire(NORMAL)
+        order = []
+
+        async def request(name):
+            await controller.acquire(name)
+            order.append(name)
+            controller.release(name)
+        tasks = [asyncio.create_task(request(name)) for name in (LOW, NORMAL, CRITICAL)]
+        await asyncio.sleep(0.01)
+        controller.release(NORMAL)
+        await asyncio.gather(*tasks)
+        return order, controller
+    order, controller = asyncio.run(scenario())
+    assert order == [CRITICAL, NORMAL, LOW]
+    assert controller.total_in_flight() == 0
+
+
+def test_low_priority_share_is_capped():
+    async def scenario():
+        controller = AdmissionController(concurrency=8, deadlines={CRITICAL: 1, NORMAL: 1, LOW: 0.01})
+        for _ in range(2):
+            await controller.acquire(LOW)
+        with pytest.raises(Overloaded):
+            await controller.acquire(LOW)
+        # The rest of the capacity is still there for the kitchen
+        await controller.acquire(CRITICAL)
+        return controller
+    controller = asyncio.run(scenario())
+    assert controller.stats[LOW]["timed_out"] == 1
+    assert controller.in_flight == {CRITICAL: 1, NORMAL: 0, LOW: 2}
+
+
+def test_low_priority_is_shed_when_queues_are_slow():
+    async def scenario():
+        controller = AdmissionController(concurrency=1, latency_target=0.1)
+        await controller.acquire(CRITICAL)
+        controller.queue_delay = 2.4
+        with pytest.raises(Overloaded) as overloaded:
+            await controller.acquire(LOW)
+        return controller, overloaded.value
+    controller, overloaded = asyncio.run(scenario())
+    assert overloaded.retry_after == 3
+    assert controller.stats[LOW]["shed"] == 1
+    assert not controller.waiting[LOW]
+
+
+def test_cancelled_waiter_gives_back_its_slot():
+    async def scenario():
+        controller = AdmissionController(concurrency=1)
+        await controller.acquire(CRITICAL)
+        task = asyncio.create_task(controller.acquire(NORMAL))
+        await asyncio.sleep(0.01)
+        task.cancel()
+        await asyncio.gather(task, return_exceptions=True)
+        controller.release(CRITICAL)
+        return controller
+    controller = asyncio.run(scenario())
+    assert controller.total_in_flight() == 0
+    assert not controller.waiting[NORMAL]
+
+# ------------------------ MIDDLEWARE TESTS ------------------------
+
+
+def test_busy_server_answers_503_with_retry_after(client, manager_headers, waiter_headers):
+    admission.in_flight[CRITICAL] = admission.concurrency
+    admission.queue_delay = 5.0
+    try:
+        response = client.get("/users/manager/dashboard", headers=manager_headers)
+        assert response.status_code == 503
+        assert response.headers["retry-after"] == "5"
+        # Health checks are never queued
+        assert client.get("/health/live").status_code == 200
+    finally:
+        admission.in_flight[CRITICAL] = 0
+        admission.queue_delay = 0.0
+    response = client.get("/users/manager/dashboard", headers=manager_headers)
+    assert response.status_code == 200
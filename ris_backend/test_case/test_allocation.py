@@ -0,0 +1,77 @@
+import pytest
+from app import models
+from app.allocation import VacantTableIndex, vacant_tables
+
+# ------------------------ VACANT TABLE INDEX TESTS ------------------------
+
+
+@pytest.fixture
+def index():
+    index = VacantTableIndex()
+    for table_id, capacity in [(1, 2), (2, 4), (3, 4), (4, 8), (5, 2)]:
+        index.add(table_id, capacity)
+    return index
+
+
+def test_best_fit_picks_smallest_capacity(index):
+    assert index.best_fit(1) == (1, 2)
+    assert index.best_fit(3) == (2, 4)
+    assert index.best_fit(5) == (4, 8)
+    assert index.best_fit(9) is None
+
+
+def test_best_fit_skips_excluded(index):
+    assert index.best_fit(3, exclude={2}) == (3, 4)
+    assert index.best_fit(3, exclude={2, 3}) == (4, 8)
+
+
+def test_remove_drops_empty_buckets(index):
+    index.remove(4, 8)
+    assert index.capacities == [2, 4]
+    assert index.best_fit(5) is None
+    # Removing twice is harmless
+    index.remove(4, 8)
+    index.add(2, 4)
+    assert index.buckets[4] == [2, 3]
+
+
+# ------------------------ API TESTS ------------------------
+
+
+def test_allocate_reserves_best_fit(client, db, waiter_headers):
+    db.add_all([models.Table(table_id=10, capacity=8, table_status="vacant"),
+                models.Table(table_id=11, capacity=2, table_status="vacant")])
+    db.commit()
+    assert vacant_tables.get(1).reconcile(db)["missing"] == [1, 10, 11]
+
+    response = client.put("/users/waiter/tables/allocate", json={"party_size": 3}, headers=waiter_headers)
+    assert response.json() == {"table_id": 1, "capacity": 4, "table_status": "reserved"}
+    response = client.put("/users/waiter/tables/allocate", json={"party_size": 2}, headers=waiter_headers)
+    assert response.json()["table_id"] == 11
+    response = client.put("/users/waiter/tables/allocate", json={"party_size": 9}, headers=waiter_headers)
+    assert response.status_code == 409
+    assert vacant_tables.get(1).snapshot() == {10}
+    # Serving a table puts it back
+    client.put("/users/waiter/orders/3/serve", headers=waiter_headers)
+    assert vacant_tables.get(1).best_fit(4) == (3, 4)
+
+
+def test_allocate_skips_stale_entries(client, db, waiter_headers):
+    vacant_tables.get(1).reconcile(db)
+    # Reserved behind the index's back, as by a concurrent request on another worker
+    db.get(models.Table, 1).table_status = "reserved"
+    db.commit()
+    response = client.put("/users/waiter/tables/allocate", json={"party_size": 2}, headers=waiter_headers)
+    assert response.status_code == 409
+    # The failed UPDATE already dropped the stale entry
+    assert vacant_tables.get(1).snapshot() == set()
+    assert vacant_tables.get(1).reconcile(db)["stale"] == []
+
+
+def test_allocate_falls_back_to_the_database(client, db, waiter_headers):
+    vacant_tables.get(1).reconcile(db)
+    # Freed through another worker, this index never heard of it
+    db.add(models.Table(table_id=10, capacity=6, table_status="vacant"))
+    db.commit()
+    response = client.put("/users/waiter/tables/allocate", json={"party_size": 5}, headers=waiter_headers)
+    assert response.json() == {"table_id": 10, "capacity": 6, "table_status": "reserved"}
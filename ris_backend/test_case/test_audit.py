@@ -0,0 +1,69 @@
+import pytest
+from uuid import uuid4
+from datetime import datetime
+from app import models
+from app.audit import AuditLog, audit_rows
+from app.events import Event
+
+# ------------------------ AUDIT LOG TESTS ------------------------
+
+
+def table_event(table_id: int = 1):
+    return Event("table_status_changed", {"table_id": table_id, "staff_id": uuid4(),
+                                          "old": "vacant", "new": "reserved"}, datetime.utcnow())
+
+
+def test_dishes_added_is_one_row_per_dish():
+    dishes = [{"dish_id": uuid4(), "menu_item_id": uuid4(), "quantity": 2} for _ in range(3)]
+    rows = audit_rows(Event("dishes_added", {"order_id": uuid4(), "table_id": 1,
+                                             "staff_id": uuid4(), "dishes": dishes}, None))
+    assert [row["entity_id"] for row in rows] == [str(dish["dish_id"]) for dish in dishes]
+    assert {row["event_type"] for row in rows} == {"dish_added"}
+
+
+def test_records_are_buffered_until_flush():
+    writes = []
+    log = AuditLog(batch_size=10, max_buffer=100)
+    log.write = lambda rows, db=None: writes.append(len(rows))
+    for table_id in range(25):
+        log.record(table_event(table_id))
+    assert writes == []
+    assert log.flush() == 25
+    # Multi-row inserts of at most batch_size rows
+    assert writes == [10, 10, 5]
+    assert log.pending() == 0
+
+
+def test_full_buffer_flushes_inline():
+    writes = []
+    log = AuditLog(batch_size=10, max_buffer=5)
+    log.write = lambda rows, db=None: writes.append(len(rows))
+    for table_id in range(5):
+        log.record(table_event(table_id))
+    assert writes == [5]
+
+
+def test_failed_flush_keeps_rows_up_to_the_limit():
+    log = AuditLog(batch_size=10, max_buffer=4)
+
+    def fail(rows, db=None):
+        raise RuntimeError("database down")
+    log.write = fail
+    for table_id in range(3):
+        log.record(table_event(table_id))
+    assert log.flush() == 0
+    assert log.pending() == 3
+    log.record(table_event(3))
+    log.record(table_event(4))
+    # The oldest rows are dropped once the buffer is full
+    assert log.pending() == 4
+    assert log.stats["dropped"] >= 1
+
+
+def test_flush_writes_rows(session_factory, db):
+    log = AuditLog(session_factory=session_factory)
+    log.record(table_event(2))
+    assert log.flush() == 1
+    [row] = db.query(models.AuditEvent).all()
+    assert row.entity_type == "table" and row.entity_id == "2"
+    assert log.stats["batches"] == 1
@@ -1,4 +1,8 @@
+import asyncio
+import threading
 import pytest
+import httpx
+from anyio import to_thread
 from pydantic import ValidationError
 from uuid import uuid4
 from datetime import datetime, date
@@ -55,3 +59,66 @@ def test_token_schema():
     }
     token = Token(**token_data)
     assert token.token_type == "bearer"
+
+
+# ------------------------ LOGIN TESTS ------------------------
+
+
+def test_login(client):
+    response = client.post("/login", data={"username": "waiter", "password": "Waiter@123"})
+    assert response.status_code == 200
+    token = response.json()["access_token"]
+    response = client.get("/users/me", headers={"Authorization": f"Bearer {token}"})
+    assert response.json()["username"] == "waiter"
+
+
+def test_login_wrong_password(client):
+    response = client.post("/login", data={"username": "waiter", "password": "wrong"})
+    assert response.status_code == 400
+    response = client.post("/login", data={"username": "nobody", "password": "wrong"})
+    assert response.status_code == 404
+
+
+def test_invalid_token(client):
+    response = client.get("/users/me", headers={"Authorization": "Bearer not-a-token"})
+    assert response.status_code == 401
+
+
+def test_login_does_not_block_other_requests(client):
+    from app.main import app
+    finished = []
+
+    async def run():
+        async with httpx.AsyncClient(transport=httpx.ASGITransport(app=app), base_url="http://test") as http:
+            async def login():
+                await http.post("/login", data={"username": "waiter", "password": "Waiter@123"})
+                finished.append("login")
+
+            async def poll():
+                # Sent while the password hash is being checked
+                await asyncio.sleep(0.02)
+                await http.get("/health/live")
+                finished.append("poll")
+            await asyncio.gather(login(), poll())
+    asyncio.run(run())
+    assert finished == ["poll", "login"]
+
+
+def test_polls_do_not_wait_for_a_thread(client, waiter_headers):
+    from app.main import app
+    release = threading.Event()
+
+    async def run():
+        # The only thread is held, as by a write stuck on a row lock
+        to_thread.current_default_thread_limiter().total_tokens = 1
+        blocked = asyncio.ensure_future(to_thread.run_sync(release.wait))
+        await asyncio.sleep(0.01)
+        try:
+            async with httpx.AsyncClient(transport=httpx.ASGITransport(app=app), base_url="http://test") as http:
+                return await asyncio.wait_for(http.get("/users/waiter/tables", headers=waiter_headers), 5)
+        finally:
+            release.set()
+            await blocked
+    response = asyncio.run(run())
+    assert response.status_code == 200
+    assert [table["table_id"] for table in response.json()] == [1, 2, 3]
@@ -0,0 +1,70 @@
+import gzip
+import time
+import pytest
+from app import cache
+from app.cache import ResponseCache, CachedBody, negotiate_encoding
+
+# ------------------------ ENCODING NEGOTIATION TESTS ------------------------
+
+
+def test_negotiate_encoding():
+    assert negotiate_encoding(None) is None
+    assert negotiate_encoding("identity") is None
+    assert negotiate_encoding("gzip, deflate") == "gzip"
+    assert negotiate_encoding("gzip;q=0, deflate") is None
+    if cache.brotli:
+        assert negotiate_encoding("gzip, br") == "br"
+        assert negotiate_encoding("br;q=0, gzip") == "gzip"
+
+
+def test_cached_body_threshold():
+    small = CachedBody(b"[]")
+    assert small.encoded("gzip") == (None, b"[]")
+
+    body = b'{"item_name": "Beef Steak"}' * 100
+    large = CachedBody(body)
+    encoding, content = large.encoded("gzip")
+    assert encoding == "gzip"
+    assert gzip.decompress(content) == body
+    # The compressed variant is reused, not rebuilt
+    assert large.encoded("gzip")[1] is content
+
+# ------------------------ RESPONSE CACHE TESTS ------------------------
+
+
+def test_response_cache_invalidation():
+    response_cache = ResponseCache(max_entries=2)
+    response_cache.put(("tables", None), b"[1]", ("tables",))
+    response_cache.put(("menu-items", None), b"[2]", ("menu",))
+    assert response_cache.get(("tables", None)).body == b"[1]"
+
+    response_cache.invalidate("tables")
+    assert response_cache.get(("tables", None)) is None
+    assert response_cache.get(("menu-items", None)).body == b"[2]"
+
+
+def test_response_cache_skips_stale_put():
+    response_cache = ResponseCache()
+    generation = response_cache.generation(("tables",))
+    # A write commits while the body is being built
+    response_cache.invalidate("tables")
+    response_cache.put(("tables", None), b"[]", ("tables",), generation)
+    assert response_cache.get(("tables", None)) is None
+
+
+def test_response_cache_evicts_oldest():
+    response_cache = ResponseCache(max_entries=2)
+    for key in ("a", "b", "c"):
+        response_cache.put(key, b"[]", ("menu",))
+    assert response_cache.get("a") is None
+    assert response_cache.get("c") is not None
+
+
+def test_response_cache_expires_entries():
+    # Another worker's write never invalidates this one, the entry has to age out
+    response_cache = ResponseCache(max_age=0.05)
+    response_cache.put(("tables", None), b"[]", ("tables",))
+    assert response_cache.get(("tables", None)) is not None
+    time.sleep(0.06)
+    assert response_cache.get(("tables", None)) is None
+    assert ("tables", None) not in response_cache.entries
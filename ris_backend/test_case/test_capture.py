@@ -0,0 +1,92 @@
+import os
+import json
+import asyncio
+import pytest
+import httpx
+from app.capture import TrafficCapture, capture, sanitize, body_shape, route_template, REDACTED
+from tools.replay import load_traces, plan, user_roles, Replayer
+from test_case.conftest import BEEF_STEAK_ID
+
+# ------------------------ TRACE TESTS ------------------------
+
+
+def test_secrets_are_redacted():
+    body = {"username": "waiter", "password": "Waiter@123", "items": [{"access_token": "abc", "quantity": 2}]}
+    assert sanitize(body) == {"username": "waiter", "password": REDACTED,
+                              "items": [{"access_token": REDACTED, "quantity": 2}]}
+
+
+def test_bodies_keep_only_their_shape():
+    body = {"table_id": 1, "dishes": [{"menu_item_id": "550e8400", "quantity": 2, "note": "No onions"}],
+            "full_name": "Jane Doe", "dob": "1990-01-01", "price": 12.5, "extra": None}
+    assert body_shape(body) == {"table_id": 1, "dishes": [{"menu_item_id": "550e8400", "quantity": 2, "note": "<str>"}],
+                                "full_name": "<str>", "dob": "<str>", "price": "<float>", "extra": None}
+
+
+def test_route_template():
+    assert route_template("/users/waiter/tables/4/order", {"table_id": 4}) == "/users/waiter/tables/{table_id}/order"
+
+
+def test_files_are_rotated_and_pruned(tmp_path):
+    writer = TrafficCapture(enabled=True, directory=str(tmp_path), max_bytes=10, keep=2)
+    for number in range(4):
+        writer.write(json.dumps({"number": number}) + "\n")
+    # Every line filled a file, the oldest rotated file is gone
+    assert writer.stats["rotated"] == 4 and len(os.listdir(tmp_path)) == 2
+
+# ------------------------ CAPTURE AND REPLAY TESTS ------------------------
+
+
+@pytest.fixture
+def captures(tmp_path):
+    directory = capture.directory
+    capture.directory, capture.enabled = str(tmp_path), True
+    yield tmp_path
+    capture.stop()
+    capture.directory, capture.enabled = directory, False
+
+
+def take_order(client):
+    login = client.post("/login", data={"username": "waiter", "password": "Waiter@123"})
+    headers = {"Authorization": f"Bearer {login.json()['access_token']}"}
+    order = client.post("/users/waiter/create-order", json={
+        "table_id": 1, "dishes": [{"menu_item_id": str(BEEF_STEAK_ID), "quantity": 1}]
+    }, headers=headers).json()
+    client.get(f"/users/waiter/orders/{order['order_id']}/bill", headers=headers)
+    client.put("/users/waiter/orders/1/serve", headers=headers)
+    return order["order_id"]
+
+
+def test_requests_are_recorded(client, captures):
+    order_id = take_order(client)
+    client.get("/health/live")
+    capture.stop()
+    [login, order, bill, serve] = load_traces(str(captures))
+    # Neither the password nor the username is kept, the login only ties the user key to what follows
+    assert login["body"] == {"username": "<str>", "password": "<str>"}
+    assert "Waiter@123" not in json.dumps(login) and '"waiter"' not in json.dumps(login)
+    # The login belongs to the same user as the requests made with its token
+    assert login["user"] == order["user"] == serve["user"] and order["role_id"] == 1
+    assert order["ids"]["order_id"] == order_id and order["body"]["table_id"] == 1
+    assert bill["route"] == "/users/waiter/orders/{order_id}/bill" and bill["status"] == 200
+    assert "authorization" not in bill["headers"]
+
+
+def test_replay_keeps_user_order_and_swaps_ids(client, captures):
+    from app.main import app
+    captured_order_id = take_order(client)
+    capture.stop()
+    capture.enabled = False
+    traces = load_traces(str(captures))
+    streams = plan(traces, speed=10.0)
+    assert len(streams) == 1
+
+    async def replay():
+        async with httpx.AsyncClient(transport=httpx.ASGITransport(app=app), base_url="http://staging") as staging:
+            replayer = Replayer(staging, {1: "waiter:Waiter@123"}, user_roles(traces), 10.0)
+            return replayer, replayer.report(await replayer.replay(streams))
+    replayer, report = asyncio.run(replay())
+    # The bill was asked for the order the replay created, not the captured one
+    assert replayer.ids[captured_order_id] != captured_order_id
+    assert report["total"]["count"] == 4 and report["total"]["errors"] == 0
+    assert report["routes"]["GET /users/waiter/orders/{order_id}/bill"]["count"] == 1
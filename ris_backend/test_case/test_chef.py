@@ -2,6 +2,8 @@ import pytest
 from pydantic import ValidationError
 from datetime import datetime, date
 from uuid import uuid4, UUID
+from sqlalchemy import delete
+from app import crud, models
 from app.schemas import User, DishDisplay, Dish, DishStatusUpdate, GenderEnum, DishStatusEnum
 
 # ------------------------ TEST CASES ------------------------
@@ -89,5 +91,87 @@ def test_dish_status_update_schema():
         )
 
 
+# ------------------------ API TESTS ------------------------
+
+
+def test_get_dishes(client, chef_headers):
+    response = client.get("/users/chef/dishes", headers=chef_headers)
+    assert response.status_code == 200
+    assert len(response.json()) == 6
+    assert {dish["table_id"] for dish in response.json()} == {3}
+
+
+def test_get_dishes_sparse_fields(client, chef_headers):
+    response = client.get("/users/chef/dishes?fields=dish_status", headers=chef_headers)
+    assert set(response.json()[0]) == {"dish_id", "dish_status"}
+
+
+def test_update_dish_status(client, chef_headers):
+    dish_id = "550e8400-e29b-41d4-a716-446655440024"
+    response = client.put("/users/chef/dishes/status-update", json={"dish_id": dish_id}, headers=chef_headers)
+    assert response.json()["dish_status"] == "prepared"
+    response = client.put("/users/chef/dishes/status-update", json={"dish_id": dish_id}, headers=chef_headers)
+    assert response.json()["dish_status"] == "ready"
+    response = client.put("/users/chef/dishes/status-update", json={"dish_id": dish_id}, headers=chef_headers)
+    assert response.status_code == 400
+
+
+def test_update_unknown_dish(client, chef_headers):
+    response = client.put("/users/chef/dishes/status-update", json={"dish_id": str(uuid4())}, headers=chef_headers)
+    assert response.status_code == 404
+
+
+def test_kitchen_tickets_follow_writes(client, chef_headers, waiter_headers, manager_headers):
+    response = client.post("/users/waiter/create-order", json={
+        "table_id": 1, "dishes": [{"menu_item_id": "550e8400-e29b-41d4-a716-446655440003", "quantity": 2}]
+    }, headers=waiter_headers)
+    assert response.status_code == 200
+    client.put("/users/manager/menu-items/550e8400-e29b-41d4-a716-446655440003", json={
+        "item_name": "Wagyu Steak", "note": "Grilled", "price": 20.0, "menu_section_id": 1
+    }, headers=manager_headers)
+    tickets = client.get("/users/chef/dishes", headers=chef_headers).json()
+    [ticket] = [ticket for ticket in tickets if ticket["table_id"] == 1]
+    assert ticket["item_name"] == "Wagyu Steak"
+    assert ticket["quantity"] == 2 and ticket["dish_status"] == "received"
+    assert ticket["ordered_at"] is not None
+
+    client.put("/users/chef/dishes/status-update", json={"dish_id": ticket["dish_id"]}, headers=chef_headers)
+    client.put("/users/waiter/orders/1/serve", headers=waiter_headers)
+    tickets = client.get("/users/chef/dishes?fields=dish_status", headers=chef_headers).json()
+    assert {"dish_id": ticket["dish_id"], "dish_status": "ready"} in tickets
+
+
+def test_rebuild_kitchen_tickets_matches_writes(db):
+    before = crud.get_kitchen_tickets(db)
+    db.execute(delete(models.KitchenTicket))
+    assert not crud.kitchen_tickets_in_sync(db)
+    crud.rebuild_kitchen_tickets(db)
+    assert crud.kitchen_tickets_in_sync(db)
+    assert crud.get_kitchen_tickets(db) == before
+
+
+def test_station_feed_only_has_its_sections(client, chef_headers, db):
+    stations = client.get("/users/chef/stations", headers=chef_headers).json()
+    assert [(station["station_name"], station["menu_section_ids"]) for station in stations] == [
+        ("Kitchen", [1, 2]), ("Pastry", [3]), ("Bar", [4])]
+    sections = dict(db.query(models.KitchenTicket.dish_id, models.KitchenTicket.menu_section_id).all())
+    for station in stations:
+        response = client.get(f"/users/chef/stations/{station['station_id']}/dishes?fields=dish_status",
+                              headers=chef_headers)
+        expected = {str(dish_id) for dish_id, section in sections.items() if section in station["menu_section_ids"]}
+        if expected:
+            assert {dish["dish_id"] for dish in response.json()} == expected
+        else:
+            assert response.status_code == 404
+    response = client.get("/users/chef/stations/99/dishes", headers=chef_headers)
+    assert response.json()["detail"] == "Station not found"
+
+
+def test_station_feed_in_sql(db):
+    # Bar tickets only, still in ticket order
+    tickets = crud.get_kitchen_tickets(db, ("dish_id", "menu_section_id", "ordered_at"), station_id=3)
+    assert tickets and {ticket.menu_section_id for ticket in tickets} == {4}
+    assert [ticket.ordered_at for ticket in tickets] == sorted(ticket.ordered_at for ticket in tickets)
+
 if __name__ == "__main__":
     pytest.main()
@@ -1,35 +1,38 @@
-# This file sets up the database
-import os
-from sqlalchemy import create_engine
-from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy.orm import sessionmaker
-from dotenv import load_dotenv
-from app.models import StaffRole
+# This file checks the test database is reachable and seeded from init.sql
+from app.models import StaffRole, Table, MenuItem
 
-# Load environment variables from .env file
-load_dotenv()
-DB_URL = os.getenv("DB_URL")
 
-# Setup database engine and session
-engine = create_engine(DB_URL, echo=True)
-SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+def test_connection(db):
+    # Query to check the connection
+    roles = db.query(StaffRole).order_by(StaffRole.role_id).all()
+    assert [role.role_name for role in roles] == ["Waiter", "Chef", "Manager"]
 
-Base = declarative_base()
 
+def test_seed_data(db):
+    assert db.query(Table).count() == 3
+    assert db.query(MenuItem).count() == 20
 
-def test_connection():
-    session = SessionLocal()
-    try:
-        # Query to check the connection
-        roles = session.query(StaffRole).all()
-        for role in roles:
-            print(f"Role ID: {role.role_id}, Role Name: {role.role_name}")
-        print("Connection successful!")
-    except Exception as e:
-        print(f"An error occurred: {e}")
-    finally:
-        session.close()
+
+def test_rollback_between_tests(db):
+    # Each test starts from the seed, whatever the previous test committed
+    db.add(Table(table_id=99, capacity=2, table_status="vacant"))
+    db.commit()
+    assert db.query(Table).count() == 4
+
+
+def test_rollback_between_tests_again(db):
+    assert db.get(Table, 99) is None
 
 
-if __name__ == "__main__":
-    test_connection()
+def test_liveness(client):
+    assert client.get("/health/live").json() == {"status": "ok"}
+
+
+def test_readiness_follows_startup(client):
+    from app.main import app
+    assert client.get("/health/ready").status_code == 503
+    app.state.ready = True
+    try:
+        assert client.get("/health/ready").json() == {"status": "ok"}
+    finally:
+        app.state.ready = False
@@ -0,0 +1,54 @@
+from sqlalchemy import text
+from sqlalchemy.orm import Session
+from app import models, crud
+from app.database import Base
+from tools.generate_dataset import DatasetGenerator, LOAD_ORDER
+from tools.bulk_load import bulk_load, DEPENDENT_TABLES
+from test_case.conftest import create_test_engine, seed_statements
+
+# ------------------------ GENERATE AND LOAD TESTS ------------------------
+
+
+def seeded_database(path):
+    # The init.sql seed plus a kitchen station, so every table the truncate has to empty holds rows
+    engine = create_test_engine(path)
+    Base.metadata.create_all(bind=engine)
+    with engine.begin() as connection:
+        for statement in seed_statements():
+            connection.exec_driver_sql(statement)
+    with Session(bind=engine) as db:
+        station = models.KitchenStation(station_name="Grill")
+        db.add(station)
+        db.flush()
+        db.add(models.StationSection(station_id=station.station_id, menu_section_id=1))
+        crud.rebuild_kitchen_tickets(db)
+        db.commit()
+    return engine
+
+
+def test_dataset_loads_into_a_seeded_database(tmp_path):
+    counts = DatasetGenerator(seed=7, sites=2, tables_per_site=4, menu_sections=3, menu_items=8, days=2,
+                              turns_per_table=3).write(str(tmp_path / "dataset"))
+    engine = seeded_database(tmp_path / "target.db")
+    with engine.connect() as connection:
+        assert connection.execute(text("SELECT COUNT(*) FROM tables WHERE current_order_id IS NOT NULL")).scalar()
+        assert all(connection.execute(text(f"SELECT COUNT(*) FROM {name}")).scalar() for name in DEPENDENT_TABLES)
+
+    # A small batch size, so the executemany path commits more than one batch per table
+    results = bulk_load(f"sqlite:///{tmp_path / 'target.db'}", str(tmp_path / "dataset"), truncate=True,
+                        batch_size=20)
+    assert [name for name, _, _ in results] == LOAD_ORDER
+    with engine.connect() as connection:
+        for name, rows, _ in results:
+            assert rows == counts[name] == connection.execute(text(f"SELECT COUNT(*) FROM {name}")).scalar()
+        assert counts["dishes"] > 20
+        # Nothing of the seed is left behind, and every loaded row points at a loaded parent
+        for name in DEPENDENT_TABLES:
+            assert connection.execute(text(f"SELECT COUNT(*) FROM {name}")).scalar() == 0
+        assert connection.exec_driver_sql("PRAGMA foreign_key_check").fetchall() == []
+    # Eating tables already point at their unserved order, the startup repair has nothing to do
+    with Session(bind=engine) as db:
+        assert db.query(models.Table).filter(models.Table.current_order_id.isnot(None)).count() \
+            == db.query(models.Table).filter(models.Table.table_status == "eating").count() > 0
+        assert crud.repair_current_orders(db) == []
+    engine.dispose()
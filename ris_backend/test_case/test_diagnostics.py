@@ -0,0 +1,57 @@
+import os
+import pytest
+from app import crud
+from app.diagnostics import MemoryDiagnostics, memory_diagnostics, module_name
+
+# ------------------------ DIAGNOSTICS TESTS ------------------------
+
+
+@pytest.fixture
+def tracing():
+    yield memory_diagnostics
+    memory_diagnostics.stop()
+
+
+def test_module_names():
+    assert module_name(crud.__file__) == "app.crud"
+    assert module_name(os.path.join(os.path.dirname(crud.__file__), "__init__.py")) == "app"
+    assert module_name("<frozen abc>") == "<frozen abc>"
+
+
+def test_snapshot_diff(client, manager_headers, tracing):
+    assert client.post("/users/manager/diagnostics/memory/snapshots", headers=manager_headers).status_code == 409
+    status = client.post("/users/manager/diagnostics/memory/start?frames=5", headers=manager_headers).json()
+    assert status["tracing"] and status["frames"] == 5 and status["pid"] == os.getpid()
+    since = client.post("/users/manager/diagnostics/memory/snapshots", headers=manager_headers).json()
+    held = [bytearray(1024) for _ in range(2000)]
+    response = client.get(f"/users/manager/diagnostics/memory/diff?since={since['snapshot_id']}&group_by=lineno",
+                          headers=manager_headers)
+    assert response.status_code == 200
+    # The list above is where most of the new memory went
+    assert response.json()["sites"][0]["site"].startswith("test_case.test_diagnostics:")
+    assert response.json()["sites"][0]["size_diff_bytes"] >= len(held) * 1024
+    by_module = client.get(f"/users/manager/diagnostics/memory/diff?since={since['snapshot_id']}",
+                           headers=manager_headers).json()
+    assert "test_case.test_diagnostics" in [site["site"] for site in by_module["sites"]]
+    assert client.get("/users/manager/diagnostics/memory/diff?since=unknown",
+                      headers=manager_headers).status_code == 404
+
+
+def test_tracing_stops_by_itself(tracing):
+    # Started on a worker that may never get the stop request
+    diagnostics = MemoryDiagnostics(frames=1, max_seconds=0.05)
+    diagnostics.start()
+    timer = diagnostics.timer
+    assert diagnostics.take() is not None
+    timer.join(5)
+    assert diagnostics.status()["tracing"] is False and diagnostics.take() is None
+
+
+def test_live_objects(client, manager_headers, db):
+    tables = crud.get_tables(db)
+    counts = client.get("/users/manager/diagnostics/objects", headers=manager_headers).json()
+    assert counts["orm_instances"]["Table"] >= len(tables) and counts["sessions"] >= 1
+
+
+def test_diagnostics_are_manager_only(client, waiter_headers):
+    assert client.get("/users/manager/diagnostics/objects", headers=waiter_headers).status_code == 401
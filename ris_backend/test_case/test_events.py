@@ -0,0 +1,94 @@
+import pytest
+from app import models
+from app.events import EventBus, Event, emit, event_bus
+
+# ------------------------ EVENT BUS TESTS ------------------------
+
+
+def make_events(count: int, name: str = "order_created"):
+    return [Event(name, {"number": number}, None) for number in range(count)]
+
+
+def test_worker_batches_events():
+    bus = EventBus(workers=1, batch_size=10, batch_interval=0.2)
+    batches = []
+    bus.subscribe(["order_created"], lambda events: batches.append(len(events)))
+    bus.start()
+    bus.publish(make_events(25))
+    assert bus.stop(timeout=5)
+    assert sum(batches) == 25
+    assert max(batches) <= 10
+    assert bus.stats["processed"] == 25
+
+
+def test_only_matching_events_are_queued():
+    bus = EventBus()
+    seen = []
+    bus.subscribe(["order_served"], seen.extend)
+    bus.publish(make_events(3, "order_created") + make_events(2, "order_served"))
+    bus.drain()
+    assert [item.name for item in seen] == ["order_served", "order_served"]
+    assert bus.stats["published"] == 2
+
+
+def test_failed_handler_is_retried():
+    bus = EventBus(max_retries=2, retry_backoff=0)
+    calls = []
+
+    def flaky(events):
+        calls.append(len(events))
+        if len(calls) < 3:
+            raise RuntimeError("database unavailable")
+
+    bus.subscribe(["order_created"], flaky)
+    bus.publish(make_events(4))
+    bus.drain()
+    assert calls == [4, 4, 4]
+    assert bus.stats["retried"] == 2
+    assert bus.stats["failed"] == 0
+
+
+def test_handler_gives_up_after_retries():
+    bus = EventBus(max_retries=1, retry_backoff=0)
+
+    def broken(events):
+        raise RuntimeError("always fails")
+
+    bus.subscribe(["order_created"], broken)
+    bus.publish(make_events(2))
+    bus.drain()
+    assert bus.stats["failed"] == 2
+
+
+def test_full_queue_drops_events():
+    bus = EventBus(queue_size=2)
+    bus.subscribe(["order_created"], lambda events: None)
+    bus.publish(make_events(3))
+    assert bus.stats["dropped"] == 1
+
+
+def test_inline_handler_runs_on_publish():
+    bus = EventBus()
+    seen = []
+    bus.on_commit(["order_created"], seen.append)
+    bus.publish(make_events(2))
+    assert len(seen) == 2
+    assert bus.queue.qsize() == 0
+
+# ------------------------ SESSION HOOK TESTS ------------------------
+
+
+def test_events_publish_after_commit_only(db):
+    seen = []
+    event_bus.on_commit(["test_event"], seen.append)
+    try:
+        emit(db, "test_event", table_id=1)
+        db.rollback()
+        assert seen == []
+
+        emit(db, "test_event", table_id=2)
+        assert seen == []
+        db.commit()
+        assert [item.payload["table_id"] for item in seen] == [2]
+    finally:
+        event_bus.inline_subscribers.pop()
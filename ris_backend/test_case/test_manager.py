@@ -2,6 +2,10 @@ import pytest
 from uuid import uuid4
 from datetime import datetime, date
 from pydantic import ValidationError
+from app import models
+from app.counters import live_counters
+from app.events import event_bus
+from test_case.conftest import BEEF_STEAK_ID
 from app.schemas import (User, MenuSectionWithItems, MenuSection,
                          MenuSectionCreate, MenuItem, MenuItemCreate,
                          GenderEnum)
@@ -105,3 +109,155 @@ def test_menu_section_with_items_schema_invalid_item_price():
                  "note": "Vegetarian", "price": -5.99},  # Invalid price
             ]
         )
+
+# ------------------------ API TESTS ------------------------
+
+
+def test_get_menu_sections(client, manager_headers):
+    response = client.get("/users/manager/menu-sections", headers=manager_headers)
+    assert response.status_code == 200
+    assert [section["section_name"] for section in response.json()] == [
+        "Main Courses", "Salads", "Desserts", "Drinks"]
+    assert all(len(section["menu_items"]) == 5 for section in response.json())
+
+
+def test_get_menu_sections_gzip(client, manager_headers):
+    response = client.get("/users/manager/menu-sections",
+                          headers={**manager_headers, "Accept-Encoding": "gzip"})
+    assert response.headers["content-encoding"] == "gzip"
+    assert len(response.json()) == 4
+
+
+def test_create_menu_item_refreshes_menu(client, manager_headers, waiter_headers):
+    client.get("/users/waiter/tables/menu-items", headers=waiter_headers)
+    response = client.post("/users/manager/menu-items", json={
+        "item_name": "Pho", "note": "Beef noodle soup", "price": 8.5, "menu_section_id": 1
+    }, headers=manager_headers)
+    assert response.status_code == 200
+    response = client.get("/users/waiter/tables/menu-items", headers=waiter_headers)
+    assert "Pho" in [item["item_name"] for item in response.json()]
+
+
+def test_create_menu_section_unique(client, manager_headers):
+    response = client.post("/users/manager/menu-sections", json={"section_name": "Soups"}, headers=manager_headers)
+    assert response.json()["menu_section_id"] == 5
+    response = client.post("/users/manager/menu-sections", json={"section_name": "Soups"}, headers=manager_headers)
+    assert response.status_code == 400
+
+
+def test_update_menu_item(client, manager_headers):
+    menu_item_id = "550e8400-e29b-41d4-a716-446655440022"
+    response = client.put(f"/users/manager/menu-items/{menu_item_id}", json={
+        "item_name": "Virgin Mojito", "note": "Alcohol-free", "price": 3.0, "menu_section_id": 4
+    }, headers=manager_headers)
+    assert response.json()["item_name"] == "Virgin Mojito"
+
+
+def test_dashboard_follows_transitions(client, manager_headers, waiter_headers, chef_headers, db):
+    live_counters.get(1).reconcile(db)
+    dashboard = client.get("/users/manager/dashboard", headers=manager_headers).json()
+    assert dashboard["tables"] == {"vacant": 1, "reserved": 1, "eating": 1}
+    assert dashboard["dishes"] == {"received": 2, "prepared": 2, "ready": 2}
+    assert dashboard["open_orders"] == 1
+
+    client.put("/users/waiter/tables/reserve", json={"table_id": 1}, headers=waiter_headers)
+    client.put("/users/chef/dishes/status-update",
+               json={"dish_id": "550e8400-e29b-41d4-a716-446655440024"}, headers=chef_headers)
+    client.put("/users/waiter/orders/3/serve", headers=waiter_headers)
+    dashboard = client.get("/users/manager/dashboard", headers=manager_headers).json()
+    assert dashboard["tables"] == {"vacant": 1, "reserved": 2}
+    assert dashboard["dishes"] == {"ready": 6}
+    assert dashboard["open_orders"] == 0
+    assert dashboard["average_wait_seconds"] == 0
+    # Nothing drifted, so a reconcile finds the same numbers
+    assert live_counters.get(1).reconcile(db) == {"tables": {}, "dishes": {}, "open_orders": 0}
+
+
+def test_dashboard_ignores_rolled_back_batch(client, manager_headers, waiter_headers, db):
+    live_counters.get(1).reconcile(db)
+    client.post("/users/waiter/batch", json={"operations": [
+        {"op": "reserve", "table_id": 1}, {"op": "reserve", "table_id": 2}
+    ]}, headers=waiter_headers)
+    dashboard = client.get("/users/manager/dashboard", headers=manager_headers).json()
+    assert dashboard["tables"] == {"vacant": 1, "reserved": 1, "eating": 1}
+
+
+def test_audit_events_record_who_did_what(client, manager_headers, waiter_headers, chef_headers):
+    client.put("/users/waiter/tables/reserve", json={"table_id": 1}, headers=waiter_headers)
+    client.put("/users/chef/dishes/status-update",
+               json={"dish_id": "550e8400-e29b-41d4-a716-446655440024"}, headers=chef_headers)
+    response = client.get("/users/manager/audit-events", params={"entity_type": "table", "entity_id": "1"},
+                          headers=manager_headers)
+    assert response.status_code == 200
+    [event] = response.json()
+    assert event["event_type"] == "table_status_changed"
+    assert event["staff_id"] == "550e8400-e29b-41d4-a716-446655440000"
+    assert event["detail"] == {"old": "vacant", "new": "reserved"}
+
+    events = client.get("/users/manager/audit-events", headers=manager_headers).json()
+    assert [event["entity_type"] for event in events] == ["dish", "table"]
+    assert events[0]["staff_id"] == "550e8400-e29b-41d4-a716-446655440001"
+
+
+def test_audit_events_skip_rolled_back_batch(client, manager_headers, waiter_headers):
+    client.post("/users/waiter/batch", json={"operations": [
+        {"op": "reserve", "table_id": 1}, {"op": "reserve", "table_id": 2}
+    ]}, headers=waiter_headers)
+    response = client.get("/users/manager/audit-events", headers=manager_headers)
+    assert response.json() == []
+
+
+def test_audit_events_time_range(client, manager_headers, waiter_headers):
+    client.put("/users/waiter/tables/reserve", json={"table_id": 1}, headers=waiter_headers)
+    response = client.get("/users/manager/audit-events", params={"until": "2000-01-01T00:00:00"},
+                          headers=manager_headers)
+    assert response.json() == []
+    response = client.get("/users/manager/audit-events", params={"entity_id": "1"}, headers=manager_headers)
+    assert response.status_code == 400
+
+
+def test_prep_times_from_dish_transitions(client, manager_headers, waiter_headers, chef_headers, db):
+    response = client.post("/users/waiter/create-order", json={
+        "table_id": 1, "dishes": [{"menu_item_id": str(BEEF_STEAK_ID), "quantity": 1}]
+    }, headers=waiter_headers)
+    assert response.status_code == 200
+    dish = db.query(models.Dish).filter(models.Dish.menu_item_id == BEEF_STEAK_ID,
+                                        models.Dish.dish_status == "received",
+                                        models.Dish.received_at.isnot(None)).one()
+    for _ in range(2):
+        client.put("/users/chef/dishes/status-update", json={"dish_id": str(dish.dish_id)}, headers=chef_headers)
+    db.refresh(dish)
+    assert dish.received_at <= dish.prepared_at <= dish.ready_at
+    event_bus.drain()
+
+    response = client.get("/users/manager/prep-times", headers=manager_headers)
+    assert response.status_code == 200
+    [item] = response.json()["items"]
+    assert item["menu_item_id"] == str(BEEF_STEAK_ID) and item["count"] == 1
+    assert [section["menu_section_id"] for section in response.json()["sections"]] == [1]
+    response = client.get("/users/manager/prep-times", params={"stage": "prepare"}, headers=manager_headers)
+    assert response.json()["items"][0]["p99"] >= 0
+
+
+def test_manage_stations(client, manager_headers):
+    response = client.post("/users/manager/stations", json={"station_name": "Grill", "menu_section_ids": [1, 1]},
+                           headers=manager_headers)
+    assert response.status_code == 200
+    station = response.json()
+    assert station["menu_section_ids"] == [1]
+    response = client.post("/users/manager/stations", json={"station_name": "Grill", "menu_section_ids": [1]},
+                           headers=manager_headers)
+    assert response.status_code == 400
+    response = client.put(f"/users/manager/stations/{station['station_id']}",
+                          json={"station_name": "Grill", "menu_section_ids": [1, 99]}, headers=manager_headers)
+    assert response.status_code == 404
+    client.post("/users/manager/menu-sections", json={"section_name": "Soups"}, headers=manager_headers)
+    response = client.put(f"/users/manager/stations/{station['station_id']}",
+                          json={"station_name": "Hot line", "menu_section_ids": [1, 5]}, headers=manager_headers)
+    assert response.json()["menu_section_ids"] == [1, 5]
+    # Deleting a section takes it off every station
+    client.delete("/users/manager/menu-sections/5/delete", headers=manager_headers)
+    stations = client.get("/users/chef/stations", headers=manager_headers).json()
+    assert [station["menu_section_ids"] for station in stations] == [[1, 2], [3], [4], [1]]
+    response = client.delete(f"/users/manager/stations/{station['station_id']}/delete", headers=manager_headers)
+    assert response.status_code == 204
@@ -0,0 +1,189 @@
+import time
+import pytest
+from sqlalchemy.exc import OperationalError
+from app import crud, models
+from app.outbox import Outbox, outbox as app_outbox, PENDING, APPLIED, REJECTED, FAILED
+from app.schemas import OrderWithDishesCreate, DishCreate
+from test_case.conftest import WAITER_ID, BEEF_STEAK_ID
+
+# ------------------------ FIXTURES ------------------------
+
+
+@pytest.fixture
+def outbox(tmp_path, session_factory):
+    outbox = Outbox(str(tmp_path / "outbox.db"), session_factory=session_factory)
+    yield outbox
+    outbox.close()
+
+
+def order_data(table_id: int = 1):
+    return OrderWithDishesCreate(table_id=table_id, dishes=[DishCreate(menu_item_id=BEEF_STEAK_ID, quantity=2)])
+
+# ------------------------ OUTBOX TESTS ------------------------
+
+
+def test_replay_applies_with_the_provisional_id(outbox, db):
+    entry = outbox.append(1, WAITER_ID, order_data())
+    assert entry["status"] == PENDING and outbox.pending_count(1) == 1
+    assert outbox.replay() == 1
+    order = crud.get_order(db, entry["order_id"])
+    assert order.table_id == 1 and order.created_at == entry["created_at"]
+    assert crud.get_table(db, 1).current_order_id == entry["order_id"]
+    assert outbox.get(1, entry["order_id"])["status"] == APPLIED
+    # Nothing left to do, and another restaurant cannot see the entry
+    assert outbox.replay() == 0
+    assert outbox.get(2, entry["order_id"]) is None
+
+
+def test_idempotency_key_returns_the_first_entry(outbox):
+    first = outbox.append(1, WAITER_ID, order_data(), idempotency_key="tablet-7-42")
+    again = outbox.append(1, WAITER_ID, order_data(), idempotency_key="tablet-7-42")
+    assert again["order_id"] == first["order_id"]
+    assert outbox.pending_count() == 1
+
+
+def test_idempotency_key_is_per_restaurant(outbox):
+    first = outbox.append(1, WAITER_ID, order_data(), idempotency_key="tablet-7-42")
+    other = outbox.append(2, WAITER_ID, order_data(), idempotency_key="tablet-7-42")
+    # Restaurant 2 gets its own order, not restaurant 1's
+    assert other["order_id"] != first["order_id"] and other["restaurant_id"] == 2
+    assert outbox.pending_count(1) == outbox.pending_count(2) == 1
+
+
+def test_old_outbox_file_is_upgraded(tmp_path, session_factory):
+    path = tmp_path / "outbox.db"
+    old = Outbox(str(path), session_factory=session_factory)
+    with old.lock:
+        # The table as it was created while keys were unique across restaurants
+        old.connect().executescript(
+            "DROP TABLE outbox_entries; CREATE TABLE outbox_entries (seq INTEGER PRIMARY KEY AUTOINCREMENT, "
+            "order_id TEXT NOT NULL UNIQUE, idempotency_key TEXT UNIQUE, restaurant_id INTEGER NOT NULL, "
+            "staff_id TEXT NOT NULL, table_id INTEGER NOT NULL, payload TEXT NOT NULL, status TEXT NOT NULL, "
+            "attempts INTEGER NOT NULL DEFAULT 0, detail TEXT, created_at TEXT NOT NULL, applied_at TEXT);")
+    first = old.append(1, WAITER_ID, order_data(), idempotency_key="tablet-7-42")
+    old.close()
+    outbox = Outbox(str(path), session_factory=session_factory)
+    try:
+        # The pending entry survives, and the key is free for another restaurant
+        assert outbox.append(1, WAITER_ID, order_data(), idempotency_key="tablet-7-42")["seq"] == first["seq"]
+        assert outbox.append(2, WAITER_ID, order_data(), idempotency_key="tablet-7-42")["restaurant_id"] == 2
+    finally:
+        outbox.close()
+
+
+def test_already_committed_order_is_not_applied_twice(outbox, db):
+    entry = outbox.append(1, WAITER_ID, order_data())
+    # Committed, then the process died before the entry was marked
+    crud.create_order_with_dishes(db, order_data(), WAITER_ID, order_id=entry["order_id"])
+    db.commit()
+    assert outbox.replay() == 1
+    assert db.query(models.Order).filter(models.Order.table_id == 1).count() == 1
+
+
+def test_invalid_order_is_rejected(outbox):
+    # Table 3 already has an unserved order
+    entry = outbox.append(1, WAITER_ID, order_data(table_id=3))
+    outbox.replay()
+    rejected = outbox.get(1, entry["order_id"])
+    assert rejected["status"] == REJECTED and "previous order" in rejected["detail"]
+
+
+def test_unreachable_database_keeps_order(tmp_path):
+    def unreachable(restaurant_id):
+        raise OperationalError("SELECT 1", {}, Exception("Lost connection to MySQL server"))
+    outbox = Outbox(str(tmp_path / "outbox.db"), session_factory=unreachable)
+    first = outbox.append(1, WAITER_ID, order_data(1))
+    outbox.append(1, WAITER_ID, order_data(2))
+    try:
+        assert outbox.replay() == 0
+        # Only the first order was tried, the second must not overtake it
+        [waiting, behind] = outbox.entries(1)
+        assert waiting["order_id"] == first["order_id"] and waiting["attempts"] == 1
+        assert behind["attempts"] == 0
+        assert outbox.failures == 1
+    finally:
+        outbox.close()
+
+
+def test_broken_entry_is_given_up(tmp_path, session_factory):
+    def broken_then_fine(restaurant_id):
+        if not calls:
+            calls.append(restaurant_id)
+            raise ValueError("Bug in apply")
+        return session_factory(restaurant_id)
+    calls = []
+    outbox = Outbox(str(tmp_path / "outbox.db"), session_factory=broken_then_fine, max_attempts=1)
+    try:
+        broken = outbox.append(1, WAITER_ID, order_data(1))
+        behind = outbox.append(1, WAITER_ID, order_data(2))
+        # Not a connection error, so the entry fails for good and the next order goes ahead
+        assert outbox.replay() == 2
+        failed = outbox.get(1, broken["order_id"])
+        assert failed["status"] == FAILED and failed["detail"] == "Bug in apply" and failed["attempts"] == 1
+        assert outbox.get(1, behind["order_id"])["status"] == APPLIED
+    finally:
+        outbox.close()
+
+
+def test_broken_entry_is_retried_up_to_the_limit(tmp_path):
+    def broken(restaurant_id):
+        raise ValueError("Bug in apply")
+    outbox = Outbox(str(tmp_path / "outbox.db"), session_factory=broken, max_attempts=3)
+    try:
+        entry = outbox.append(1, WAITER_ID, order_data(1))
+        assert outbox.replay() == 0 and outbox.replay() == 0
+        assert outbox.get(1, entry["order_id"])["status"] == PENDING
+        assert outbox.replay() == 1 and outbox.get(1, entry["order_id"])["attempts"] == 3
+    finally:
+        outbox.close()
+
+
+def test_settled_entry_keeps_its_status(outbox):
+    entry = outbox.append(1, WAITER_ID, order_data())
+    outbox.mark(entry["seq"], APPLIED)
+    # A late verdict from a second replayer must not undo the first
+    outbox.mark(entry["seq"], REJECTED, "Table has a previous order")
+    assert outbox.get(1, entry["order_id"])["status"] == APPLIED
+
+
+def test_one_worker_replays_at_a_time(tmp_path, session_factory):
+    path = str(tmp_path / "outbox.db")
+    first = Outbox(path, session_factory=session_factory, lease_seconds=0.2)
+    second = Outbox(path, session_factory=session_factory, lease_seconds=0.2)
+    try:
+        first.append(1, WAITER_ID, order_data(1))
+        assert first.replay() == 1
+        entry = second.append(1, WAITER_ID, order_data(2))
+        # The first worker holds the lease, the second one leaves the entry to it
+        assert second.replay() == 0 and second.get(1, entry["order_id"])["status"] == PENDING
+        first.release_lease()
+        assert second.replay() == 1
+        # Once the holder stops renewing, the lease runs out and the other worker takes over
+        third = second.append(1, WAITER_ID, order_data(3))
+        assert first.replay() == 0
+        second.lease_until = 0.0
+        time.sleep(0.25)
+        assert first.replay() == 1 and first.get(1, third["order_id"])["status"] != PENDING
+    finally:
+        first.close()
+        second.close()
+
+# ------------------------ API TESTS ------------------------
+
+
+def test_queued_order_api(client, waiter_headers, outbox, monkeypatch):
+    for name in ("path", "session_factory"):
+        monkeypatch.setattr(app_outbox, name, getattr(outbox, name))
+    monkeypatch.setattr(app_outbox, "connection", None)
+    response = client.post("/users/waiter/create-order/queued", json={
+        "table_id": 1, "dishes": [{"menu_item_id": str(BEEF_STEAK_ID), "quantity": 1}]
+    }, headers=waiter_headers)
+    assert response.status_code == 202
+    order_id = response.json()["order_id"]
+    status = client.get("/users/waiter/outbox", headers=waiter_headers).json()
+    assert status["pending"] == 1 and status["entries"][0]["order_id"] == order_id
+
+    app_outbox.replay()
+    app_outbox.close()
+    assert client.get(f"/users/waiter/outbox/{order_id}", headers=waiter_headers).json()["status"] == "applied"
+    assert client.get("/users/waiter/tables/1/order", headers=waiter_headers).json()["order_id"] == order_id
@@ -0,0 +1,71 @@
+import os
+import json
+import pytest
+from app.profiling import StackSampler, profiler
+
+# ------------------------ SAMPLER TESTS ------------------------
+
+
+def test_output_formats():
+    sampler = StackSampler(loop_thread=0)
+    sampler.record(("worker", "run (a.py:1)", "handler (b.py:2)"), 0.002)
+    sampler.record(("worker", "run (a.py:1)", "handler (b.py:2)"), 0.001)
+    sampler.record(("event-loop", "run (a.py:1)"), 0.001)
+    assert sampler.collapsed() == "event-loop;run (a.py:1) 1\nworker;run (a.py:1);handler (b.py:2) 2\n"
+    document = json.loads(sampler.speedscope("GET-tables"))
+    assert [frame["name"] for frame in document["shared"]["frames"]] == ["run (a.py:1)", "handler (b.py:2)"]
+    worker = document["profiles"][1]
+    assert worker["samples"] == [[0, 1]] and worker["weights"] == [0.003]
+
+
+def test_idle_threads_are_skipped():
+    sampler = StackSampler(loop_thread=0)
+
+    class Code:
+        co_filename = os.path.join("lib", "threading.py")
+        co_name = "wait"
+        co_firstlineno = 1
+
+    class Frame:
+        f_code = Code
+        f_back = None
+    assert sampler.stack(Frame) is None
+
+# ------------------------ MIDDLEWARE TESTS ------------------------
+
+
+@pytest.fixture
+def profile_dir(tmp_path):
+    directory = profiler.directory
+    profiler.directory = str(tmp_path)
+    yield tmp_path
+    profiler.directory = directory
+
+
+def test_manager_can_profile_a_request(client, manager_headers, profile_dir):
+    response = client.get("/users/manager/menu-sections", headers={**manager_headers, "X-Profile": "1"})
+    assert response.status_code == 200
+    profile_id = response.headers["x-profile-id"]
+    with open(profile_dir / f"{profile_id}.speedscope.json") as output:
+        assert json.load(output)["name"] == profile_id
+
+
+def test_profiling_is_manager_only(client, waiter_headers, profile_dir):
+    response = client.get("/users/waiter/tables", headers={**waiter_headers, "X-Profile": "1"})
+    assert response.status_code == 200
+    assert "x-profile-id" not in response.headers
+    assert os.listdir(profile_dir) == []
+
+
+def test_old_profiles_are_pruned(profile_dir):
+    keep = profiler.keep
+    profiler.keep = 2
+    try:
+        for number in range(3):
+            path = profile_dir / f"{number}.collapsed"
+            path.write_text("")
+            os.utime(path, (number, number))
+        profiler.prune()
+    finally:
+        profiler.keep = keep
+    assert sorted(os.listdir(profile_dir)) == ["1.collapsed", "2.collapsed"]
@@ -0,0 +1,71 @@
+import pytest
+from uuid import uuid4
+from app.search import MenuSearchIndex, trigrams, menu_search
+
+# ------------------------ SEARCH INDEX TESTS ------------------------
+
+
+@pytest.fixture
+def index():
+    index = MenuSearchIndex()
+    for name, note, section in [("Caesar Salad", "Romaine lettuce and croutons", 2),
+                                ("Greek Salad", "Tomatoes and feta", 2),
+                                ("Crème Brûlée", "Vanilla custard", 3),
+                                ("Lemonade", "Freshly squeezed", 4),
+                                ("Iced Tea", "Brewed tea with lemon", 4)]:
+        index.upsert(uuid4(), name, note, 5.0, section)
+    return index
+
+
+def names(results):
+    return [result["item_name"] for result in results]
+
+
+def test_trigrams_of_partial_word():
+    assert trigrams("sal", partial_last_word=True) == {"  s", " sa", "sal"}
+    assert "ad " in trigrams("salad")
+
+
+def test_search_tolerates_typos(index):
+    assert names(index.search("ceasar"))[0] == "Caesar Salad"
+    assert names(index.search("lemonad"))[0] == "Lemonade"
+
+
+def test_search_prefix_and_accents(index):
+    assert set(names(index.search("sal"))) == {"Caesar Salad", "Greek Salad"}
+    assert names(index.search("creme brulee")) == ["Crème Brûlée"]
+
+
+def test_search_notes_rank_below_names(index):
+    assert names(index.search("lemon")) == ["Lemonade", "Iced Tea"]
+
+
+def test_incremental_updates(index):
+    item_id = uuid4()
+    index.upsert(item_id, "Pho", "Beef noodle soup", 8.5, 1)
+    assert names(index.search("pho")) == ["Pho"]
+    index.upsert(item_id, "Bun Cha", "Grilled pork", 8.5, 1)
+    assert index.search("pho") == []
+    index.remove(item_id)
+    assert index.search("bun cha") == []
+    index.remove_section(4)
+    assert index.search("lemonade") == []
+
+
+# ------------------------ API TESTS ------------------------
+
+
+def test_search_endpoint_follows_menu_changes(client, db, waiter_headers, manager_headers):
+    menu_search.get(1).rebuild(db)
+    response = client.get("/users/waiter/tables/menu-items/search", params={"q": "chese cake"},
+                          headers=waiter_headers)
+    assert response.status_code == 200
+    assert response.json()[0]["item_name"] == "Cheesecake"
+
+    client.post("/users/manager/menu-items", json={
+        "item_name": "Cheese Platter", "note": "Three cheeses", "price": 9.0, "menu_section_id": 3
+    }, headers=manager_headers)
+    response = client.get("/users/waiter/tables/menu-items/search", params={"q": "cheese p"},
+                          headers=waiter_headers)
+    assert response.json()[0]["item_name"] == "Cheese Platter"
+    assert response.json()[0]["price"] == 9.0
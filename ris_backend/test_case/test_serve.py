@@ -0,0 +1,51 @@
+import pytest
+from app.serve import pool_budget, pool_settings, server_options, worker_count
+
+# ------------------------ SERVER LAUNCHER TESTS ------------------------
+
+
+def test_pool_budget_fits_database_limit():
+    for workers in (1, 2, 4, 8, 16):
+        pool_size, max_overflow = pool_budget(workers, 1, max_connections=151, reserved=11)
+        assert workers * 2 * (pool_size + max_overflow) <= 140
+        assert pool_size >= max_overflow
+
+
+def test_pool_budget_refuses_to_overcommit():
+    assert sum(pool_budget(35, 1, max_connections=151, reserved=11)) == 2
+    with pytest.raises(ValueError):
+        pool_budget(36, 1, max_connections=151, reserved=11)
+
+
+def test_pool_budget_is_split_over_shards():
+    # Each worker opens a sync and an async pool per shard
+    for workers, shards in ((1, 3), (4, 2), (8, 4)):
+        pool_size, max_overflow = pool_budget(workers, shards, max_connections=151, reserved=11)
+        assert workers * shards * 2 * (pool_size + max_overflow) <= 140
+    with pytest.raises(ValueError):
+        pool_budget(18, 2, max_connections=151, reserved=11)
+
+
+def test_preset_pool_must_fit_the_budget():
+    pool_size, max_overflow = pool_budget(4, 1)
+    assert pool_settings(4, 1, {}) == (pool_size, max_overflow)
+    # Smaller values from .env are kept, larger ones would overcommit the database
+    assert pool_settings(4, 1, {"DB_POOL_SIZE": "5", "DB_MAX_OVERFLOW": "2"}) == (5, 2)
+    with pytest.raises(ValueError):
+        pool_settings(4, 1, {"DB_POOL_SIZE": str(pool_size + max_overflow), "DB_MAX_OVERFLOW": "1"})
+
+
+def test_one_worker_by_default(monkeypatch):
+    # In-process caches are per worker, more workers have to be asked for
+    monkeypatch.delenv("WEB_CONCURRENCY", raising=False)
+    assert worker_count() == 1
+    monkeypatch.setenv("WEB_CONCURRENCY", "4")
+    assert worker_count() == 4
+
+
+def test_server_options():
+    options = server_options(4)
+    assert options["workers"] == 4
+    assert options["loop"] in ("uvloop", "asyncio")
+    assert options["http"] in ("httptools", "h11")
+    assert options["timeout_graceful_shutdown"] > 0
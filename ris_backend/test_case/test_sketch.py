@@ -0,0 +1,66 @@
+import random
+import pytest
+from uuid import uuid4
+from datetime import datetime, timedelta
+from app.sketch import QuantileSketch, PrepTimes, SKETCH_ACCURACY
+
+# ------------------------ QUANTILE SKETCH TESTS ------------------------
+
+
+def exact_quantile(values, q):
+    return sorted(values)[int(q * (len(values) - 1))]
+
+
+def test_quantiles_within_relative_accuracy():
+    rng = random.Random(7)
+    values = [rng.lognormvariate(6.5, 0.6) for _ in range(20000)]
+    sketch = QuantileSketch()
+    for value in values:
+        sketch.add(value)
+    for q in (0.5, 0.9, 0.99):
+        exact = exact_quantile(values, q)
+        assert abs(sketch.quantile(q) - exact) <= SKETCH_ACCURACY * exact + 1e-9
+    # Far fewer buckets than values
+    assert len(sketch.buckets) < 500
+
+
+def test_merge_matches_single_sketch():
+    rng = random.Random(3)
+    values = [rng.uniform(30, 3600) for _ in range(5000)]
+    whole, first, second = QuantileSketch(), QuantileSketch(), QuantileSketch()
+    for index, value in enumerate(values):
+        whole.add(value)
+        (first if index % 2 else second).add(value)
+    first.merge(second)
+    assert first.count == whole.count
+    assert first.buckets == whole.buckets
+    assert first.quantile(0.9) == whole.quantile(0.9)
+
+
+def test_merge_rejects_other_accuracy():
+    with pytest.raises(ValueError):
+        QuantileSketch(0.01).merge(QuantileSketch(0.02))
+
+
+def test_empty_and_sub_second_values():
+    sketch = QuantileSketch()
+    assert sketch.quantile(0.5) is None
+    sketch.add(0.2)
+    assert sketch.quantile(0.99) == 0.0
+
+
+def test_prep_times_merge_days_and_expire():
+    times = PrepTimes(days=3)
+    item_id = uuid4()
+    today = datetime(2024, 8, 10, 12, 0)
+    for offset, seconds in enumerate([600, 900, 1200]):
+        at = today - timedelta(days=offset)
+        times.add(at, at - timedelta(seconds=seconds), "ready", item_id, 1)
+    # A dish that was never received is ignored
+    times.add(today, None, "ready", item_id, 1)
+    merged = times.merged("total", today.date() - timedelta(days=2), today.date())
+    assert merged["item"][item_id].count == 3
+    assert merged["section"][1].count == 3
+    assert times.merged("total", today.date(), today.date())["item"][item_id].count == 1
+    times.expire(today.date() + timedelta(days=1))
+    assert times.merged("total", today.date() - timedelta(days=2), today.date())["item"][item_id].count == 2
@@ -0,0 +1,124 @@
+import os
+import asyncio
+import tempfile
+import pytest
+from datetime import datetime, date
+from app import models, crud_async
+from app.database import ShardRouter, DEFAULT_SHARD, TENANT_KEY
+from app.counters import live_counters
+from test_case.conftest import auth_headers
+
+# ------------------------ FIXTURES ------------------------
+
+
+@pytest.fixture
+def second_site(session_factory):
+    # A second restaurant on the same shard, with a waiter of the same username and one table
+    db = session_factory(2)
+    db.add(models.StaffAccount(role_id=1, username="waiter", password="-", full_name="Second Waiter",
+                               gender="female", dob=date(1990, 1, 1), created_at=datetime.utcnow()))
+    db.add(models.Table(table_id=20, capacity=6, table_status="vacant"))
+    db.commit()
+    db.close()
+    return auth_headers("waiter", 1, restaurant_id=2)
+
+# ------------------------ SESSION SCOPING TESTS ------------------------
+
+
+def test_sessions_only_see_their_restaurant(session_factory, second_site, db):
+    assert [table.table_id for table in db.query(models.Table).order_by(models.Table.table_id)] == [1, 2, 3]
+    other = session_factory(2)
+    try:
+        [table] = other.query(models.Table).all()
+        # New rows were stamped with the session's restaurant
+        assert table.table_id == 20 and table.restaurant_id == 2
+        assert other.get(models.Table, 1) is None
+        assert other.query(models.MenuItem).count() == 0
+    finally:
+        other.close()
+
+
+def test_async_sessions_only_see_their_restaurant(async_session_factory, second_site):
+    # app.tenancy hooks the sync Session class, which an AsyncSession runs on
+    async def read(restaurant_id):
+        async with async_session_factory(restaurant_id) as db:
+            return ([table.table_id for table in await crud_async.get_tables(db)],
+                    await crud_async.get_table(db, 1), len(await crud_async.get_menu_items(db)))
+    assert asyncio.run(read(2)) == ([20], None, 0)
+    tables, table, menu_items = asyncio.run(read(1))
+    assert tables == [1, 2, 3] and table.table_id == 1 and menu_items > 0
+
+
+def test_api_serves_the_restaurant_of_the_token(client, waiter_headers, second_site):
+    # The first restaurant's response is cached, the second must not be served from it
+    first = client.get("/users/waiter/tables", headers=waiter_headers).json()
+    second = client.get("/users/waiter/tables", headers=second_site).json()
+    assert [table["table_id"] for table in first] == [1, 2, 3]
+    assert [table["table_id"] for table in second] == [20]
+    response = client.put("/users/waiter/tables/reserve", json={"table_id": 1}, headers=second_site)
+    assert response.status_code == 404
+
+
+def test_events_update_their_restaurant_only(client, session_factory, db, second_site):
+    live_counters.get(1).reconcile(db)
+    other = session_factory(2)
+    live_counters.get(2).reconcile(other)
+    other.close()
+    client.put("/users/waiter/tables/reserve", json={"table_id": 20}, headers=second_site)
+    assert live_counters.get(2).snapshot()["tables"] == {"reserved": 1}
+    assert live_counters.get(1).snapshot()["tables"] == {"vacant": 1, "reserved": 1, "eating": 1}
+
+# ------------------------ SHARD ROUTER TESTS ------------------------
+
+
+@pytest.fixture
+def shard_router():
+    paths = [os.path.join(tempfile.gettempdir(), f"ris_shard_{os.getpid()}_{name}.db") for name in "ab"]
+    router = ShardRouter(f"sqlite:///{paths[0]}", {"east": f"sqlite:///{paths[1]}"}, {"2": "east"})
+    for name in router.shard_names():
+        models.Base.metadata.create_all(bind=router.engine(name))
+    yield router
+    router.dispose()
+    for path in paths:
+        os.remove(path)
+
+
+def test_router_sends_each_restaurant_to_its_shard(shard_router):
+    assert shard_router.shard_for(1) == DEFAULT_SHARD
+    assert shard_router.shard_for(2) == "east"
+    for restaurant_id in (1, 2):
+        db = shard_router.session(restaurant_id)
+        db.add(models.StaffAccount(role_id=1, username="waiter", password="-", full_name="Waiter",
+                                   gender="male", dob=date(1990, 1, 1), created_at=datetime.utcnow()))
+        db.commit()
+        assert db.info[TENANT_KEY] == restaurant_id
+        db.close()
+    assert shard_router.restaurant_ids(DEFAULT_SHARD) == [1]
+    assert shard_router.restaurant_ids("east") == [2]
+    with shard_router.shard_session("east") as db:
+        assert [account.restaurant_id for account in db.query(models.StaffAccount)] == [2]
+
+
+def test_router_reads_each_shard_through_its_async_engine(shard_router):
+    for restaurant_id in (1, 2):
+        with shard_router.session(restaurant_id) as db:
+            db.add(models.Table(table_id=restaurant_id * 10, capacity=4, table_status="vacant"))
+            db.commit()
+
+    async def read():
+        try:
+            found = {}
+            for restaurant_id in (1, 2):
+                async with shard_router.async_session(restaurant_id) as db:
+                    assert db.info[TENANT_KEY] == restaurant_id
+                    found[restaurant_id] = [table.table_id for table in await crud_async.get_tables(db)]
+            return found
+        finally:
+            await shard_router.dispose_async()
+    assert asyncio.run(read()) == {1: [10], 2: [20]}
+    assert shard_router.async_engines == {}
+
+
+def test_router_rejects_unknown_shards():
+    with pytest.raises(ValueError):
+        ShardRouter("sqlite://", {}, {"3": "west"})
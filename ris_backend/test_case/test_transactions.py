@@ -0,0 +1,103 @@
+import sqlite3
+import threading
+import pytest
+import pymysql
+from fastapi import HTTPException
+from sqlalchemy import create_engine, text
+from sqlalchemy.exc import OperationalError, IntegrityError
+from sqlalchemy.orm import Session
+from app import crud
+from app.transactions import TransactionRunner, retryable_error, transactions as app_transactions
+
+
+def mysql_error(code: int, message: str):
+    return OperationalError("UPDATE tables SET table_status=%s", {}, pymysql.err.OperationalError(code, message))
+
+
+DEADLOCK = mysql_error(1213, "Deadlock found when trying to get lock; try restarting transaction")
+
+
+@pytest.fixture
+def runner():
+    return TransactionRunner(attempts=3, base_delay=0.001, max_delay=0.002, budget=1.0)
+
+# ------------------------ CLASSIFICATION TESTS ------------------------
+
+
+def test_retryable_errors():
+    assert retryable_error(DEADLOCK) == "deadlock"
+    assert retryable_error(mysql_error(1205, "Lock wait timeout exceeded")) == "lock_wait_timeout"
+    assert retryable_error(OperationalError("INSERT", {}, sqlite3.OperationalError("database is locked"))) \
+        == "sqlite_locked"
+    # Lost connections and constraint violations are not lock contention
+    assert retryable_error(mysql_error(2013, "Lost connection to MySQL server during query")) is None
+    assert retryable_error(IntegrityError("INSERT", {}, pymysql.err.IntegrityError(1062, "Duplicate entry"))) is None
+    assert retryable_error(ValueError("deadlock")) is None
+
+# ------------------------ RETRY TESTS ------------------------
+
+
+def test_deadlock_is_retried_until_commit(runner, db):
+    calls = []
+
+    def work():
+        calls.append(1)
+        if len(calls) < 3:
+            raise DEADLOCK
+        return crud.get_table(db, 1)
+    assert runner.run(db, work, "reserve_table").table_id == 1
+    assert runner.snapshot()["reserve_table"] == {"committed": 1, "retried": 2, "exhausted": 0,
+                                                  "errors": {"deadlock": 2}}
+
+
+def test_gives_up_with_503(runner, db):
+    def work():
+        raise DEADLOCK
+    with pytest.raises(HTTPException) as raised:
+        runner.run(db, work, "serve_table")
+    assert raised.value.status_code == 503 and raised.value.headers["Retry-After"] == "1"
+    assert runner.snapshot()["serve_table"]["exhausted"] == 1
+
+
+def test_other_errors_are_not_retried(runner, db):
+    def work():
+        raise HTTPException(status_code=404, detail="Table not found")
+    with pytest.raises(HTTPException):
+        runner.run(db, work, "reserve_table")
+    assert runner.snapshot() == {}
+
+
+def test_sqlite_lock_is_waited_out(runner, tmp_path):
+    # No busy timeout, a locked database fails at once and only the retries wait
+    engine = create_engine(f"sqlite:///{tmp_path / 'locked.db'}", connect_args={"timeout": 0})
+    with engine.begin() as connection:
+        connection.execute(text("CREATE TABLE visits (table_id INTEGER)"))
+    holder = sqlite3.connect(tmp_path / "locked.db", isolation_level=None, check_same_thread=False)
+    holder.execute("BEGIN IMMEDIATE")
+    threading.Timer(0.02, holder.commit).start()
+    runner.attempts, runner.base_delay, runner.max_delay = 20, 0.01, 0.02
+    with Session(engine) as db:
+        runner.run(db, lambda: db.execute(text("INSERT INTO visits VALUES (1)")), "visit")
+        assert db.execute(text("SELECT COUNT(*) FROM visits")).scalar() == 1
+    holder.close()
+    engine.dispose()
+    assert runner.snapshot()["visit"]["errors"]["sqlite_locked"] >= 1
+
+# ------------------------ API TESTS ------------------------
+
+
+def test_reserve_survives_a_deadlock(client, waiter_headers, manager_headers, monkeypatch):
+    reserve_table = crud.reserve_table
+    calls = []
+
+    def deadlocked_once(db, table_id, staff_id):
+        calls.append(1)
+        if len(calls) == 1:
+            raise DEADLOCK
+        return reserve_table(db, table_id, staff_id)
+    monkeypatch.setattr(crud, "reserve_table", deadlocked_once)
+    monkeypatch.setattr(app_transactions, "stats", {})
+    response = client.put("/users/waiter/tables/reserve", json={"table_id": 1}, headers=waiter_headers)
+    assert response.status_code == 200 and response.json()["table_status"] == "reserved"
+    stats = client.get("/users/manager/diagnostics/transactions", headers=manager_headers).json()
+    assert stats["reserve_table"]["retried"] == 1 and stats["reserve_table"]["committed"] == 1
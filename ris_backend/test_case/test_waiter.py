@@ -1,8 +1,12 @@
 import pytest
 from pydantic import ValidationError
+from sqlalchemy import event
 from datetime import datetime, date
 from uuid import uuid4
-from app.schemas import User, Table, TableStatusUpdate, MenuItem, Order, OrderWithDishesCreate, OrderDetail, OrderUpdate, GenderEnum, TableStatusEnum, DishStatusEnum, DishCreate, OrderItemDetail
+from app import crud, models
+from app.schemas import User, Table, TableStatusUpdate, MenuItem, Order, OrderWithDishesCreate, OrderDetail, OrderUpdate, GenderEnum, TableStatusEnum, DishStatusEnum, DishCreate, OrderItemDetail, BatchOperation, BatchRequest, BatchOperationEnum, parse_fields, partial_model
+from app.cache import response_cache
+from test_case.conftest import RESTAURANT_ID, WAITER_ID, SEED_ORDER_ID, BEEF_STEAK_ID, CAESAR_SALAD_ID, COCA_COLA_ID
 
 # ------------------------ TEST CASES ------------------------
 
@@ -141,5 +145,237 @@ def test_order_update_schema():
         )
 
 
+def test_batch_request_schema():
+    batch = BatchRequest(operations=[
+        BatchOperation(op=BatchOperationEnum.reserve, table_id=1),
+        BatchOperation(op=BatchOperationEnum.create_order, table_id=1,
+                       dishes=[DishCreate(menu_item_id=uuid4(), quantity=2)]),
+        BatchOperation(op="serve", table_id=1)
+    ])
+    assert len(batch.operations) == 3
+    assert batch.operations[2].op == BatchOperationEnum.serve
+    with pytest.raises(ValidationError):
+        BatchRequest(operations=[])
+    with pytest.raises(ValidationError):
+        BatchOperation(op=BatchOperationEnum.create_order, table_id=1)
+    with pytest.raises(ValidationError):
+        BatchOperation(op="cancel", table_id=1)
+
+
+def test_table_sparse_fields():
+    fields = parse_fields(Table, "table_status", "table_id")
+    assert fields == ("table_id", "table_status")
+    assert parse_fields(Table, None, "table_id") is None
+    with pytest.raises(ValueError):
+        parse_fields(Table, "table_status,owner", "table_id")
+
+    TableFields = partial_model(Table, fields)
+    assert partial_model(Table, fields) is TableFields
+    table = TableFields(table_id=1, table_status=TableStatusEnum.eating)
+    assert table.model_dump() == {"table_id": 1, "table_status": "eating"}
+    with pytest.raises(ValidationError):
+        TableFields(table_id=-1, table_status=TableStatusEnum.eating)
+
+
+# ------------------------ API TESTS ------------------------
+
+
+def test_get_tables(client, waiter_headers):
+    response = client.get("/users/waiter/tables", headers=waiter_headers)
+    assert response.status_code == 200
+    assert [table["table_status"] for table in response.json()] == [
+        "vacant", "reserved", "eating"]
+
+
+def test_get_tables_requires_waiter(client, chef_headers):
+    response = client.get("/users/waiter/tables", headers=chef_headers)
+    assert response.status_code == 401
+
+
+def test_get_tables_sparse_fields(client, waiter_headers):
+    response = client.get("/users/waiter/tables?fields=table_status", headers=waiter_headers)
+    assert response.json()[0] == {"table_id": 1, "table_status": "vacant"}
+    response = client.get("/users/waiter/tables?fields=owner", headers=waiter_headers)
+    assert response.status_code == 400
+
+
+def test_reserve_table(client, waiter_headers):
+    response = client.put("/users/waiter/tables/reserve", json={"table_id": 1}, headers=waiter_headers)
+    assert response.status_code == 200
+    assert response.json()["table_status"] == "reserved"
+    response = client.put("/users/waiter/tables/reserve", json={"table_id": 1}, headers=waiter_headers)
+    assert response.status_code == 400
+
+
+def test_reserve_invalidates_cached_tables(client, waiter_headers):
+    client.get("/users/waiter/tables", headers=waiter_headers)
+    client.put("/users/waiter/tables/reserve", json={"table_id": 1}, headers=waiter_headers)
+    response = client.get("/users/waiter/tables", headers=waiter_headers)
+    assert response.json()[0]["table_status"] == "reserved"
+
+
+def test_create_order_and_view(client, waiter_headers):
+    response = client.post("/users/waiter/create-order", json={
+        "table_id": 1,
+        "dishes": [{"menu_item_id": str(BEEF_STEAK_ID), "quantity": 2}]
+    }, headers=waiter_headers)
+    assert response.status_code == 200
+    assert response.json()["staff_id"] == str(WAITER_ID)
+
+    response = client.get("/users/waiter/tables/1/order", headers=waiter_headers)
+    assert response.status_code == 200
+    assert response.json()["items"] == [
+        {"item_name": "Beef Steak", "quantity": 2, "price": 15.0}]
+
+
+def test_create_order_rejects_unserved_table(client, waiter_headers):
+    response = client.post("/users/waiter/create-order", json={
+        "table_id": 3,
+        "dishes": [{"menu_item_id": str(BEEF_STEAK_ID), "quantity": 1}]
+    }, headers=waiter_headers)
+    assert response.status_code == 400
+
+
+def test_create_order_unknown_item_is_not_saved(client, waiter_headers, db):
+    response = client.post("/users/waiter/create-order", json={
+        "table_id": 1,
+        "dishes": [{"menu_item_id": str(uuid4()), "quantity": 1}]
+    }, headers=waiter_headers)
+    assert response.status_code == 404
+    assert db.query(models.Order).filter(models.Order.table_id == 1).count() == 0
+
+
+def test_serve_order(client, waiter_headers, db):
+    response = client.put("/users/waiter/orders/3/serve", headers=waiter_headers)
+    assert response.status_code == 200
+    assert response.json() == [
+        {"order_id": str(SEED_ORDER_ID), "table_id": 3, "is_served": True}]
+    assert db.get(models.Table, 3).table_status == "vacant"
+    response = client.put("/users/waiter/orders/3/serve", headers=waiter_headers)
+    assert response.status_code == 404
+
+
+def test_serve_order_serves_older_unserved_orders(client, waiter_headers, db):
+    # Left unserved on the table by data written before the current order pointer
+    older = models.Order(table_id=3, staff_id=WAITER_ID, is_served=False, created_at=datetime(2024, 1, 1))
+    db.add(older)
+    db.commit()
+    response = client.put("/users/waiter/orders/3/serve", headers=waiter_headers)
+    assert [order["order_id"] for order in response.json()] == [str(older.order_id), str(SEED_ORDER_ID)]
+    db.expire_all()
+    assert db.get(models.Order, older.order_id).is_served and db.get(models.Order, SEED_ORDER_ID).is_served
+
+
+def test_order_pointer_follows_create_and_serve(client, waiter_headers, db):
+    assert db.get(models.Table, 3).current_order_id == SEED_ORDER_ID
+    client.put("/users/waiter/orders/3/serve", headers=waiter_headers)
+    db.expire_all()
+    assert db.get(models.Table, 3).current_order_id is None
+    response = client.get("/users/waiter/tables/3/order", headers=waiter_headers)
+    assert response.status_code == 400
+
+    response = client.post("/users/waiter/create-order", json={
+        "table_id": 3, "dishes": [{"menu_item_id": str(BEEF_STEAK_ID), "quantity": 1}]
+    }, headers=waiter_headers)
+    db.expire_all()
+    assert str(db.get(models.Table, 3).current_order_id) == response.json()["order_id"]
+
+
+def test_repair_current_orders(db):
+    db.get(models.Table, 3).current_order_id = None
+    db.get(models.Table, 1).current_order_id = SEED_ORDER_ID
+    db.flush()
+    assert sorted(crud.repair_current_orders(db)) == [1, 3]
+    db.expire_all()
+    assert db.get(models.Table, 3).current_order_id == SEED_ORDER_ID
+    assert db.get(models.Table, 1).current_order_id is None
+    assert crud.repair_current_orders(db) == []
+
+def test_batch_commits_all_operations(client, waiter_headers):
+    response = client.post("/users/waiter/batch", json={"operations": [
+        {"op": "reserve", "table_id": 1},
+        {"op": "create_order", "table_id": 1,
+         "dishes": [{"menu_item_id": str(BEEF_STEAK_ID), "quantity": 1}]},
+        {"op": "add_dishes", "table_id": 1,
+         "dishes": [{"menu_item_id": str(COCA_COLA_ID), "quantity": 2}]},
+    ]}, headers=waiter_headers)
+    assert response.status_code == 200
+    assert response.json()["committed"] is True
+    assert [result["status_code"] for result in response.json()["results"]] == [200, 200, 200]
+
+    response = client.get("/users/waiter/tables/1/order", headers=waiter_headers)
+    assert len(response.json()["items"]) == 2
+
+
+def test_batch_rolls_back_on_failure(client, waiter_headers, db):
+    response = client.post("/users/waiter/batch", json={"operations": [
+        {"op": "reserve", "table_id": 1},
+        {"op": "reserve", "table_id": 2},
+        {"op": "serve", "table_id": 3},
+    ]}, headers=waiter_headers)
+    body = response.json()
+    assert body["committed"] is False
+    assert [result["status_code"] for result in body["results"]] == [200, 400, 424]
+    assert db.get(models.Table, 1).table_status == "vacant"
+
+
+def test_serve_loads_menu_items_once(client, waiter_headers, connection):
+    statements = []
+
+    def listener(conn, cursor, statement, *args):
+        statements.append(statement)
+    event.listen(connection, "before_cursor_execute", listener)
+    try:
+        assert client.put("/users/waiter/orders/3/serve", headers=waiter_headers).status_code == 200
+    finally:
+        event.remove(connection, "before_cursor_execute", listener)
+    # Not one lazy load per dish
+    assert len([statement for statement in statements if "FROM menu_items" in statement]) == 1
+
+
+def test_order_bill(client, waiter_headers):
+    response = client.get(f"/users/waiter/orders/{SEED_ORDER_ID}/bill", headers=waiter_headers)
+    assert response.status_code == 200
+    bill = response.json()
+    assert bill["item_count"] == 10
+    assert bill["subtotal"] == pytest.approx(70.23)
+    assert [(section["section_name"], section["item_count"]) for section in bill["sections"]] == [
+        ("Main Courses", 3), ("Salads", 3), ("Desserts", 2), ("Drinks", 2)]
+    assert bill["lines"][0]["item_name"] == "Beef Steak"
+    assert bill["lines"][0]["subtotal"] == 30.0
+
+
+def test_order_bill_refreshes_when_dishes_change(client, waiter_headers):
+    client.get(f"/users/waiter/orders/{SEED_ORDER_ID}/bill", headers=waiter_headers)
+    client.post("/users/waiter/batch", json={"operations": [
+        {"op": "add_dishes", "table_id": 3,
+         "dishes": [{"menu_item_id": str(CAESAR_SALAD_ID), "quantity": 1}]}
+    ]}, headers=waiter_headers)
+    bill = client.get(f"/users/waiter/orders/{SEED_ORDER_ID}/bill", headers=waiter_headers).json()
+    assert bill["item_count"] == 11
+    assert bill["sections"][1]["subtotal"] == pytest.approx(20.0)
+
+
+def test_open_order_bill_is_not_cached(client, waiter_headers, db):
+    client.get(f"/users/waiter/orders/{SEED_ORDER_ID}/bill", headers=waiter_headers)
+    # A dish added through another worker, whose invalidation never reaches this one
+    db.add(models.Dish(order_id=SEED_ORDER_ID, staff_id=WAITER_ID, menu_item_id=COCA_COLA_ID, quantity=1,
+                       total=2.0, dish_status="received", received_at=datetime.utcnow()))
+    db.commit()
+    bill = client.get(f"/users/waiter/orders/{SEED_ORDER_ID}/bill", headers=waiter_headers).json()
+    assert bill["item_count"] == 11
+
+
+def test_served_order_bill_is_cached(client, waiter_headers):
+    client.put("/users/waiter/orders/3/serve", headers=waiter_headers)
+    client.get(f"/users/waiter/orders/{SEED_ORDER_ID}/bill", headers=waiter_headers)
+    assert (RESTAURANT_ID, "bill", SEED_ORDER_ID) in response_cache.entries
+
+
+def test_order_bill_unknown_order(client, waiter_headers):
+    response = client.get(f"/users/waiter/orders/{uuid4()}/bill", headers=waiter_headers)
+    assert response.status_code == 404
+
+
 if __name__ == "__main__":
     pytest.main()
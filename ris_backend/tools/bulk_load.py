@@ -0,0 +1,148 @@
+# This file bulk loads CSV files from tools.generate_dataset without going through the ORM
+# Run from the backend folder: python -m tools.bulk_load --data dataset [--method load-data] [--truncate]
+import os
+import csv
+import time
+import argparse
+from sqlalchemy import create_engine
+from dotenv import load_dotenv
+from tools.generate_dataset import COLUMNS, UUID_COLUMNS, LOAD_ORDER, NULL
+
+# Load environment variables from .env file
+load_dotenv()
+DB_URL = os.getenv("DB_URL")
+BATCH_SIZE = 5000
+# Tables the app fills from the loaded ones, they reference them and go first
+DEPENDENT_TABLES = ["kitchen_tickets", "station_sections"]
+
+
+def convert(column: str, value: str):
+    # CSV text to DB-API values for the multi-row insert path
+    if value == NULL:
+        return None
+    if column in UUID_COLUMNS:
+        return bytes.fromhex(value)
+    return value
+
+
+def read_batches(path: str, batch_size: int):
+    with open(path, newline="") as handle:
+        reader = csv.reader(handle)
+        columns = next(reader)
+        batch = []
+        for row in reader:
+            batch.append(tuple(convert(column, value) for column, value in zip(columns, row)))
+            if len(batch) >= batch_size:
+                yield batch
+                batch = []
+        if batch:
+            yield batch
+
+
+def placeholders(connection, count: int):
+    # pymysql uses %s, sqlite3 uses ?
+    marker = "?" if connection.dialect.dbapi.paramstyle == "qmark" else "%s"
+    return ", ".join([marker] * count)
+
+
+def insert_table(connection, data_dir: str, name: str, batch_size: int):
+    # executemany on pymysql rewrites the batch into one multi-row INSERT statement
+    columns = COLUMNS[name]
+    statement = f"INSERT INTO {name} ({', '.join(columns)}) VALUES ({placeholders(connection, len(columns))})"
+    raw = connection.connection.dbapi_connection
+    cursor = raw.cursor()
+    rows = 0
+    try:
+        for batch in read_batches(os.path.join(data_dir, f"{name}.csv"), batch_size):
+            cursor.executemany(statement, batch)
+            raw.commit()
+            rows += len(batch)
+    finally:
+        cursor.close()
+    return rows
+
+
+def load_data_table(connection, data_dir: str, name: str):
+    # MySQL parses the file server side, UUID columns are unhexed on the way in
+    columns = COLUMNS[name]
+    targets = [f"@{column}" if column in UUID_COLUMNS else column for column in columns]
+    conversions = [f"{column} = UNHEX(@{column})" for column in columns if column in UUID_COLUMNS]
+    path = os.path.abspath(os.path.join(data_dir, f"{name}.csv")).replace("\\", "/")
+    statement = (
+        f"LOAD DATA LOCAL INFILE '{path}' INTO TABLE {name} "
+        "FIELDS TERMINATED BY ',' OPTIONALLY ENCLOSED BY '\"' "
+        "LINES TERMINATED BY '\\r\\n' IGNORE 1 LINES "
+        f"({', '.join(targets)})"
+        + (f" SET {', '.join(conversions)}" if conversions else "")
+    )
+    raw = connection.connection.dbapi_connection
+    cursor = raw.cursor()
+    try:
+        rows = cursor.execute(statement)
+        raw.commit()
+    finally:
+        cursor.close()
+    return rows
+
+
+def set_checks(connection, enabled: bool):
+    # Skip per-row foreign key and unique checks while loading, MySQL only
+    if connection.dialect.name == "mysql":
+        value = 1 if enabled else 0
+        connection.exec_driver_sql(f"SET FOREIGN_KEY_CHECKS = {value}, UNIQUE_CHECKS = {value}")
+    elif connection.dialect.name == "sqlite":
+        connection.exec_driver_sql(f"PRAGMA foreign_keys = {'ON' if enabled else 'OFF'}")
+
+
+def truncate_tables(connection):
+    # Children before parents. tables and orders reference each other, so tables let go of their orders first
+    for name in DEPENDENT_TABLES:
+        connection.exec_driver_sql(f"DELETE FROM {name}")
+    connection.exec_driver_sql("UPDATE tables SET current_order_id = NULL")
+    for name in reversed(LOAD_ORDER):
+        connection.exec_driver_sql(f"DELETE FROM {name}")
+    connection.commit()
+
+
+def bulk_load(db_url: str, data_dir: str, method: str = "insert", truncate: bool = False,
+              batch_size: int = BATCH_SIZE):
+    connect_args = {"local_infile": True} if method == "load-data" else {}
+    engine = create_engine(db_url, connect_args=connect_args)
+    results = []
+    with engine.connect() as connection:
+        if truncate:
+            # With the checks on, a table left out of the order fails here instead of keeping orphaned rows
+            set_checks(connection, True)
+            truncate_tables(connection)
+        set_checks(connection, False)
+        try:
+            for name in LOAD_ORDER:
+                started = time.perf_counter()
+                if method == "load-data":
+                    rows = load_data_table(connection, data_dir, name)
+                else:
+                    rows = insert_table(connection, data_dir, name, batch_size)
+                results.append((name, rows, time.perf_counter() - started))
+        finally:
+            set_checks(connection, True)
+    engine.dispose()
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Bulk load a generated dataset into the database")
+    parser.add_argument("--data", default="dataset")
+    parser.add_argument("--db-url", default=DB_URL)
+    parser.add_argument("--method", choices=["insert", "load-data"], default="insert",
+                        help="Multi-row INSERT batches, or MySQL LOAD DATA LOCAL INFILE")
+    parser.add_argument("--batch-size", type=int, default=BATCH_SIZE)
+    parser.add_argument("--truncate", action="store_true", help="Delete existing rows first")
+    args = parser.parse_args()
+
+    for name, rows, seconds in bulk_load(args.db_url, args.data, args.method, args.truncate, args.batch_size):
+        rate = rows / seconds if seconds else 0
+        print(f"{name:<16}{rows:>12} rows {seconds:>8.1f}s {rate:>10.0f} rows/s")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,287 @@
+# This file extends the mock_data fixtures into a large, seeded restaurant history written as CSV files
+# Run from the backend folder: python -m tools.generate_dataset --out dataset --sites 10 --days 90
+import os
+import csv
+import json
+import math
+import uuid
+import random
+import argparse
+from datetime import datetime, date, timedelta
+from passlib.context import CryptContext
+
+MOCK_DATA_DIR = os.path.join(os.path.dirname(os.path.dirname(__file__)), "mock_data")
+NULL = "\\N"
+
+# Column order of every CSV file, shared with tools.bulk_load. Each site is a restaurant with its own menu
+COLUMNS = {
+    "roles": ["role_id", "role_name"],
+    "staff_accounts": ["staff_id", "restaurant_id", "role_id", "username", "password", "full_name", "gender", "dob",
+                       "created_at", "is_active"],
+    "tables": ["table_id", "restaurant_id", "capacity", "table_status", "current_order_id"],
+    "menu_sections": ["menu_section_id", "restaurant_id", "section_name"],
+    "menu_items": ["menu_item_id", "restaurant_id", "menu_section_id", "item_name", "note", "price"],
+    "orders": ["order_id", "restaurant_id", "table_id", "staff_id", "is_served", "created_at"],
+    "dishes": ["dish_id", "restaurant_id", "order_id", "staff_id", "menu_item_id", "note", "quantity", "total",
+               "dish_status", "received_at", "prepared_at", "ready_at"],
+}
+# Columns stored as BINARY(16) UUIDs, written as 32 hex characters
+UUID_COLUMNS = {"staff_id", "order_id", "dish_id", "menu_item_id", "current_order_id"}
+# Foreign keys first, except tables.current_order_id which is loaded with the checks off
+LOAD_ORDER = ["roles", "staff_accounts", "tables", "menu_sections", "menu_items", "orders", "dishes"]
+
+SECTION_NAMES = ["Main Courses", "Salads", "Desserts", "Drinks", "Starters", "Soups", "Pasta", "Pizza",
+                 "Grill", "Seafood", "Sides", "Breakfast", "Kids", "Specials", "Cocktails", "Coffee"]
+ITEM_STYLES = ["Classic", "Spicy", "Grilled", "Crispy", "Smoked", "Garden", "Chef's", "House", "Roasted",
+               "Creamy", "Lemon", "Garlic", "Truffle", "Honey", "Herb", "Wild", "Rustic", "Golden"]
+DISH_NOTES = ["Less spicy", "Extra cheese", "No onions", "No ice", "With ice", "Warm", "Well done",
+              "Medium rare", "Gluten free", "Sauce on the side", "No croutons", "Extra sauce"]
+FIRST_NAMES = ["Thanh", "Trung", "Nghia", "Minh", "Linh", "Anh", "Huy", "Mai", "Lan", "Tuan", "Ngoc", "Khoa"]
+LAST_NAMES = ["Dat", "Hieu", "Phat", "Nguyen", "Tran", "Le", "Pham", "Hoang", "Vo", "Dang", "Bui", "Do"]
+
+# Share of dishes still in the kitchen for orders placed in the last hours of the dataset
+OPEN_DISH_STATUS_WEIGHTS = {"received": 0.45, "prepared": 0.35, "ready": 0.20}
+# Party sizes by table capacity, small parties dominate
+CAPACITY_WEIGHTS = {2: 0.35, 4: 0.40, 6: 0.15, 8: 0.10}
+
+
+def load_fixture(name: str):
+    with open(os.path.join(MOCK_DATA_DIR, f"{name}.json")) as fixture:
+        return json.load(fixture)
+
+
+def new_uuid(rng: random.Random):
+    # Seeded version 4 UUID, so the same seed always gives the same dataset
+    return uuid.UUID(int=rng.getrandbits(128), version=4).hex
+
+
+def timestamp(value: datetime):
+    return value.strftime("%Y-%m-%d %H:%M:%S")
+
+
+class DatasetGenerator:
+    def __init__(self, seed: int = 30003, sites: int = 10, tables_per_site: int = 200,
+                 menu_sections: int = 12, menu_items: int = 300, days: int = 90,
+                 turns_per_table: float = 2.5, end_date: date = date(2024, 7, 30),
+                 password: str = "Waiter@123"):
+        self.rng = random.Random(seed)
+        self.sites = sites
+        self.tables_per_site = tables_per_site
+        self.menu_sections = menu_sections
+        self.menu_items = menu_items
+        self.days = days
+        self.turns_per_table = turns_per_table
+        self.end = datetime.combine(end_date, datetime.min.time()) + timedelta(hours=22)
+        # One bcrypt hash shared by every generated account, hashing millions is not the point
+        self.password_hash = CryptContext(schemes=["bcrypt"], deprecated="auto").hash(password)
+        self.waiters = {}
+        self.chefs = {}
+        self.tables = []
+        self.items = {}
+        # Table id -> its unserved order
+        self.open_tables = {}
+
+    # ------------------------ REFERENCE DATA ------------------------
+
+    def roles(self):
+        for role in load_fixture("roles"):
+            yield [role["role_id"], role["role_name"]]
+
+    def staff_accounts(self):
+        created_at = timestamp(self.end - timedelta(days=self.days + 30))
+        for site in range(1, self.sites + 1):
+            self.waiters[site] = []
+            self.chefs[site] = []
+            for role_id, prefix, count in ((1, "waiter", 12), (2, "chef", 6), (3, "manager", 2)):
+                for number in range(1, count + 1):
+                    staff_id = new_uuid(self.rng)
+                    if role_id == 1:
+                        self.waiters[site].append(staff_id)
+                    elif role_id == 2:
+                        self.chefs[site].append(staff_id)
+                    dob = date(1970, 1, 1) + timedelta(days=self.rng.randrange(365 * 35))
+                    yield [staff_id, site, role_id, f"{prefix}{site}_{number}", self.password_hash,
+                           f"{self.rng.choice(FIRST_NAMES)} {self.rng.choice(LAST_NAMES)}",
+                           self.rng.choice(["male", "female", "others"]), dob.isoformat(), created_at, 1]
+
+    def tables_rows(self):
+        capacities = list(CAPACITY_WEIGHTS)
+        weights = list(CAPACITY_WEIGHTS.values())
+        table_id = 0
+        for site in range(1, self.sites + 1):
+            for _ in range(self.tables_per_site):
+                table_id += 1
+                capacity = self.rng.choices(capacities, weights)[0]
+                self.tables.append((table_id, site, capacity))
+        # Statuses are written after the orders, once we know which tables are still eating
+        return self.tables
+
+    def menu_sections_rows(self):
+        names = [section["section_name"] for section in load_fixture("menu_sections")]
+        names += [name for name in SECTION_NAMES if name not in names]
+        for site in range(1, self.sites + 1):
+            for number in range(1, self.menu_sections + 1):
+                name = names[(number - 1) % len(names)]
+                if number > len(names):
+                    name = f"{name} {number // len(names) + 1}"
+                yield [self.section_id(site, number), site, name]
+
+    def section_id(self, site: int, number: int):
+        # Section ids are shared by every restaurant on a shard
+        return (site - 1) * self.menu_sections + number
+
+    def menu_items_rows(self):
+        fixtures = load_fixture("menu_items")
+        base_names = [item["item_name"] for item in fixtures]
+        base_names += ["Beef Steak", "Chicken Alfredo", "Salmon Fillet", "Caesar Salad", "Tiramisu",
+                       "Lemonade", "Pork Chop", "Greek Salad", "Cheesecake", "Iced Tea", "Risotto", "Burger"]
+        for site in range(1, self.sites + 1):
+            self.items[site] = []
+            seen = set()
+            for number in range(self.menu_items):
+                if number < len(fixtures):
+                    fixture = fixtures[number]
+                    # The fixture ids are kept by the first site, the others get fresh ones
+                    menu_item_id = fixture["menu_item_id"].replace("-", "") if site == 1 else new_uuid(self.rng)
+                    name, note, price = fixture["item_name"], fixture["note"], fixture["price"]
+                    section_number = fixture["menu_section_id"]
+                else:
+                    menu_item_id = new_uuid(self.rng)
+                    name = f"{self.rng.choice(ITEM_STYLES)} {self.rng.choice(base_names)}"
+                    while name in seen:
+                        name = f"{name} {len(seen)}"
+                    note = self.rng.choice(DISH_NOTES + [None])
+                    # Prices cluster around a few points like a real menu
+                    price = round(self.rng.lognormvariate(math.log(9), 0.55), 1) + 0.5
+                    section_number = self.rng.randint(1, self.menu_sections)
+                seen.add(name)
+                # Popularity follows a long tail, a few items make most of the orders
+                self.items[site].append((menu_item_id, price, 1.0 / (number + 1) ** 0.8))
+                yield [menu_item_id, site, self.section_id(site, section_number), name,
+                       note if note is not None else NULL, price]
+
+    # ------------------------ ORDER HISTORY ------------------------
+
+    def order_time(self, day: date):
+        # Lunch and dinner peaks with a thin afternoon in between
+        peak = self.rng.random()
+        if peak < 0.4:
+            hour = self.rng.gauss(12.5, 0.9)
+        elif peak < 0.9:
+            hour = self.rng.gauss(19.0, 1.2)
+        else:
+            hour = self.rng.uniform(10.0, 22.0)
+        hour = min(max(hour, 10.0), 21.9)
+        return datetime.combine(day, datetime.min.time()) + timedelta(seconds=int(hour * 3600))
+
+    def orders_and_dishes(self):
+        # Yields ("orders", row) and ("dishes", row) so both files are streamed in one pass
+        item_ids = {site: [item[0] for item in items] for site, items in self.items.items()}
+        item_prices = {item[0]: item[1] for items in self.items.values() for item in items}
+        item_weights = {site: [item[2] for item in items] for site, items in self.items.items()}
+        open_after = self.end - timedelta(hours=3)
+        start_day = self.end.date() - timedelta(days=self.days - 1)
+        for offset in range(self.days):
+            day = start_day + timedelta(days=offset)
+            # Weekends are busier
+            busy = 1.35 if day.weekday() >= 4 else 1.0
+            for table_id, site, capacity in self.tables:
+                turns = self.poisson(self.turns_per_table * busy)
+                for created_at in sorted(self.order_time(day) for _ in range(turns)):
+                    is_open = created_at >= open_after and table_id not in self.open_tables
+                    if created_at >= open_after and not is_open:
+                        continue
+                    order_id = new_uuid(self.rng)
+                    if is_open:
+                        self.open_tables[table_id] = order_id
+                    waiter_id = self.rng.choice(self.waiters[site])
+                    yield "orders", [order_id, site, table_id, waiter_id, 0 if is_open else 1, timestamp(created_at)]
+                    party = self.rng.randint(1, capacity)
+                    for menu_item_id in self.rng.choices(item_ids[site], item_weights[site],
+                                                         k=party + self.rng.randint(0, 2)):
+                        quantity = self.rng.choices([1, 2, 3], [0.75, 0.2, 0.05])[0]
+                        status = "ready"
+                        if is_open:
+                            status = self.rng.choices(list(OPEN_DISH_STATUS_WEIGHTS),
+                                                      list(OPEN_DISH_STATUS_WEIGHTS.values()))[0]
+                        note = self.rng.choice(DISH_NOTES) if self.rng.random() < 0.3 else NULL
+                        yield "dishes", [new_uuid(self.rng), site, order_id, self.rng.choice(self.chefs[site]),
+                                         menu_item_id, note, quantity,
+                                         round(item_prices[menu_item_id] * quantity, 2), status,
+                                         *self.dish_times(created_at, status)]
+
+    def dish_times(self, received_at: datetime, status: str):
+        # Long-tailed kitchen times, around 12 minutes to prepare and 3 more to reach the table
+        prepared_at = received_at + timedelta(seconds=int(self.rng.lognormvariate(6.6, 0.45)))
+        ready_at = prepared_at + timedelta(seconds=int(self.rng.lognormvariate(5.2, 0.5)))
+        return [timestamp(received_at),
+                timestamp(prepared_at) if status != "received" else NULL,
+                timestamp(ready_at) if status == "ready" else NULL]
+
+    def poisson(self, mean: float):
+        # Knuth's method, fine for the small means used here
+        limit = math.exp(-mean)
+        count, product = 0, self.rng.random()
+        while product > limit:
+            count += 1
+            product *= self.rng.random()
+        return count
+
+    # ------------------------ OUTPUT ------------------------
+
+    def write(self, out_dir: str):
+        os.makedirs(out_dir, exist_ok=True)
+        files = {name: open(os.path.join(out_dir, f"{name}.csv"), "w", newline="") for name in COLUMNS}
+        writers = {name: csv.writer(handle) for name, handle in files.items()}
+        for name, writer in writers.items():
+            writer.writerow(COLUMNS[name])
+        counts = dict.fromkeys(COLUMNS, 0)
+        try:
+            for name, rows in (("roles", self.roles()), ("staff_accounts", self.staff_accounts()),
+                               ("menu_sections", self.menu_sections_rows()),
+                               ("menu_items", self.menu_items_rows())):
+                for row in rows:
+                    writers[name].writerow(row)
+                    counts[name] += 1
+            self.tables_rows()
+            for name, row in self.orders_and_dishes():
+                writers[name].writerow(row)
+                counts[name] += 1
+            for table_id, site, capacity in self.tables:
+                if table_id in self.open_tables:
+                    status = "eating"
+                else:
+                    status = "reserved" if self.rng.random() < 0.05 else "vacant"
+                writers["tables"].writerow([table_id, site, capacity, status, self.open_tables.get(table_id, NULL)])
+                counts["tables"] += 1
+        finally:
+            for handle in files.values():
+                handle.close()
+        return counts
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Generate a seeded synthetic restaurant dataset as CSV files")
+    parser.add_argument("--out", default="dataset")
+    parser.add_argument("--seed", type=int, default=30003)
+    parser.add_argument("--sites", type=int, default=10)
+    parser.add_argument("--tables-per-site", type=int, default=200)
+    parser.add_argument("--menu-sections", type=int, default=12)
+    parser.add_argument("--menu-items", type=int, default=300)
+    parser.add_argument("--days", type=int, default=90)
+    parser.add_argument("--turns-per-table", type=float, default=2.5,
+                        help="Average orders per table per day")
+    parser.add_argument("--end-date", type=date.fromisoformat, default=date(2024, 7, 30))
+    args = parser.parse_args()
+
+    generator = DatasetGenerator(
+        seed=args.seed, sites=args.sites, tables_per_site=args.tables_per_site,
+        menu_sections=args.menu_sections, menu_items=args.menu_items, days=args.days,
+        turns_per_table=args.turns_per_table, end_date=args.end_date)
+    counts = generator.write(args.out)
+    for name in LOAD_ORDER:
+        print(f"{name:<16}{counts[name]:>12}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,248 @@
+# This file replays traces recorded with CAPTURE_ENABLED against a staging server and reports latency per endpoint
+# Run from the backend folder: python -m tools.replay --captures captures --target http://staging:8000 --speed 5
+#     --login 1=waiter:Waiter@123 --login 2=chef:Chef@123 --login 3=manager:Manager@123 --out after.json
+import os
+import glob
+import json
+import math
+import time
+import uuid
+import asyncio
+import argparse
+from collections import defaultdict
+import httpx
+
+LOGIN_PATH = "/login"
+# Stand-ins for body values the capture only kept the type of
+PLACEHOLDERS = {"<int>": 1, "<float>": 1.0, "<bool>": True}
+PERCENTILES = (0.5, 0.9, 0.99)
+
+
+def load_traces(directory: str, limit: int = None):
+    # Every worker's files, oldest request first
+    traces = []
+    for path in glob.glob(os.path.join(directory, "capture-*.jsonl")):
+        with open(path) as handle:
+            traces.extend(json.loads(line) for line in handle if line.strip())
+    traces.sort(key=lambda trace: trace["ts"])
+    return traces[:limit] if limit else traces
+
+
+def plan(traces: list, speed: float):
+    # Per user streams of (offset in seconds from the start, trace), requests of one user stay in order.
+    # Anonymous requests other than logins do not depend on each other, each gets its own stream
+    if not traces:
+        return {}
+    first = traces[0]["ts"]
+    streams = defaultdict(list)
+    for number, trace in enumerate(traces):
+        streams[trace["user"] or f"anonymous-{number}"].append(((trace["ts"] - first) / speed, trace))
+    return dict(streams)
+
+
+def user_roles(traces: list):
+    # Role of every user, known from any request made with their token
+    return {trace["user"]: trace["role_id"] for trace in traces if trace["user"] and trace["role_id"]}
+
+
+def percentile(values: list, fraction: float):
+    # Nearest rank, values sorted
+    return values[max(math.ceil(fraction * len(values)) - 1, 0)]
+
+
+def summarize(latencies: list, errors: int, shed: int):
+    values = sorted(latencies)
+    summary = {"count": len(values), "errors": errors, "shed": shed}
+    if values:
+        summary.update({f"p{round(fraction * 100)}_ms": round(percentile(values, fraction), 3)
+                        for fraction in PERCENTILES})
+        summary["max_ms"] = round(values[-1], 3)
+    return summary
+
+
+class Replayer:
+    def __init__(self, client: httpx.AsyncClient, credentials: dict, roles: dict, speed: float):
+        self.client = client
+        self.credentials = credentials
+        self.roles = roles
+        self.speed = speed
+        self.run_id = uuid.uuid4().hex[:8]
+        self.tokens = {}
+        self.filled = 0
+        # Captured id -> id the staging server handed out for the same write
+        self.ids = {}
+        self.latencies = defaultdict(list)
+        self.errors = defaultdict(int)
+        self.shed = defaultdict(int)
+        # Requests of users whose role has no --login account
+        self.skipped = 0
+        # How late requests were sent, a replayer that cannot keep up makes the latencies meaningless
+        self.lag = []
+
+    # ------------------------ SESSIONS ------------------------
+
+    def account(self, user: str):
+        username, _, password = self.credentials[self.roles[user]].partition(":")
+        return {"username": username, "password": password}
+
+    async def login(self, user: str, restaurant_id):
+        headers = {"X-Restaurant-Id": str(restaurant_id)} if restaurant_id is not None else {}
+        response = await self.client.post(LOGIN_PATH, data=self.account(user), headers=headers)
+        if response.status_code == 200:
+            self.tokens[user] = response.json()["access_token"]
+        return response
+
+    # ------------------------ REQUESTS ------------------------
+
+    def rewrite(self, text: str):
+        for captured, replayed in self.ids.items():
+            text = text.replace(captured, replayed)
+        return text
+
+    def fill(self, value):
+        # A unique text per placeholder, names of sections and stations must not collide
+        if isinstance(value, dict):
+            return {key: self.fill(item) for key, item in value.items()}
+        if isinstance(value, list):
+            return [self.fill(item) for item in value]
+        if value == "<str>":
+            self.filled += 1
+            return f"replay-{self.run_id}-{self.filled}"
+        return PLACEHOLDERS.get(value, value) if isinstance(value, str) else value
+
+    def request_args(self, trace: dict):
+        headers = dict(trace["headers"])
+        if "idempotency-key" in headers:
+            # Unique per run, a second replay against the same server is not deduplicated
+            headers["idempotency-key"] = f"replay-{self.run_id}-{headers['idempotency-key']}"
+        if trace["user"] in self.tokens:
+            headers["Authorization"] = f"Bearer {self.tokens[trace['user']]}"
+        args = {"headers": headers, "params": {key: self.rewrite(value) for key, value in trace["query"].items()}}
+        if trace["body_type"] == "json":
+            args["content"] = self.rewrite(json.dumps(self.fill(trace["body"])))
+            headers["content-type"] = "application/json"
+        elif trace["body_type"] == "form":
+            args["data"] = {key: self.rewrite(str(value)) for key, value in self.fill(trace["body"]).items()}
+        return args
+
+    async def send(self, trace: dict):
+        if trace["method"] == "POST" and trace["path"] == LOGIN_PATH and trace["user"]:
+            return await self.login(trace["user"], trace["restaurant_id"])
+        if trace["user"] and trace["user"] not in self.tokens:
+            # Logged in before the capture started, not timed
+            await self.login(trace["user"], trace["restaurant_id"])
+        response = await self.client.request(trace["method"], self.rewrite(trace["path"]), **self.request_args(trace))
+        if response.status_code == 401 and trace["user"]:
+            # The token ran out during a long replay
+            await self.login(trace["user"], trace["restaurant_id"])
+            response = await self.client.request(trace["method"], self.rewrite(trace["path"]),
+                                                 **self.request_args(trace))
+        if trace["ids"] and response.status_code < 300:
+            replayed = response.json()
+            for key, captured in trace["ids"].items():
+                if isinstance(replayed.get(key), str):
+                    self.ids[captured] = replayed[key]
+        return response
+
+    async def run_stream(self, start: float, stream: list):
+        for offset, trace in stream:
+            delay = start + offset - time.perf_counter()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            else:
+                self.lag.append(-delay * 1000)
+            if trace["user"] and trace["user"] not in self.roles:
+                self.skipped += 1
+                continue
+            key = f"{trace['method']} {trace['route']}"
+            clock = time.perf_counter()
+            try:
+                response = await self.send(trace)
+            except httpx.HTTPError:
+                self.errors[key] += 1
+                continue
+            self.latencies[key].append((time.perf_counter() - clock) * 1000)
+            if response.status_code == 503:
+                self.shed[key] += 1
+            elif response.status_code >= 500 or (response.status_code >= 400) != ((trace["status"] or 500) >= 400):
+                # Server errors, and requests that now fail although they worked when captured or the other way round
+                self.errors[key] += 1
+
+    async def replay(self, streams: dict):
+        start = time.perf_counter() + 0.1
+        await asyncio.gather(*(self.run_stream(start, stream) for stream in streams.values()))
+        return time.perf_counter() - start
+
+    def report(self, duration: float):
+        routes = {key: summarize(self.latencies[key], self.errors[key], self.shed[key])
+                  for key in sorted(set(self.latencies) | set(self.errors))}
+        every = [latency for latencies in self.latencies.values() for latency in latencies]
+        return {
+            "speed": self.speed,
+            "duration_s": round(duration, 3),
+            "total": summarize(every, sum(self.errors.values()), sum(self.shed.values())),
+            "lag_p99_ms": round(percentile(sorted(self.lag), 0.99), 3) if self.lag else 0.0,
+            "skipped": self.skipped,
+            "routes": routes,
+        }
+
+# ------------------------ OUTPUT ------------------------
+
+
+def print_report(report: dict, baseline: dict = None):
+    print(f"Replayed at {report['speed']}x in {report['duration_s']}s, "
+          f"sent up to {report['lag_p99_ms']}ms late (p99), {report['skipped']} requests skipped without an account")
+    header = f"{'endpoint':<58}{'count':>7}{'p50 ms':>10}{'p90 ms':>10}{'p99 ms':>10}{'errors':>8}{'shed':>6}"
+    if baseline:
+        header += f"{'p50 diff':>10}{'p99 diff':>10}"
+    print(header)
+    for key, summary in [*report["routes"].items(), ("total", report["total"])]:
+        line = (f"{key:<58}{summary['count']:>7}{summary.get('p50_ms', 0):>10.1f}{summary.get('p90_ms', 0):>10.1f}"
+                f"{summary.get('p99_ms', 0):>10.1f}{summary['errors']:>8}{summary['shed']:>6}")
+        before = baseline["total"] if baseline and key == "total" else (baseline or {}).get("routes", {}).get(key)
+        if before and before.get("p50_ms") and summary.get("p50_ms"):
+            line += (f"{summary['p50_ms'] / before['p50_ms'] - 1:>+10.0%}"
+                     f"{summary['p99_ms'] / before['p99_ms'] - 1:>+10.0%}")
+        print(line)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Replay captured traffic against a staging server")
+    parser.add_argument("--captures", default="captures", help="CAPTURE_DIR the traces were written to")
+    parser.add_argument("--target", required=True, help="Base URL of the staging server")
+    parser.add_argument("--speed", type=float, default=1.0, help="1 keeps the captured pace, 5 sends 5 times faster")
+    parser.add_argument("--login", action="append", default=[], metavar="ROLE_ID=USERNAME:PASSWORD",
+                        help="Staging account every captured user of this role is replayed as")
+    parser.add_argument("--limit", type=int, help="Replay only the first requests")
+    parser.add_argument("--connections", type=int, default=100)
+    parser.add_argument("--out", help="Write the report as JSON, to compare with a later release")
+    parser.add_argument("--baseline", help="Report of an earlier replay to compare with")
+    args = parser.parse_args()
+
+    traces = load_traces(args.captures, args.limit)
+    if not traces:
+        parser.error(f"No traces in {args.captures}")
+    credentials = {int(role): account for role, _, account in (login.partition("=") for login in args.login)}
+    roles = {user: role for user, role in user_roles(traces).items() if role in credentials}
+    streams = plan(traces, args.speed)
+    print(f"{len(traces)} requests from {len(streams)} streams")
+
+    async def run():
+        limits = httpx.Limits(max_connections=args.connections, max_keepalive_connections=args.connections)
+        async with httpx.AsyncClient(base_url=args.target, limits=limits, timeout=30.0) as client:
+            replayer = Replayer(client, credentials, roles, args.speed)
+            return replayer.report(await replayer.replay(streams))
+    report = asyncio.run(run())
+
+    baseline = None
+    if args.baseline:
+        with open(args.baseline) as handle:
+            baseline = json.load(handle)
+    print_report(report, baseline)
+    if args.out:
+        with open(args.out, "w") as handle:
+            json.dump(report, handle, indent=2)
+
+
+if __name__ == "__main__":
+    main()